@@ -0,0 +1,801 @@
+"""PythoShop BMP Image
+
+Helpers for creating BMP images held in a BytesIO and for looking at
+their pixels without walking them one pixel at a time.
+
+Filters work on 24 and 32-bit images.  32-bit images keep their alpha
+channel: `get_pixels` only shows filters the blue, green and red bytes of
+every pixel (so the alpha comes through any filter unchanged), and
+`get_alpha` gives the filters that use it its own view.  Indexed (1, 4 and
+8-bit) images are kept as they are: filters that change every pixel on its
+own only need to change the colors of the palette (see `apply_lut` and
+`filter_palette`), anything else works on a 24-bit copy (see
+`convert_to_24_bit`).
+"""
+
+import collections
+import io
+import math
+import mmap
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+# Number of bytes at the start of a BMP file that BmpHeader parses
+HEADER_BYTES = 38
+
+# BMP files at least this big are memory-mapped instead of read into a BytesIO
+MMAP_THRESHOLD = 16 * 1024 * 1024
+
+# Bits per pixel of the images whose pixels are indexes into a palette
+PALETTE_BPP = (1, 4, 8)
+
+# Bits per pixel of the images whose pixels `get_pixels` can view (BGR and BGRA)
+PIXEL_BPP = (24, 32)
+
+# Red, green and blue masks of 32-bit images with bit fields (compression 3) that are laid out like BGRA
+BGRA_MASKS = (0x00FF0000, 0x0000FF00, 0x000000FF)
+
+# How many bytes of released images (see release_bmp) are kept to be reused by take_bmp
+POOL_MAX_BYTES = 256 * 1024 * 1024
+
+# How many pixels a lookup table is applied to at once (bounds the temporary
+# index arrays numpy needs for the table lookup)
+LUT_CHUNK_PIXELS = 1 << 20
+
+# Color map pieces that leave a pixel unchanged
+IDENTITY_ORDER = (0, 1, 2)
+IDENTITY_LUT = np.tile(np.arange(256, dtype=np.uint8), (3, 1))
+IDENTITY_LUT.flags.writeable = False
+
+
+class BmpHeader:
+    """
+    The fields of a BMP header that PythoShop cares about
+
+    Parsed once from the first bytes of the file (see `get_header`), which are
+    kept in `raw` so the cached copy can be checked against the image cheaply.
+    """
+
+    __slots__ = (
+        "raw",
+        "file_size",
+        "fpp",
+        "header_size",
+        "width",
+        "height",
+        "top_down",
+        "color_planes",
+        "bpp",
+        "compression",
+        "pixel_data_size",
+        "padding",
+        "row_size",
+    )
+
+    def __init__(self, raw: bytes) -> None:
+        self.raw = raw
+        self.file_size = int.from_bytes(raw[2:6], "little")
+        self.fpp = int.from_bytes(raw[10:14], "little")
+        self.header_size = int.from_bytes(raw[14:18], "little")  # should be fpp - 14
+        self.width = int.from_bytes(raw[18:22], "little")
+        height = int.from_bytes(raw[22:26], "little", signed=True)
+        self.top_down = height < 0  # rows are stored top to bottom instead of bottom to top
+        self.height = abs(height)
+        self.color_planes = int.from_bytes(raw[26:28], "little")
+        self.bpp = int.from_bytes(raw[28:30], "little")
+        self.compression = int.from_bytes(raw[30:34], "little")
+        self.pixel_data_size = int.from_bytes(raw[34:38], "little")
+
+        bytes_per_row = math.ceil(self.width * self.bpp / 8)
+        self.padding = 0
+        if bytes_per_row % 4 != 0:
+            self.padding = 4 - bytes_per_row % 4
+        self.row_size = bytes_per_row + self.padding
+
+    @classmethod
+    def new(cls, width: int, height: int, bpp: int = 24) -> "BmpHeader":
+        """
+        Make the header of a new 24 or 32-bit image with a version 5 info header
+
+        32-bit images are uncompressed BGRA, which is how Pillow writes images
+        with an alpha channel too.
+
+        :param width: Width of the image in pixels
+        :param height: Height of the image in pixels
+        :param bpp: Bits per pixel (24 or 32)
+        :returns: BmpHeader whose `raw` bytes can be written at the start of the file
+        """
+        if bpp not in PIXEL_BPP:
+            raise ValueError("can only make 24 or 32-bit images, not " + str(bpp) + "-bit ones")
+        row_size = width * bpp // 8
+        if row_size % 4 != 0:
+            row_size += 4 - row_size % 4
+        raw = (
+            b"\x42\x4D"
+            + (138 + row_size * height).to_bytes(4, byteorder="little")
+            + bytes(4)
+            + (138).to_bytes(4, byteorder="little")  # starting pixel
+            + (124).to_bytes(4, byteorder="little")  # header size (for version 5)
+            + width.to_bytes(4, byteorder="little")
+            + height.to_bytes(4, byteorder="little")
+            + (1).to_bytes(2, byteorder="little")  # color planes must be 1
+            + bpp.to_bytes(2, byteorder="little")  # bits per pixel
+            + (0).to_bytes(4, byteorder="little")  # compression (none)
+            + (0).to_bytes(4, byteorder="little")  # pixel data size (0 means "work it out")
+        )
+        return cls(raw)
+
+
+def get_header(image) -> BmpHeader:
+    """
+    Get the parsed header of an image
+
+    The header is parsed the first time and then cached on the image; later
+    calls only re-read the raw header bytes and parse them again if they have
+    changed since.
+
+    :param image: BytesIO holding the BMP image
+    :returns: BmpHeader of the image
+    """
+    image.seek(0)
+    raw = image.read(HEADER_BYTES)
+    header = getattr(image, "_bmp_header", None)
+    if header is None or header.raw != raw:
+        header = BmpHeader(raw)
+        image._bmp_header = header
+    return header
+
+
+def create_bmp(width, height, bpp=24):
+    header = BmpHeader.new(width, height, bpp)
+    bmp = io.BytesIO()
+    if header.row_size * height:
+        # writing past the end makes the BytesIO fill the gap with zeros, i.e. black pixels
+        bmp.seek(header.fpp + header.row_size * height - 1)
+        bmp.write(b"\0")
+    bmp.seek(0)
+    bmp.write(header.raw)
+    bmp.seek(0)
+    bmp._bmp_header = header
+    return bmp
+
+
+_pool_lock = threading.Lock()
+_pool: collections.OrderedDict = collections.OrderedDict()  # (width, height, bpp) -> [(image, bytes)] released, oldest first
+_pool_bytes = 0
+
+
+def take_bmp(width: int, height: int, bpp: int = 24):
+    """
+    Get a 24 (or 32) bit image for an out-of-place filter to write its result into
+
+    An image of the same size that was given back with `release_bmp` is
+    reused if there is one, so running a filter again and again doesn't
+    allocate a new buffer every time; otherwise a new one is made with
+    `create_bmp`.  A reused image still has its old pixels, so only use
+    this when every pixel is going to be written.
+
+    :param width: Width of the image in pixels
+    :param height: Height of the image in pixels
+    :param bpp: Bits per pixel (24 or 32)
+    :returns: BytesIO holding the image
+    """
+    global _pool_bytes
+    image = None
+    with _pool_lock:
+        images = _pool.get((width, height, bpp))
+        if images:
+            image, size = images.pop()
+            _pool_bytes -= size
+            if not images:
+                del _pool[(width, height, bpp)]
+    if image is None:
+        image = create_bmp(width, height, bpp)
+    image._bmp_pooled = True
+    image.seek(0)
+    return image
+
+
+def release_bmp(image) -> None:
+    """
+    Give back an image from `take_bmp` that nothing uses anymore, so
+    `take_bmp` can hand it out again (anything else is left alone)
+
+    Images are kept until there are POOL_MAX_BYTES of them, after which the
+    ones released longest ago are let go.
+
+    :param image: Image buffer that won't be used again
+    :returns: None
+    """
+    global _pool_bytes
+    if not getattr(image, "_bmp_pooled", False) or image.__class__ is not io.BytesIO:
+        return
+    header = get_header(image)
+    size = len(image.getbuffer())
+    made_here = header.bpp in PIXEL_BPP and header.raw == BmpHeader.new(header.width, header.height, header.bpp).raw
+    if not made_here or size != header.fpp + header.row_size * header.height or size > POOL_MAX_BYTES:
+        return  # not laid out like create_bmp makes them any more
+    # forget everything worked out from its pixels (which also stops it being released twice)
+    for name in [name for name in vars(image) if name.startswith("_bmp_") and name != "_bmp_header"]:
+        delattr(image, name)
+
+    with _pool_lock:
+        key = (header.width, header.height, header.bpp)
+        _pool.setdefault(key, []).append((image, size))
+        _pool.move_to_end(key)
+        _pool_bytes += size
+        while _pool_bytes > POOL_MAX_BYTES:
+            key, images = next(iter(_pool.items()))
+            _pool_bytes -= images.pop(0)[1]
+            if not images:
+                del _pool[key]
+
+
+def clear_bmp_pool() -> None:
+    """Let go of every image released with `release_bmp`"""
+    global _pool_bytes
+    with _pool_lock:
+        _pool.clear()
+        _pool_bytes = 0
+
+
+class BufferImage:
+    """
+    An image buffer over a block of writable memory (e.g. shared memory)
+
+    Has the seek/read/write/getbuffer interface of a BytesIO, so filters can
+    work on it, but it can't grow past the memory it was given.
+    """
+
+    def __init__(self, buffer) -> None:
+        self._buffer = memoryview(buffer).cast("B")
+        self._position = 0
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += len(self._buffer)
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self._buffer) if size is None or size < 0 else min(len(self._buffer), self._position + size)
+        data = self._buffer[self._position : end].tobytes()
+        self._position = max(self._position, end)
+        return data
+
+    def write(self, data) -> int:
+        data = memoryview(data).cast("B")
+        end = self._position + len(data)
+        if end > len(self._buffer):
+            raise ValueError("can't write past the end of an image that isn't a BytesIO")
+        self._buffer[self._position : end] = data
+        self._position = end
+        return len(data)
+
+    def getbuffer(self) -> memoryview:
+        return self._buffer
+
+    def close(self) -> None:
+        self._buffer.release()
+
+
+class MappedImage(BufferImage):
+    """
+    A BMP file mapped into memory that can stand in for a BytesIO
+
+    The mapping is copy-on-write: filters change the image in place, but only
+    the pages they touch get copied into memory and the file on disk is never
+    changed.  Pages that are only read are shared with the OS file cache, so a
+    huge scan doesn't need to fit in memory twice.
+    """
+
+    def __init__(self, file_name: str) -> None:
+        with open(file_name, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+        super().__init__(self._map)
+
+    def close(self) -> None:
+        super().close()
+        self._map.close()
+
+
+def open_bmp(file_name: str):
+    """
+    Load a BMP file as an image buffer, memory-mapping it if it is big
+
+    :param file_name: Path of the BMP file
+    :returns: BytesIO for small files, MappedImage for ones of at least MMAP_THRESHOLD bytes
+    """
+    if os.path.getsize(file_name) >= MMAP_THRESHOLD:
+        return MappedImage(file_name)
+    with open(file_name, "rb") as file:
+        return io.BytesIO(file.read())
+
+
+def copy_bmp(image):
+    """
+    Get a copy of an image to change without touching the original
+
+    Images laid out like `create_bmp` makes them (memory-mapped ones too)
+    are copied into one from `take_bmp`, so copying one again and again
+    doesn't allocate a new buffer every time (give it back with
+    `release_bmp` if it isn't kept).
+
+    :param image: Image buffer to copy
+    :returns: BytesIO holding the copy
+    """
+    header = get_header(image)
+    if header.bpp in PIXEL_BPP and header.raw == BmpHeader.new(header.width, header.height, header.bpp).raw:
+        copy = take_bmp(header.width, header.height, header.bpp)
+        if len(copy.getbuffer()) == len(image.getbuffer()):
+            copy.getbuffer()[:] = image.getbuffer()
+            return copy
+        release_bmp(copy)
+    return io.BytesIO(image.getbuffer())
+
+
+def open_image(file_name: str):
+    """
+    Load any image file Pillow can read as a BMP image buffer
+
+    :param file_name: Path of the image file
+    :returns: Image buffer (see open_bmp) for BMP files, BytesIO holding a 24-bit BMP (32-bit for
+        images with transparency, indexed for images with a palette) for anything else
+    """
+    if os.path.splitext(file_name)[-1].lower() == ".bmp":
+        # Load it directly rather than going through Pillow where we might loose some fidelity (e.g. paddding bytes)
+        image = open_bmp(file_name)
+        header = get_header(image)
+        if header.bpp == 32 and header.compression == 0 and not has_alpha(image):
+            # written without alpha (see has_alpha): make that opaque for real, so that e.g. drawing
+            # on it (which makes what it draws opaque) doesn't leave the rest looking transparent
+            get_alpha(image)[...] = 255
+            mark_changed(image)  # (a memory-mapped file no longer says what the image is like)
+        return image
+    image = io.BytesIO()
+    with Image.open(file_name) as img:
+        if img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info:
+            img.convert("RGBA").save(image, format="bmp")  # (Pillow writes RGBA as 32-bit BGRA)
+        elif img.mode in ("1", "L", "P"):  # stays indexed (1 or 8-bit) rather than taking 3 times the memory
+            img.save(image, format="bmp")
+        else:
+            img.convert("RGB").save(image, format="bmp")
+    image.seek(0)
+    return image
+
+
+def save_bmp(image, file_name: str) -> None:
+    """
+    Write an image buffer to a file straight from its memory (no intermediate copy)
+
+    :param image: BytesIO or MappedImage holding the BMP image
+    :param file_name: Path of the file to write
+    :returns: None
+    """
+    with open(file_name, "wb") as file:
+        file.write(image.getbuffer())
+
+
+def _check_pixel_layout(image, header: BmpHeader) -> None:
+    """Raise if get_pixels can't view the pixels of an image"""
+    if header.bpp not in PIXEL_BPP:
+        raise ValueError("PythoShop filters only work on 24 and 32-bit images, not " + str(header.bpp) + "-bit ones")
+    if header.bpp == 32 and header.compression == 3:
+        image.seek(54)  # (the masks are the first thing after the version 1 info header, whatever its version)
+        masks = image.read(12)
+        if tuple(int.from_bytes(masks[i : i + 4], "little") for i in range(0, 12, 4)) != BGRA_MASKS:
+            raise ValueError("PythoShop only works on 32-bit images whose pixels are stored as BGRA")
+
+
+def can_view_pixels(image) -> bool:
+    """
+    :returns: Whether `get_pixels` can view the pixels of an image (24-bit, or 32-bit BGRA)
+    """
+    try:
+        _check_pixel_layout(image, get_header(image))
+    except ValueError:
+        return False
+    return True
+
+
+def get_pixels(image, alpha: bool = False):
+    """
+    Get a zero-copy view of the pixels of a 24 or 32-bit BMP image
+
+    The view is a (height, width, 3) uint8 array in BGR order whose row 0 is
+    the bottom row of the picture (whichever way round the file stores its
+    rows).  The padding bytes at the end of each row are skipped, so writing
+    to the view changes the image without ever touching the padding.  For
+    32-bit images the alpha byte of every pixel is skipped the same way
+    (unless asked for), so filters that only look at the colors leave it as
+    it was.
+
+    NB: while the view (or anything derived from it) is alive, the BytesIO
+    can't be resized, so drop it before calling `image.write`.
+
+    :param image: BytesIO holding the BMP image
+    :param alpha: For 32-bit images, view all four BGRA channels instead
+    :returns: numpy array viewing the pixels of the image
+    """
+    header = get_header(image)
+    _check_pixel_layout(image, header)
+    channels = header.bpp // 8
+
+    rows = np.frombuffer(image.getbuffer(), dtype=np.uint8, count=header.row_size * header.height, offset=header.fpp)
+    pixels = rows.reshape(header.height, header.row_size)[:, : header.width * channels].reshape(header.height, header.width, channels)
+    if channels == 4 and not alpha:
+        pixels = pixels[:, :, :3]
+    return pixels[::-1] if header.top_down else pixels
+
+
+def get_alpha(image):
+    """
+    Get a zero-copy view of the alpha channel of a 32-bit BMP image
+
+    :param image: BytesIO holding the 32-bit BMP image
+    :returns: (height, width) uint8 array laid out like `get_pixels`, 255 where a pixel is opaque and 0 where it is transparent
+    """
+    if get_header(image).bpp != 32:
+        raise ValueError("only 32-bit images have an alpha channel")
+    return get_pixels(image, alpha=True)[:, :, 3]
+
+
+def has_alpha(image) -> bool:
+    """
+    Whether an image has an alpha channel that says anything
+
+    Plenty of programs write 32-bit BMPs with every alpha byte left at 0
+    (the spec says the byte is unused unless there are masks), and those
+    are opaque rather than completely transparent.
+
+    :param image: BytesIO holding the BMP image
+    :returns: True for 32-bit images with an alpha byte that isn't 0
+    """
+    return get_header(image).bpp == 32 and bool(get_alpha(image).any())
+
+
+def get_pixel(image, x: int, y: int) -> tuple[int, int, int]:
+    """
+    Read the color of one pixel of a BMP image straight from where the
+    header says it is, without looking at any other pixel
+
+    :param image: BytesIO holding the BMP image
+    :param x: Column of the pixel (0 is the left one)
+    :param y: Row of the pixel (0 is the bottom one, like in `get_pixels`)
+    :returns: (red, green, blue) of the pixel
+    """
+    header = get_header(image)
+    if header.bpp not in PIXEL_BPP and header.bpp not in PALETTE_BPP:
+        raise ValueError("PythoShop filters only work on 24 and 32-bit images, not " + str(header.bpp) + "-bit ones")
+    if not (0 <= x < header.width and 0 <= y < header.height):
+        raise IndexError("pixel (" + str(x) + ", " + str(y) + ") is outside the image")
+    row = header.height - 1 - y if header.top_down else y
+    if header.bpp in PALETTE_BPP:
+        image.seek(header.fpp + row * header.row_size + x * header.bpp // 8)
+        shift = 8 - header.bpp - x * header.bpp % 8  # (the leftmost pixel is in the highest bits)
+        index = image.read(1)[0] >> shift & (1 << header.bpp) - 1
+        palette = get_palette(image)
+        b, g, r = (int(value) for value in palette[index, :3]) if index < len(palette) else (0, 0, 0)
+        return r, g, b
+    image.seek(header.fpp + row * header.row_size + x * header.bpp // 8)
+    b, g, r = image.read(3)
+    return r, g, b
+
+
+def get_palette(image):
+    """
+    Get a zero-copy view of the palette (color table) of an indexed image
+
+    :param image: BytesIO holding the 1, 4 or 8-bit BMP image
+    :returns: (colors, 4) uint8 array of blue, green, red and an unused byte
+        ((colors, 3) for the old OS/2 header, which has no unused byte)
+    """
+    header = get_header(image)
+    if header.bpp not in PALETTE_BPP:
+        raise ValueError(str(header.bpp) + "-bit images don't have a palette")
+    entry_size = 3 if header.header_size == 12 else 4
+    colors = 0
+    if header.header_size >= 40:
+        image.seek(46)
+        colors = int.from_bytes(image.read(4), "little")  # 0 means all of them
+    start = 14 + header.header_size
+    colors = min(colors or 1 << header.bpp, (header.fpp - start) // entry_size)
+    return np.frombuffer(image.getbuffer(), dtype=np.uint8, count=colors * entry_size, offset=start).reshape(colors, entry_size)
+
+
+def get_indices(image):
+    """
+    Get which color of the palette every pixel of an indexed image has
+
+    :param image: BytesIO holding the 1, 4 or 8-bit BMP image
+    :returns: (height, width) uint8 array whose row 0 is the bottom row (like `get_pixels`), a
+        zero-copy view for 8-bit images and a copy for 1 and 4-bit ones
+    """
+    header = get_header(image)
+    if header.bpp not in PALETTE_BPP:
+        raise ValueError(str(header.bpp) + "-bit images don't have a palette")
+    rows = np.frombuffer(image.getbuffer(), dtype=np.uint8, count=header.row_size * header.height, offset=header.fpp)
+    rows = rows.reshape(header.height, header.row_size)
+    if header.bpp == 8:
+        indices = rows[:, : header.width]
+    elif header.bpp == 4:
+        packed = rows[:, : (header.width + 1) // 2]
+        indices = np.stack((packed >> 4, packed & 15), axis=-1).reshape(header.height, -1)[:, : header.width]
+    else:
+        indices = np.unpackbits(rows[:, : (header.width + 7) // 8], axis=1)[:, : header.width]
+    return indices[::-1] if header.top_down else indices
+
+
+def expand_palette(image):
+    """
+    Look up the color of every pixel of an indexed image
+
+    :param image: BytesIO holding the 1, 4 or 8-bit BMP image
+    :returns: (height, width, 3) uint8 array in BGR order, laid out like `get_pixels` (but a copy)
+    """
+    palette = get_palette(image)
+    colors = np.zeros((256, 3), dtype=np.uint8)  # (pixels pointing past the end of the palette are black)
+    colors[: len(palette)] = palette[:, :3]
+    return colors[get_indices(image)]
+
+
+def convert_to_24_bit(image):
+    """
+    Make a 24-bit copy of an indexed image, for filters that need to work on its pixels
+
+    :param image: BytesIO holding the 1, 4 or 8-bit BMP image
+    :returns: BytesIO holding the 24-bit BMP image
+    """
+    header = get_header(image)
+    converted = take_bmp(header.width, header.height)  # (every pixel gets written)
+    pixels = get_pixels(converted)
+    pixels[:] = expand_palette(image)
+    del pixels
+    converted.seek(0)
+    return converted
+
+
+def filter_palette(func, image, *args, **kwargs) -> None:
+    """
+    Run a filter that changes every pixel on its own on the palette of an
+    indexed image rather than on its pixels
+
+    The colors of the palette go in a one row 24-bit probe image that the
+    filter runs on, and whatever they become is written back, so how long it
+    takes doesn't depend on the size of the image.
+
+    :param func: The filter to run
+    :param image: BytesIO holding the 1, 4 or 8-bit BMP image (changed in place)
+    :param args: Extra positional arguments to call the filter with
+    :param kwargs: Extra keyword arguments to call the filter with
+    :returns: None
+    """
+    palette = get_palette(image)
+    probe = create_bmp(len(palette), 1)
+    pixels = get_pixels(probe)
+    pixels[0] = palette[:, :3]
+    del pixels
+
+    probe.seek(0)
+    result = func(probe, *args, **kwargs)
+    palette[:, :3] = get_pixels(result or probe)[0]
+    mark_changed(image)
+
+
+def get_pixel_data(image) -> memoryview:
+    """
+    Get a zero-copy view of the raw pixel data of a BMP image (padding included)
+
+    :param image: BytesIO holding the BMP image
+    :returns: memoryview of the bytes from the first pixel to the end of the last row
+    """
+    header = get_header(image)
+    return image.getbuffer()[header.fpp : header.fpp + header.row_size * header.height]
+
+
+def mark_dirty(image, left: int, bottom: int, right: int, top: int) -> None:
+    """
+    Record that a manipulation changed the pixels in a rectangle
+
+    Coordinates are those of `get_pixels` (row 0 is the bottom row), with
+    left/bottom included and right/top excluded.  Marks add up to their
+    bounding box until `take_dirty` collects them.  Functions that only change
+    a small part of an image should mark everything they change, so only that
+    part gets redisplayed; if nothing is marked the whole image is assumed to
+    have changed.
+
+    :param image: Image buffer that was changed
+    :returns: None
+    """
+    mark_changed(image)
+    header = get_header(image)
+    left, right = max(0, left), min(header.width, right)
+    bottom, top = max(0, bottom), min(header.height, top)
+    if left >= right or bottom >= top:
+        return
+    dirty = getattr(image, "_bmp_dirty", None)
+    if dirty is not None:
+        left, bottom = min(left, dirty[0]), min(bottom, dirty[1])
+        right, top = max(right, dirty[2]), max(top, dirty[3])
+    image._bmp_dirty = (left, bottom, right, top)
+
+
+def mark_changing(image, left: int, bottom: int, right: int, top: int) -> None:
+    """
+    Record that a manipulation is about to change the pixels in a rectangle
+
+    Same coordinates as `mark_dirty`, but called before the pixels are
+    written, so whatever keeps track of what the image was like (see
+    UndoHistory) can save that part of it first.  Tools that change an image
+    in place should announce everything they change (Drawing does).
+
+    :param image: Image buffer that is about to be changed
+    :returns: None
+    """
+    before_change = getattr(image, "_bmp_before_change", None)
+    if before_change is None:
+        return
+    header = get_header(image)
+    left, right = max(0, left), min(header.width, right)
+    bottom, top = max(0, bottom), min(header.height, top)
+    if left < right and bottom < top:
+        before_change(left, bottom, right, top)
+
+
+def mark_changed(image) -> None:
+    """
+    Record that the pixels of an image changed, so whatever was worked out
+    from them before (see ImageStats) has to be worked out again
+
+    Exported functions, `mark_dirty` and `apply_lut` do this already; only
+    code writing pixels some other way needs to call it.
+
+    :param image: Image buffer that was changed
+    :returns: None
+    """
+    image._bmp_version = getattr(image, "_bmp_version", 0) + 1
+
+
+def get_version(image) -> int:
+    """
+    :returns: A number that changes every time the image is marked as changed
+    """
+    return getattr(image, "_bmp_version", 0)
+
+
+def take_dirty(image):
+    """
+    Collect (and forget) the rectangle marked by `mark_dirty`
+
+    :param image: Image buffer
+    :returns: (left, bottom, right, top) or None if nothing was marked
+    """
+    dirty = getattr(image, "_bmp_dirty", None)
+    image._bmp_dirty = None
+    return dirty
+
+
+def compile_lut(func, *args, **kwargs):
+    """
+    Turn a per-channel point filter into a lookup table
+
+    The filter is run once on a 256 pixel probe image whose pixel i is
+    (i, i, i); whatever each channel of pixel i becomes is what that channel
+    maps i to.  This is only valid for filters where every channel of the
+    result depends on nothing but the same channel of the original pixel.
+
+    :param func: The (undecorated) filter to compile
+    :param args: Extra positional arguments to call the filter with
+    :param kwargs: Extra keyword arguments to call the filter with
+    :returns: (3, 256) uint8 array with one table per channel in BGR order
+    """
+    probe = create_bmp(256, 1)
+    pixels = get_pixels(probe)
+    pixels[0] = np.arange(256, dtype=np.uint8)[:, np.newaxis]
+    del pixels
+
+    probe.seek(0)
+    result = func(probe, *args, **kwargs)
+    lut = get_pixels(result or probe)[0].T.copy()
+    lut.flags.writeable = False
+    return lut
+
+
+def compile_channel_order(func, *args, **kwargs):
+    """
+    Find out how a channel swapping filter shuffles the channels of a pixel
+
+    The filter is run once on a single pixel probe whose channels are
+    (0, 1, 2).  This is only valid for filters where every channel of the
+    result is a copy of one of the channels of the original pixel.
+
+    :param func: The (undecorated) filter to compile
+    :param args: Extra positional arguments to call the filter with
+    :param kwargs: Extra keyword arguments to call the filter with
+    :returns: Tuple with, for each channel of the result, the original channel it comes from
+    """
+    probe = create_bmp(1, 1)
+    pixels = get_pixels(probe)
+    pixels[0, 0] = [0, 1, 2]
+    del pixels
+
+    probe.seek(0)
+    result = func(probe, *args, **kwargs)
+    order = tuple(int(channel) for channel in get_pixels(result or probe)[0, 0])
+    assert sorted(order) == [0, 1, 2], func.__name__ + " doesn't just swap channels around"
+    return order
+
+
+def compose_color_maps(first, second):
+    """
+    Combine two color maps into one that does the work of both
+
+    A color map is an (order, lut) pair: channel c of the result is
+    `lut[c][pixel[order[c]]]`.  Every point filter and channel swap is one.
+
+    :param first: Color map applied first
+    :param second: Color map applied to the result of the first one
+    :returns: Color map equivalent to applying `first` and then `second`
+    """
+    order1, lut1 = first
+    order2, lut2 = second
+    order = tuple(order1[order2[c]] for c in range(3))
+    lut = np.stack([lut2[c][lut1[order2[c]]] for c in range(3)])
+    lut.flags.writeable = False
+    return order, lut
+
+
+def apply_lut(image, lut, order=IDENTITY_ORDER):
+    """
+    Replace every channel of every pixel by its entry in a lookup table
+
+    When all three channels share the same table (and stay in place) the
+    pixels go through `bytes.translate`, otherwise through a numpy table
+    lookup.  Either way the image is processed a chunk of rows at a time in C,
+    never pixel by pixel.  For indexed images only the colors of the palette
+    are looked up, and the alpha of 32-bit images is left as it is.
+
+    :param image: BytesIO holding the BMP image (changed in place)
+    :param lut: (3, 256) uint8 array as returned by `compile_lut`
+    :param order: For each channel, the channel it is looked up from (see `compile_channel_order`)
+    :returns: None
+    """
+    mark_changed(image)
+    if get_header(image).bpp in PALETTE_BPP:
+        pixels = get_palette(image)[np.newaxis, :, :3]  # (as a one row image)
+    else:
+        pixels = get_pixels(image, alpha=True)
+    height, width = pixels.shape[:2]
+    rows_per_chunk = max(1, LUT_CHUNK_PIXELS // max(1, width))
+    in_place = tuple(order) == IDENTITY_ORDER
+    same_table = in_place and bool((lut[0] == lut[1]).all() and (lut[1] == lut[2]).all())
+    has_alpha_channel = pixels.shape[2] == 4
+    table = lut[0].tobytes()
+    # channels whose table maps every value to itself can be copied as they are
+    changed = [(lut[c] != IDENTITY_LUT[c]).any() for c in range(3)]
+
+    for first_row in range(0, height, rows_per_chunk):
+        chunk = pixels[first_row : first_row + rows_per_chunk]
+        if same_table:
+            # (the alpha of 32-bit images gets translated too and is then put back, which is
+            # quicker than translating the colors of a view that skips it)
+            alpha = chunk[:, :, 3].copy() if has_alpha_channel else None
+            chunk[:] = np.frombuffer(chunk.tobytes().translate(table), dtype=np.uint8).reshape(chunk.shape)
+            if alpha is not None:
+                chunk[:, :, 3] = alpha
+            continue
+
+        source = chunk if in_place else chunk.copy()
+        for c in range(3):
+            if changed[c]:
+                chunk[:, :, c] = lut[c][source[:, :, order[c]]]
+            elif order[c] != c:
+                chunk[:, :, c] = source[:, :, order[c]]
@@ -0,0 +1,275 @@
+"""PythoShop Compositing
+
+Puts one image on top of another: lines the two up (they don't have to be
+the same size), then blends the part where they overlap with one of the
+blend modes, optionally through a matte (alpha blending), a band of rows
+at a time.  A chroma key turns the colored screen behind the top image
+into such a matte.
+
+Everything works on pixel arrays like those of `get_pixels`: (height,
+width, 3) uint8 in BGR order with row 0 at the bottom, or (height, width,
+4) BGRA ones from 32-bit images.  The alpha of a BGRA image underneath
+becomes how opaque it is with the top image "over" it; the alpha of a top
+image is only used if it is passed as the matte.  Sizes and positions are
+(x, y) / (width, height) like everywhere else in PythoShop.
+"""
+
+import functools
+import typing
+
+import numpy as np
+
+# Where get_position puts the top image, as (x, y) in halves of the room left around it
+ALIGNMENTS = {
+    "bottom-left": (0, 0),
+    "bottom": (1, 0),
+    "bottom-right": (2, 0),
+    "left": (0, 1),
+    "center": (1, 1),
+    "right": (2, 1),
+    "top-left": (0, 2),
+    "top": (1, 2),
+    "top-right": (2, 2),
+}
+
+# Channel of the BGR pixels that each screen color of a chroma key is in
+KEY_CHANNELS = {"blue": 0, "green": 1, "red": 2}
+
+# How many pixels are composited at once (bounds the temporary arrays and keeps them in cache)
+BAND_PIXELS = 1 << 16
+
+
+def _div255(x: np.ndarray) -> np.ndarray:
+    """x / 255 rounded, for uint16 x up to 255 * 255, without a division"""
+    x = x + np.uint16(128)
+    return ((x + (x >> 8)) >> 8).astype(np.uint8)
+
+
+def _multiply(base: np.ndarray, top: np.ndarray) -> np.ndarray:
+    return _div255(base.astype(np.uint16) * top)
+
+
+def _screen(base: np.ndarray, top: np.ndarray) -> np.ndarray:
+    return 255 - _div255((255 - base).astype(np.uint16) * (255 - top))
+
+
+def _overlay(base: np.ndarray, top: np.ndarray) -> np.ndarray:
+    # multiply where the base is dark, screen where it is light (both doubled); picked with
+    # bit masks rather than np.where, which is several times slower on a mix of both
+    light = (base >> 7) * np.uint8(255)  # 255 where the base is light, 0 where it is dark
+    product = (base ^ light).astype(np.uint16) * (top ^ light)  # (255 - x is x ^ 255)
+    return _div255(product << 1) ^ light
+
+
+def _difference(base: np.ndarray, top: np.ndarray) -> np.ndarray:
+    return np.maximum(base, top) - np.minimum(base, top)
+
+
+# Blend mode name -> function of the (base, top) uint8 pixels giving the blended uint8 pixels
+BLEND_MODES: dict[str, typing.Optional[typing.Callable[[np.ndarray, np.ndarray], np.ndarray]]] = {
+    "normal": None,  # just the top pixels
+    "multiply": _multiply,
+    "screen": _screen,
+    "overlay": _overlay,
+    "difference": _difference,
+}
+
+
+def get_position(base_size, top_size, align: str = "center", offset=(0, 0)) -> tuple[int, int]:
+    """
+    Work out where to put an image on top of another
+
+    :param base_size: (width, height) of the image underneath
+    :param top_size: (width, height) of the image on top
+    :param align: Which part of the base the top image lines up with (see ALIGNMENTS)
+    :param offset: (x, y) to move the top image by from there
+    :returns: (x, y) of the bottom left pixel of the top image on the base (can be outside it)
+    """
+    if align not in ALIGNMENTS:
+        raise ValueError("unknown alignment: " + str(align))
+    halves_x, halves_y = ALIGNMENTS[align]
+    return (
+        (base_size[0] - top_size[0]) * halves_x // 2 + offset[0],
+        (base_size[1] - top_size[1]) * halves_y // 2 + offset[1],
+    )
+
+
+def get_overlap(base: np.ndarray, top: np.ndarray, position) -> typing.Optional[tuple[tuple[slice, slice], tuple[slice, slice]]]:
+    """
+    Find the part of the base that an image put at a position covers
+
+    :param base: Pixels of the image underneath
+    :param top: Pixels of the image on top
+    :param position: (x, y) of the bottom left pixel of the top image on the base
+    :returns: ((rows, columns) of the base, (rows, columns) of the top) that overlap, or None if they don't
+    """
+    x, y = position
+    left, bottom = max(0, x), max(0, y)
+    right, top_row = min(base.shape[1], x + top.shape[1]), min(base.shape[0], y + top.shape[0])
+    if left >= right or bottom >= top_row:
+        return None
+    return (slice(bottom, top_row), slice(left, right)), (slice(bottom - y, top_row - y), slice(left - x, right - x))
+
+
+def _over(base_alpha: np.ndarray, weight: int, matte: typing.Optional[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    How opaque the base is with the top over it, and the matte the colors have to be mixed with
+    so that the top shows in proportion to how much of that it makes up
+    """
+    if matte is None:
+        coverage = np.full(base_alpha.shape, 255, dtype=np.uint16)
+    else:
+        coverage = matte.astype(np.uint16)
+    coverage *= np.uint16(weight)
+    coverage += np.uint16(128)
+    coverage >>= 8  # (how much of the top there is, from 0 to 255)
+    alpha = _div255((np.uint16(255) - coverage) * base_alpha) + coverage
+    coverage *= np.uint16(255)
+    coverage //= np.maximum(alpha, np.uint16(1))
+    return alpha.astype(np.uint8), coverage.astype(np.uint8)
+
+
+def _composite_band(base: np.ndarray, top: np.ndarray, blend, weight: int, matte: typing.Optional[np.ndarray]) -> None:
+    channels = base.shape[2]
+    alpha = None
+    if channels == 4:
+        # the alpha is mixed like the colors (all four channels at once are much quicker than a
+        # view that skips one) and then replaced by the right one
+        alpha, matte = _over(base[:, :, 3], weight, matte)
+        weight = 256
+    if top.shape[2] > channels:
+        top = top[:, :, :channels]
+    elif top.shape[2] < channels:
+        padded = np.empty(top.shape[:2] + (channels,), dtype=np.uint8)
+        padded[:, :, :3] = top
+        padded[:, :, 3] = 255
+        top = padded
+    blended = top if blend is None else blend(base, top)
+    if matte is None and weight == 256:
+        base[...] = blended
+        return
+    # (256 - w) * base + w * blended is at most 255 * 256, so it all fits in uint16; worked out
+    # in place, as allocating the temporaries costs about as much as the arithmetic
+    if matte is None:
+        mixed = blended * np.uint16(weight)
+        mixed += base * np.uint16(256 - weight)
+    else:
+        top_weight = (matte.astype(np.uint16) * np.uint16(weight) + np.uint16(127)) // np.uint16(255)
+        # one weight per channel (broadcasting a last axis of 1 instead is much slower)
+        top_weight = np.stack((top_weight,) * channels, axis=-1)
+        mixed = blended * top_weight
+        np.subtract(np.uint16(256), top_weight, out=top_weight)
+        top_weight *= base
+        mixed += top_weight
+    mixed >>= 8
+    base[...] = mixed
+    if alpha is not None:
+        base[:, :, 3] = alpha
+
+
+def composite(base: np.ndarray, top: np.ndarray, position=(0, 0), mode: str = "normal", opacity: float = 1.0, matte: typing.Optional[np.ndarray] = None) -> None:
+    """
+    Blend an image into the part of another one that it covers
+
+    :param base: Pixels of the image underneath (changed in place)
+    :param top: Pixels of the image on top
+    :param position: (x, y) of the bottom left pixel of the top image on the base (see get_position)
+    :param mode: Blend mode (see BLEND_MODES)
+    :param opacity: How much of the blended pixels to use, from 0 (none) to 1 (all)
+    :param matte: (height, width) uint8 array the size of the top image, 255 where it is opaque and 0 where
+        it is transparent (see chroma_key and get_alpha); the opacity applies on top of it
+    :returns: None
+    """
+    if mode not in BLEND_MODES:
+        raise ValueError("unknown blend mode: " + str(mode))
+    overlap = get_overlap(base, top, position)
+    if overlap is None:
+        return
+    (base_rows, base_columns), (top_rows, top_columns) = overlap
+    base, top = base[base_rows, base_columns], top[top_rows, top_columns]
+    if matte is not None:
+        matte = matte[top_rows, top_columns]
+    weight = min(256, max(0, round(opacity * 256)))
+
+    rows_at_once = max(1, BAND_PIXELS // base.shape[1])
+    for row in range(0, base.shape[0], rows_at_once):
+        band = slice(row, row + rows_at_once)
+        _composite_band(base[band], top[band], BLEND_MODES[mode], weight, None if matte is None else matte[band])
+
+
+@functools.lru_cache(maxsize=16)
+def _matte_lut(tolerance: int, softness: int) -> np.ndarray:
+    """Matte value for every key strength from -255 to 255 (see chroma_key)"""
+    strength = np.arange(-255, 256)
+    # (with a softness of 1 everything under the tolerance is kept whole, i.e. a hard key)
+    matte = np.clip((tolerance - strength) * 255 // max(1, softness), 0, 255).astype(np.uint8)
+    matte.flags.writeable = False
+    return matte
+
+
+def chroma_key(pixels: np.ndarray, key: str = "green", tolerance: int = 100, softness: int = 0) -> np.ndarray:
+    """
+    Make a matte that hides the pixels of a colored screen
+
+    How much a pixel looks like the screen is how far its key channel is
+    above the highest of its other two.
+
+    :param pixels: Pixels of the image shot in front of the screen
+    :param key: Color of the screen (see KEY_CHANNELS)
+    :param tolerance: Pixels whose key channel is at least this far above the others are hidden
+    :param softness: Pixels up to this much less far above are partly hidden, fading out towards the screen
+    :returns: (height, width) uint8 matte, 255 where the pixel is kept and 0 where it is hidden
+    """
+    channel = KEY_CHANNELS[key]
+    others = [c for c in range(3) if c != channel]
+    strength = pixels[:, :, channel].astype(np.int16) - np.maximum(pixels[:, :, others[0]], pixels[:, :, others[1]])
+    return _matte_lut(tolerance, softness).take(strength + np.int16(255))
+
+
+def suppress_spill(pixels: np.ndarray, key: str = "green") -> np.ndarray:
+    """
+    Take the tint the screen's light leaves on the edges of what is in
+    front of it out of some pixels, by not letting the key channel go above
+    the highest of the other two
+
+    :param pixels: Pixels of the image shot in front of the screen
+    :param key: Color of the screen (see KEY_CHANNELS)
+    :returns: Despilled copy of the pixels
+    """
+    channel = KEY_CHANNELS[key]
+    others = [c for c in range(3) if c != channel]
+    despilled = pixels.copy()
+    np.minimum(pixels[:, :, channel], np.maximum(pixels[:, :, others[0]], pixels[:, :, others[1]]), out=despilled[:, :, channel])
+    return despilled
+
+
+def chroma_composite(base: np.ndarray, top: np.ndarray, position=(0, 0), key: str = "green", tolerance: int = 100, softness: int = 0, despill: bool = False) -> None:
+    """
+    Put an image shot in front of a colored screen on top of another,
+    showing the image underneath wherever the screen was
+
+    :param base: Pixels of the image underneath (changed in place)
+    :param top: Pixels of the image shot in front of the screen
+    :param position: (x, y) of the bottom left pixel of the top image on the base (see get_position)
+    :param key: Color of the screen (see KEY_CHANNELS)
+    :param tolerance: See chroma_key
+    :param softness: See chroma_key
+    :param despill: Also take the screen's tint out of what is kept (see suppress_spill)
+    :returns: None
+    """
+    if key not in KEY_CHANNELS:
+        raise ValueError("unknown key color: " + str(key))
+    overlap = get_overlap(base, top, position)
+    if overlap is None:
+        return
+    (base_rows, base_columns), (top_rows, top_columns) = overlap
+    base, top = base[base_rows, base_columns], top[top_rows, top_columns]
+
+    rows_at_once = max(1, BAND_PIXELS // base.shape[1])
+    for row in range(0, base.shape[0], rows_at_once):
+        band = slice(row, row + rows_at_once)
+        top_band = top[band]
+        matte = chroma_key(top_band, key, tolerance, softness)
+        if despill:
+            top_band = suppress_spill(top_band, key)
+        _composite_band(base[band], top_band, None, 256, matte)
@@ -0,0 +1,370 @@
+"""PythoShop Drawing
+
+Drawing primitives (rectangles, circles, lines, polylines, flood fill)
+that work on the pixels of a BMP image a whole row span or a whole set of
+points at a time.  Spans are written by copying a row of the color that
+was repeated once up front, rather than by setting pixel after pixel.
+Everything is clipped to the image, only touches the rows it draws on and
+announces what it is about to change and marks what it changed (see
+BmpImage.mark_changing and BmpImage.mark_dirty).
+
+Coordinates are those of `get_pixels`: (x, y) with (0, 0) the bottom left
+pixel.  Colors are (red, green, blue) like everywhere else in PythoShop.
+On 32-bit images whatever is drawn is opaque (its alpha becomes 255).
+"""
+
+import bisect
+import functools
+import math
+
+import numpy as np
+
+from BmpImage import get_pixels, mark_changing, mark_dirty
+
+
+def _bgr(color, channels: int = 3) -> np.ndarray:
+    """The bytes of one pixel of a color (with an opaque alpha byte if it has 4 channels)"""
+    return np.array([color[2], color[1], color[0], 255][:channels], dtype=np.uint8)
+
+
+def _pattern(color, width: int, channels: int = 3) -> np.ndarray:
+    """The bytes of a span of width pixels of a color"""
+    return np.tile(_bgr(color, channels), max(0, width))
+
+
+def _row_bytes(pixels: np.ndarray) -> np.ndarray:
+    """View the (height, width, channels) pixels as (height, width * channels) bytes"""
+    rows = pixels.view()
+    rows.shape = (pixels.shape[0], pixels.shape[1] * pixels.shape[2])  # (raises rather than copying)
+    return rows
+
+
+def fill_rect(image, left: int, bottom: int, right: int, top: int, color) -> None:
+    """
+    Fill a rectangle with a color
+
+    :param image: BytesIO holding the BMP image
+    :param left: First column (included)
+    :param bottom: First row (included)
+    :param right: Last column (excluded)
+    :param top: Last row (excluded)
+    :param color: (red, green, blue) to fill it with
+    :returns: None
+    """
+    pixels = get_pixels(image, alpha=True)
+    height, width, channels = pixels.shape
+    left, right = max(0, left), min(width, right)
+    bottom, top = max(0, bottom), min(height, top)
+    if left >= right or bottom >= top:
+        return
+    mark_changing(image, left, bottom, right, top)
+    _row_bytes(pixels)[bottom:top, channels * left : channels * right] = _pattern(color, right - left, channels)
+    mark_dirty(image, left, bottom, right, top)
+
+
+def draw_rect(image, corner, other_corner, color, thickness: int = 1) -> None:
+    """
+    Draw the outline of a rectangle
+
+    :param image: BytesIO holding the BMP image
+    :param corner: (x, y) of one corner
+    :param other_corner: (x, y) of the opposite corner (both corners are part of the rectangle)
+    :param color: (red, green, blue) to draw it in
+    :param thickness: Width of the outline in pixels (inwards)
+    :returns: None
+    """
+    left, right = sorted((corner[0], other_corner[0]))
+    bottom, top = sorted((corner[1], other_corner[1]))
+    right, top = right + 1, top + 1
+    thickness = max(1, thickness)
+    if right - left <= 2 * thickness or top - bottom <= 2 * thickness:
+        fill_rect(image, left, bottom, right, top, color)
+        return
+    fill_rect(image, left, bottom, right, bottom + thickness, color)
+    fill_rect(image, left, top - thickness, right, top, color)
+    fill_rect(image, left, bottom + thickness, left + thickness, top - thickness, color)
+    fill_rect(image, right - thickness, bottom + thickness, right, top - thickness, color)
+
+
+@functools.lru_cache(maxsize=64)
+def circle_spans(radius: int) -> tuple[int, ...]:
+    """
+    Half widths of the rows of a filled circle
+
+    :param radius: Radius of the circle
+    :returns: For every row offset dy from -radius to radius, the largest dx with dx ** 2 + dy ** 2 <= radius ** 2
+    """
+    return tuple(math.isqrt(radius * radius - dy * dy) for dy in range(-radius, radius + 1))
+
+
+def fill_circle(image, center, radius: int, color) -> None:
+    """
+    Fill a circle (every pixel within radius of the center) with a color, one row span at a time
+
+    :param image: BytesIO holding the BMP image
+    :param center: (x, y) of the center
+    :param radius: Radius in pixels
+    :param color: (red, green, blue) to fill it with
+    :returns: None
+    """
+    if radius < 0:
+        return
+    pixels = get_pixels(image, alpha=True)
+    height, width, channels = pixels.shape
+    x, y = center
+    rows = _row_bytes(pixels)
+    pattern = _pattern(color, min(width, 2 * radius + 1), channels)
+    spans = circle_spans(radius)
+    mark_changing(image, x - radius, y - radius, x + radius + 1, y + radius + 1)
+    for row in range(max(0, y - radius), min(height, y + radius + 1)):
+        half_width = spans[row - y + radius]
+        left, right = max(0, x - half_width), min(width, x + half_width + 1)
+        if left < right:
+            rows[row, channels * left : channels * right] = pattern[: channels * (right - left)]
+    mark_dirty(image, x - radius, y - radius, x + radius + 1, y + radius + 1)
+
+
+def circle_points(center, radius: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Points of the outline of a circle (midpoint circle algorithm)
+
+    :param center: (x, y) of the center
+    :param radius: Radius in pixels
+    :returns: (xs, ys) arrays (points may repeat)
+    """
+    x, y = center
+    offsets_x, offsets_y = [], []
+    dx, dy, error = radius, 0, 1 - radius
+    while dx >= dy:
+        offsets_x.append(dx)
+        offsets_y.append(dy)
+        dy += 1
+        if error < 0:
+            error += 2 * dy + 1
+        else:
+            dx -= 1
+            error += 2 * (dy - dx) + 1
+    octant_x, octant_y = np.array(offsets_x), np.array(offsets_y)
+    # the other seven octants are mirror images of the first one
+    xs = np.concatenate([octant_x, octant_y, -octant_y, -octant_x, -octant_x, -octant_y, octant_y, octant_x])
+    ys = np.concatenate([octant_y, octant_x, octant_x, octant_y, -octant_y, -octant_x, -octant_x, -octant_y])
+    return x + xs, y + ys
+
+
+def draw_circle(image, center, radius: int, color) -> None:
+    """
+    Draw the outline of a circle
+
+    :param image: BytesIO holding the BMP image
+    :param center: (x, y) of the center
+    :param radius: Radius in pixels
+    :param color: (red, green, blue) to draw it in
+    :returns: None
+    """
+    if radius < 0:
+        return
+    xs, ys = circle_points(center, radius)
+    _set_points(image, xs, ys, color)
+
+
+def line_points(start, end) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Points of a line from start to end (Bresenham), worked out all at once
+
+    :param start: (x, y) of the first point
+    :param end: (x, y) of the last point
+    :returns: (xs, ys) arrays, from start to end (both included)
+    """
+    x0, y0 = start
+    x1, y1 = end
+    dx, dy = abs(x1 - x0), abs(y1 - y0)
+    step_x, step_y = (1 if x1 >= x0 else -1), (1 if y1 >= y0 else -1)
+    steps = np.arange(max(dx, dy) + 1)
+    if dx >= dy:
+        # y moves on by one whenever the error of the line would pass half a pixel
+        return x0 + step_x * steps, y0 + step_y * ((2 * dy * steps + dx) // max(1, 2 * dx))
+    return x0 + step_x * ((2 * dx * steps + dy) // (2 * dy)), y0 + step_y * steps
+
+
+def _set_points(image, xs: np.ndarray, ys: np.ndarray, color) -> None:
+    """
+    Set the pixels at some points to a color, leaving out the points outside the image
+    """
+    pixels = get_pixels(image, alpha=True)
+    height, width, channels = pixels.shape
+    inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    xs, ys = xs[inside], ys[inside]
+    if not len(xs):
+        return
+    box = (int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+    mark_changing(image, *box)
+    pixels[ys, xs] = _bgr(color, channels)
+    mark_dirty(image, *box)
+
+
+def draw_line(image, start, end, color) -> None:
+    """
+    Draw a (one pixel wide, aliased) line
+
+    :param image: BytesIO holding the BMP image
+    :param start: (x, y) of the first point
+    :param end: (x, y) of the last point
+    :param color: (red, green, blue) to draw it in
+    :returns: None
+    """
+    xs, ys = line_points(start, end)
+    _set_points(image, xs, ys, color)
+
+
+def draw_smooth_line(image, start, end, color) -> None:
+    """
+    Draw an anti-aliased line (Xiaolin Wu): every step along the line blends
+    the color into the two pixels the line passes between, in proportion to
+    how close the line is to each of them
+
+    :param image: BytesIO holding the BMP image
+    :param start: (x, y) of the first point
+    :param end: (x, y) of the last point
+    :param color: (red, green, blue) to draw it in
+    :returns: None
+    """
+    x0, y0 = start
+    x1, y1 = end
+    steep = abs(y1 - y0) > abs(x1 - x0)
+    if steep:  # work along whichever axis the line moves along the most
+        x0, y0, x1, y1 = y0, x0, y1, x1
+    if x0 > x1:
+        x0, y0, x1, y1 = x1, y1, x0, y0
+    gradient = (y1 - y0) / (x1 - x0) if x1 != x0 else 0.0
+
+    along = np.arange(x0, x1 + 1)
+    exact = y0 + gradient * (along - x0)
+    below = np.floor(exact).astype(np.int64)
+    weight_above = exact - below
+    main = np.concatenate([along, along])
+    across = np.concatenate([below, below + 1])
+    weights = np.concatenate([1 - weight_above, weight_above])
+    xs, ys = (across, main) if steep else (main, across)
+
+    pixels = get_pixels(image, alpha=True)
+    height, width, channels = pixels.shape
+    inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height) & (weights > 0)
+    xs, ys, weights = xs[inside], ys[inside], weights[inside, np.newaxis]
+    if not len(xs):
+        return
+    box = (int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+    mark_changing(image, *box)
+    # (on 32-bit images the alpha is blended towards opaque the same way)
+    blended = pixels[ys, xs] * (1 - weights) + _bgr(color, channels) * weights
+    pixels[ys, xs] = np.rint(blended).astype(np.uint8)
+    mark_dirty(image, *box)
+
+
+def draw_polyline(image, points, color, smooth: bool = False) -> None:
+    """
+    Draw lines joining a list of points
+
+    :param image: BytesIO holding the BMP image
+    :param points: List of (x, y) points, in order
+    :param color: (red, green, blue) to draw it in
+    :param smooth: Draw anti-aliased lines (see draw_smooth_line)
+    :returns: None
+    """
+    if len(points) == 1:
+        draw_line(image, points[0], points[0], color)
+    for start, end in zip(points, points[1:]):
+        (draw_smooth_line if smooth else draw_line)(image, start, end, color)
+
+
+# Number of rows flood_fill looks for matching pixels in at once
+FLOOD_BAND_ROWS = 64
+
+
+def _matching_pixels(band: np.ndarray, low: np.ndarray, span: np.ndarray, channels: int = 3) -> np.ndarray:
+    """
+    Find which pixels of some rows have every channel within a range
+
+    :param band: (rows, width * channels) bytes of the pixels (see _row_bytes)
+    :param low: Lowest allowed value of every byte of a row
+    :param span: How much higher than low every byte of a row may be
+    :param channels: Bytes per pixel
+    :returns: (rows, width) bool array
+    """
+    # below low wraps around to more than span in uint8, so one comparison checks both bounds
+    inside = ((band - low) <= span).view(np.uint8)
+    inside = inside.reshape(band.shape[0], -1, channels)
+    matches = inside[:, :, 0] & inside[:, :, 1] & inside[:, :, 2]
+    if channels == 4:
+        matches &= inside[:, :, 3]
+    return matches.view(bool)
+
+
+def flood_fill(image, seed, color, tolerance: int = 0) -> None:
+    """
+    Fill the area around a pixel that has (about) the same color as it
+    (4-connected), a whole run of pixels at a time
+
+    Which pixels match is only worked out (for a band of rows at once) when
+    the fill reaches those rows, and each row's runs of matching pixels are
+    found in one go, so the cost depends on how many rows and runs the area
+    covers rather than on how many pixels it has.  Runs that still have to be
+    spread from are kept on an explicit stack, so big areas can't hit the
+    recursion limit.
+
+    :param image: BytesIO holding the BMP image
+    :param seed: (x, y) of the pixel to start from
+    :param color: (red, green, blue) to fill with
+    :param tolerance: How much each channel (alpha included) may differ from the seed pixel's and still be filled
+    :returns: None
+    """
+    pixels = get_pixels(image, alpha=True)
+    height, width, channels = pixels.shape
+    x, y = seed
+    if not (0 <= x < width and 0 <= y < height):
+        return
+    target = pixels[y, x].astype(np.int16)
+    low = np.tile(np.clip(target - tolerance, 0, 255).astype(np.uint8), width)
+    span = np.tile((np.clip(target + tolerance, 0, 255) - np.clip(target - tolerance, 0, 255)).astype(np.uint8), width)
+    rows = _row_bytes(pixels)
+    pattern = _pattern(color, width, channels)
+    bands = {}  # first row of a band -> which of its pixels match (before anything was filled)
+    runs = {}  # row -> (starts, ends, which runs are filled already)
+
+    def get_runs(row):
+        if row not in runs:
+            first_row = row - row % FLOOD_BAND_ROWS
+            if first_row not in bands:
+                bands[first_row] = _matching_pixels(rows[first_row : first_row + FLOOD_BAND_ROWS], low, span, channels)
+            matches = bands[first_row][row - first_row]
+            edges = np.flatnonzero(matches[1:] != matches[:-1]) + 1
+            edges = ([0] if matches[0] else []) + edges.tolist() + ([width] if matches[-1] else [])
+            runs[row] = (edges[0::2], edges[1::2], bytearray(len(edges) // 2))
+        return runs[row]
+
+    starts, ends, filled = get_runs(y)
+    first = bisect.bisect_right(ends, x)  # the run the seed is in
+    filled[first] = True
+    mark_changing(image, starts[first], y, ends[first], y + 1)
+    rows[y, channels * starts[first] : channels * ends[first]] = pattern[: channels * (ends[first] - starts[first])]
+    stack = [(y, starts[first], ends[first])]
+    left, bottom, right, top = starts[first], y, ends[first], y + 1
+
+    while stack:
+        row, run_start, run_end = stack.pop()
+        for next_row in (row - 1, row + 1):
+            if not 0 <= next_row < height:
+                continue
+            starts, ends, filled = get_runs(next_row)
+            # the runs of the next row that touch this one
+            for i in range(bisect.bisect_right(ends, run_start), bisect.bisect_left(starts, run_end)):
+                if filled[i]:
+                    continue
+                filled[i] = True
+                start, end = starts[i], ends[i]
+                mark_changing(image, start, next_row, end, next_row + 1)
+                rows[next_row, channels * start : channels * end] = pattern[: channels * (end - start)]
+                stack.append((next_row, start, end))
+                left, right = min(left, start), max(right, end)
+                bottom, top = min(bottom, next_row), max(top, next_row + 1)
+
+    mark_dirty(image, left, bottom, right, top)
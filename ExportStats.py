@@ -0,0 +1,202 @@
+"""PythoShop Export Stats
+
+Optional statistics about the exported filters and tools: how often each
+one is called, how long it takes, on how big images and how many bytes it
+reads and writes through the image's file interface.
+
+Off by default (it costs a little per call); turn it on with
+`enable_stats()` or by setting the PYTHOSHOP_STATS environment variable.
+If PYTHOSHOP_STATS is a file name (e.g. stats.json, or stats.prof for the
+pstats format) the stats are written there when the program exits.
+Only calls made in this process are counted, not the strips a filter runs
+on in other processes (see StripExecutor).
+"""
+
+import atexit
+import json
+import marshal
+import multiprocessing
+import os
+import threading
+import time
+import typing
+
+from BmpImage import get_header
+
+_enabled = bool(os.environ.get("PYTHOSHOP_STATS"))
+_lock = threading.Lock()
+_stats: dict = {}  # function name -> FunctionStats
+_running = threading.local()  # stack of [child seconds] for the calls running in each thread
+
+
+class CountingImage:
+    """
+    Stands in for an image buffer, counting the bytes read and written
+    through it; everything else is handed to the real image.
+
+    Pixels accessed through getbuffer() (e.g. numpy views) can't be counted
+    byte by byte, only how many times the buffer was asked for.
+    """
+
+    def __init__(self, image) -> None:
+        object.__setattr__(self, "_image", image)
+        object.__setattr__(self, "bytes_read", 0)
+        object.__setattr__(self, "bytes_written", 0)
+        object.__setattr__(self, "buffer_requests", 0)
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._image.read(size)
+        object.__setattr__(self, "bytes_read", self.bytes_read + len(data))
+        return data
+
+    def write(self, data) -> int:
+        written = self._image.write(data)
+        object.__setattr__(self, "bytes_written", self.bytes_written + written)
+        return written
+
+    def getbuffer(self) -> memoryview:
+        object.__setattr__(self, "buffer_requests", self.buffer_requests + 1)
+        return self._image.getbuffer()
+
+    def __getattr__(self, name: str) -> typing.Any:
+        return getattr(self._image, name)
+
+    def __setattr__(self, name: str, value: typing.Any) -> None:
+        setattr(self._image, name, value)  # e.g. the header cache belongs to the image
+
+
+class FunctionStats:
+    """What has been recorded about one exported function"""
+
+    def __init__(self, func) -> None:
+        code = getattr(func, "__code__", None)
+        self.file_name = code.co_filename if code else "~"
+        self.line = code.co_firstlineno if code else 0
+        self.calls = 0
+        self.errors = 0
+        self.wall_seconds = 0.0  # including the exported functions it called
+        self.own_seconds = 0.0  # not including them
+        self.cpu_seconds = 0.0
+        self.pixels = 0
+        self.largest = (0, 0)  # (width, height) of the largest image it was called on
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.buffer_requests = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "wall_seconds": self.wall_seconds,
+            "own_seconds": self.own_seconds,
+            "cpu_seconds": self.cpu_seconds,
+            "pixels": self.pixels,
+            "largest": list(self.largest),
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "buffer_requests": self.buffer_requests,
+            "mp_per_s": self.pixels / 1e6 / self.wall_seconds if self.wall_seconds else None,
+        }
+
+
+def enable_stats(enabled: bool = True) -> None:
+    global _enabled
+    _enabled = enabled
+
+
+def stats_enabled() -> bool:
+    return _enabled
+
+
+def reset_stats() -> None:
+    with _lock:
+        _stats.clear()
+
+
+def get_stats() -> dict:
+    """
+    :returns: Dictionary of function name -> dictionary of what was recorded about it (see FunctionStats.as_dict)
+    """
+    with _lock:
+        return {name: stats.as_dict() for name, stats in sorted(_stats.items())}
+
+
+def call_with_stats(func, run, image, *args, **kwargs):
+    """
+    Run an exported function on a counting proxy of the image and record
+    what it did
+
+    :param func: The function being exported (the stats are recorded under its name)
+    :param run: What to call for it (e.g. the decorator's own implementation)
+    :param image: Image buffer it is called on
+    :returns: Whatever run returns
+    """
+    counting = CountingImage(image)
+    try:
+        header = get_header(image)
+        size = (header.width, header.height)
+    except Exception:
+        size = (0, 0)  # not an image we understand, the function will complain about it itself
+
+    stack = getattr(_running, "stack", None)
+    if stack is None:
+        stack = _running.stack = []
+    stack.append(0.0)
+    failed = True
+    start_wall, start_cpu = time.perf_counter(), time.thread_time()
+    try:
+        result = run(counting, *args, **kwargs)
+        failed = False
+    finally:
+        wall = time.perf_counter() - start_wall
+        cpu = time.thread_time() - start_cpu
+        children = stack.pop()
+        if stack:
+            stack[-1] += wall
+        with _lock:
+            stats = _stats.get(func.__name__)
+            if stats is None:
+                stats = _stats[func.__name__] = FunctionStats(func)
+            stats.calls += 1
+            stats.errors += failed
+            stats.wall_seconds += wall
+            stats.own_seconds += wall - children
+            stats.cpu_seconds += cpu
+            stats.pixels += size[0] * size[1]
+            stats.largest = max(stats.largest, size, key=lambda dimensions: dimensions[0] * dimensions[1])
+            stats.bytes_read += counting.bytes_read
+            stats.bytes_written += counting.bytes_written
+            stats.buffer_requests += counting.buffer_requests
+    return image if result is counting else result
+
+
+def dump_stats(file_name: str, format: str = "json") -> None:
+    """
+    Write the recorded stats to a file
+
+    :param file_name: Path of the file to write
+    :param format: "json", or "pstats" for a file that pstats.Stats (or snakeviz...) can load like a cProfile dump
+    :returns: None
+    """
+    if format == "json":
+        with open(file_name, "w") as file:
+            json.dump(get_stats(), file, indent=2)
+    elif format == "pstats":
+        with _lock:
+            # pstats wants {(file, line, name): (primitive calls, calls, own time, cumulative time, callers)}
+            profile = {
+                (stats.file_name, stats.line, name): (stats.calls, stats.calls, stats.own_seconds, stats.wall_seconds, {})
+                for name, stats in _stats.items()
+            }
+        with open(file_name, "wb") as file:
+            marshal.dump(profile, file)
+    else:
+        raise ValueError("unknown stats format: " + str(format))
+
+
+def _dump_at_exit(file_name: str) -> None:
+    dump_stats(file_name, "pstats" if os.path.splitext(file_name)[1] in (".prof", ".pstats") else "json")
+
+
+if _enabled and os.environ["PYTHOSHOP_STATS"] != "1" and multiprocessing.parent_process() is None:
+    atexit.register(_dump_at_exit, os.environ["PYTHOSHOP_STATS"])
@@ -0,0 +1,78 @@
+"""PythoShop Filter Job
+
+Runs a filter in a background thread so the window stays responsive,
+with progress reports and a way to cancel it.
+"""
+
+import threading
+import typing
+
+from BmpImage import copy_bmp, release_bmp
+from StripExecutor import FilterCancelled, run_in_strips
+
+
+class FilterJob:
+    """
+    A filter running on a copy of an image in a background thread
+
+    The filter never touches the image itself: it works on a copy (a pooled
+    one where it can, see BmpImage.copy_bmp), which becomes the result once
+    the filter is done, so cancelling a job (or the filter failing) leaves
+    the image exactly as it was.
+    """
+
+    def __init__(
+        self,
+        func: typing.Callable,
+        image,
+        on_done: typing.Callable[["FilterJob"], None],
+        on_progress: typing.Optional[typing.Callable[[int, int], None]] = None,
+        **kwargs,
+    ) -> None:
+        """
+        :param func: Exported filter (or FilterPipeline) to run
+        :param image: Image buffer to run it on
+        :param on_done: Called with the job (from the background thread) once it has finished, failed or been cancelled
+        :param on_progress: Called with (rows done, total rows) (from the background thread) as the filter progresses
+        :param kwargs: Parameters for the filter (color, extra, other_image...)
+        """
+        self.func = func
+        self.image = image
+        self.kwargs = kwargs
+        self.on_done = on_done
+        self.on_progress = on_progress
+        self.result = None  # the filtered image, once done
+        self.error: typing.Optional[BaseException] = None
+        self._cancel = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="PythoShop " + func.__name__, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def cancel(self) -> None:
+        """Stop the filter as soon as possible (and throw away what it did)"""
+        self._cancel.set()
+
+    def discard(self) -> None:
+        """Throw away the result (e.g. of a job cancelled too late to stop it), giving its buffer back for reuse"""
+        if self.result is not None and self.result is not self.image:
+            release_bmp(self.result)
+        self.result = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def _run(self) -> None:
+        working = None
+        try:
+            working = copy_bmp(self.image)
+            result = run_in_strips(self.func, working, progress=self.on_progress, cancel=self._cancel, **self.kwargs)
+            if self._cancel.is_set():
+                raise FilterCancelled(self.func.__name__ + " was cancelled")
+            self.result = working if result is None else result
+        except BaseException as error:
+            self.error = error
+        if working is not None and working is not self.result:
+            release_bmp(working)  # (so the next filter can use it)
+        self.on_done(self)
@@ -0,0 +1,69 @@
+"""PythoShop Filter Pipeline
+
+Runs several exported filters one after the other as if they were a
+single filter, fusing neighbouring point and channel swapping filters
+into one pass over the pixels.
+"""
+
+from BmpImage import apply_lut, compose_color_maps, release_bmp
+from PythoShopExports import get_color_map
+
+
+class FilterPipeline:
+    """
+    A list of exported filters (each with its own parameters) that behaves
+    like one filter: it can be handed to `run_manip_function` so the image is
+    only validated and redisplayed once, after the last filter.
+
+    Runs of consecutive point_op / channel_op filters are combined into a
+    single color map, so e.g. negate -> swap_rgb -> lighten costs one pass.
+    """
+
+    def __init__(self, steps) -> None:
+        """
+        :param steps: List of exported filters, or of (filter, params) tuples
+            where params is a dict of keyword arguments (e.g. color, extra)
+            that override the ones the pipeline is called with
+        """
+        self.steps = []
+        for step in steps:
+            func, params = step if isinstance(step, tuple) else (step, {})
+            if getattr(func, "__type__", None) != "filter":
+                raise ValueError(str(func) + " is not an exported filter")
+            self.steps.append((func, dict(params)))
+        self.__name__ = " -> ".join(func.__name__ for func, params in self.steps)
+        # strip safe when every filter in it is (see StripExecutor)
+        self.__strip_safe__ = all(func.__strip_safe__ and "other_image" not in params for func, params in self.steps)
+
+    def __call__(self, image, **kwargs):
+        """
+        Run every filter on the image
+
+        :param image: BytesIO holding the BMP image
+        :param kwargs: Parameters passed to every filter (color, extra, other_image...)
+        :returns: The final image if one of the filters returned a new image, otherwise None
+        """
+        current = image
+        pending = None  # color map of the filters fused so far but not yet applied
+
+        for func, params in self.steps:
+            step_kwargs = {**kwargs, **params}
+            color_map = get_color_map(func, **step_kwargs)
+            if color_map is not None:
+                pending = color_map if pending is None else compose_color_maps(pending, color_map)
+                continue
+
+            if pending is not None:
+                apply_lut(current, pending[1], pending[0])
+                pending = None
+            current.seek(0)
+            result = func(current, **step_kwargs)
+            if result is not None:
+                if current is not image and result is not current:
+                    release_bmp(current)  # an earlier filter's result that nothing else has seen
+                current = result
+
+        if pending is not None:
+            apply_lut(current, pending[1], pending[0])
+        current.seek(0)
+        return None if current is image else current
@@ -1,46 +1,44 @@
-import io
-import math
+import functools
+import re
 from PythoShopExports import *
-import random
+
+import numpy as np
+
+import Compositing
+import Drawing
+from BmpImage import apply_lut, create_bmp, get_alpha, get_header, get_pixels, has_alpha, mark_changing, mark_dirty, take_bmp
+from ImageStats import get_image_stats
 
 def get_info(image):
+    # the header is only parsed once and then cached on the image (see BmpImage.get_header)
+    # (rows of 32-bit images are always a multiple of 4 bytes, so their padding is 0)
+    header = get_header(image)
+    return header.fpp, header.width, header.height, header.padding, header.row_size
+
 
-    image.seek(22)
-    height = int.from_bytes(image.read(4), 'little')
-    image.seek(18)
-    width = int.from_bytes(image.read(4), 'little')
-    image.seek(10)
-    fpp = int.from_bytes(image.read(4), 'little')
-    row_size = width * 3
-    padding = 0
-    if (row_size) % 4 != 0: # not evenly divisible by 4
-        padding = 4 - (row_size) % 4
-        row_size = row_size + padding 
-    # your code: to get the fpp, width, etc. from the image
-    return fpp, width, height, padding, row_size
+# Tools change the image in place, and to be undoable they MUST call
+# mark_changing(image, left, bottom, right, top) before changing any pixels
+# (and mark_dirty with the same rectangle afterwards).  Pixels changed without
+# mark_changing can't be undone (PythoShop warns about it).  The Drawing
+# functions do both for you.
 
 
 @export_filter
 def draw_centered_hline(image, color, **kwargs):
-    image.seek(22)
-    height = int.from_bytes(image.read(4), 'little')
+    fpp, width, height, padding, row_size = get_info(image)
 
     draw_hline(image, (0, height // 2), color, **kwargs)
     
 @export_filter
 def draw_centered_vline(image, color, **kwargs):
-    image.seek(18)
-    width = int.from_bytes(image.read(4), 'little')
+    fpp, width, height, padding, row_size = get_info(image)
 
     draw_vline(image, (width // 2, 0), color, **kwargs)
 
 @export_filter
 def mark_middle(image, color, extra, **kwargs):
 
-    image.seek(18)
-    width = int.from_bytes(image.read(4), 'little')
-    image.seek(22)
-    height = int.from_bytes(image.read(4), 'little')
+    fpp, width, height, padding, row_size = get_info(image)
 
     x_middle = width // 2
     y_middle = height // 2
@@ -59,766 +57,501 @@ def draw_vline(image, clicked_coordinate, color, extra, **kwargs):
 
     x, y = clicked_coordinate
     fpp, width, height, padding, row_size = get_info(image)
-  
-
-    bgr = bytes([color[2], color[1], color[0]])  # [B, G, R]
-    # Makes the correct row_size
-    row_size = width*3 + padding
-
-    # Go to the x value
-    image.seek(fpp + x * 3)
-    image.write(bgr)
-    for row in range(height):
-        image.seek(row_size - 3, 1)
-        image.write(bgr)
+    Drawing.fill_rect(image, x, 0, x + 1, height, color)
 
 
 @export_tool
 def draw_hline(image, clicked_coordinate, color, **kwargs):
-    fpp, width, height, padding, row_size = get_info(image)
-    # Gets all the necessary information
     x, y = clicked_coordinate
-    bgr = bytes([color[2], color[1], color[0]])  # [B, G, R]
-
-    #row_of_pixels = "FF00FF" * width
-    image.seek(fpp + (row_size) * y)
-    for col in range(width):
-        image.write(bgr)
+    fpp, width, height, padding, row_size = get_info(image)
+    Drawing.fill_rect(image, 0, y, width, y + 1, color)
 
-@export_tool
+@export_tool(interpolate=True)
 def change_pixel(image, clicked_coordinate, color, **kwargs):
     x, y = clicked_coordinate
+    Drawing.fill_rect(image, x, y, x + 1, y + 1, color)
 
+@export_filter(pixel_op=True)
+def fill(image, color, **kwargs):
     fpp, width, height, padding, row_size = get_info(image)
+    Drawing.fill_rect(image, 0, 0, width, height, color)
 
-    bgr = bytes([color[2], color[1], color[0]])  # [B, G, R]
-    image.seek(fpp + (width * 3 + padding)* y + 3 * x)
-    image.write(bgr)
+def _get_points(extra):
+    # every pair of whole numbers in extra is a point, e.g. "10,20 30,40"
+    numbers = [int(number) for number in re.findall(r"-?\d+", extra)]
+    return list(zip(numbers[0::2], numbers[1::2]))
 
-@export_filter
-def fill(image, color, **kwargs):
-    fpp, width, height, padding, row_size = get_info(image)
-    # your code: call get_info to get the information we need
-    # your code: go to the first pixel (the start of the first row)
-    image.seek(fpp)
-    bgr = bytes([color[2], color[1], color[0]])  # [B, G, R]
+def _get_radius(extra):
+    # the first whole number in extra (10 if there isn't one)
+    numbers = re.findall(r"-?\d+", extra)
+    return int(numbers[0]) if numbers else 10
 
-    for row in range(height):  # goes through every row in the image
-        # At this point we assume we're at the start of the CURRENT row
-        for pixel in range(width):  # goes through every pixel WITHIN the current row
-            # your code: write one red pixel
-            image.write(bgr)
-            # After writing these three bytes the cursor will have moved on to the next pixel
-        # your code: skip past the padding bytes so that when the loop repeats we'll be at the beginning of the next row
-        image.seek(padding, 1)
+@export_tool
+def draw_line(image, clicked_coordinate, color, extra, **kwargs):
+    # from where was clicked to the point in extra (e.g. "10,20")
+    points = _get_points(extra)
+    end = points[0] if points else clicked_coordinate
+    Drawing.draw_line(image, clicked_coordinate, end, color)
 
+@export_tool
+def draw_smooth_line(image, clicked_coordinate, color, extra, **kwargs):
+    points = _get_points(extra)
+    end = points[0] if points else clicked_coordinate
+    Drawing.draw_smooth_line(image, clicked_coordinate, end, color)
 
+@export_tool
+def draw_polyline(image, clicked_coordinate, color, extra, **kwargs):
+    # from where was clicked through all the points in extra (e.g. "10,20 30,40 50,20")
+    Drawing.draw_polyline(image, [clicked_coordinate] + _get_points(extra), color)
 
-@export_filter
-def make_static(image, extra, color, **kwargs):
-    
-    try:
-        max_distance = int(extra)
-        
-    except ValueError:
-        max_distance = 255
+@export_tool
+def draw_rectangle(image, clicked_coordinate, color, extra, **kwargs):
+    # between where was clicked and the opposite corner in extra (e.g. "10,20")
+    points = _get_points(extra)
+    corner = points[0] if points else clicked_coordinate
+    Drawing.draw_rect(image, clicked_coordinate, corner, color)
 
-    blue = color[2]
-    green = color[1]
-    red = color[0]
+@export_tool
+def fill_rectangle(image, clicked_coordinate, color, extra, **kwargs):
+    points = _get_points(extra)
+    corner = points[0] if points else clicked_coordinate
+    left, right = sorted((clicked_coordinate[0], corner[0]))
+    bottom, top = sorted((clicked_coordinate[1], corner[1]))
+    Drawing.fill_rect(image, left, bottom, right + 1, top + 1, color)
 
-    fpp, width, height, padding, row_size = get_info(image)
-    image.seek(fpp)
+@export_tool
+def draw_circle(image, clicked_coordinate, color, extra, **kwargs):
+    # around where was clicked, with the radius in extra
+    Drawing.draw_circle(image, clicked_coordinate, _get_radius(extra), color)
 
+@export_tool
+def fill_circle(image, clicked_coordinate, color, extra, **kwargs):
+    Drawing.fill_circle(image, clicked_coordinate, _get_radius(extra), color)
+
+@export_tool
+def bucket_fill(image, clicked_coordinate, color, extra, **kwargs):
+    # fills everything around where was clicked that is (about) the same color;
+    # extra is how much each channel may differ and still be filled (0 if not given)
+    try:
+        tolerance = int(extra)
+    except ValueError:
+        tolerance = 0
+    Drawing.flood_fill(image, clicked_coordinate, color, tolerance)
 
-    for row in range(height):
-        for pixel in range(width):
-            # Make the random blue
-
-            max_blue = 0
-            low_blue = 0
-
-            if (blue + max_distance > 255):
-                max_blue = 255
-            else:
-                max_blue = blue + max_distance
-            
-            if (blue - max_distance < 0):
-                low_blue = 0
-            else:
-                low_blue = blue - max_distance
-
-            max_red = 0
-            low_red = 0
-
-            if (red + max_distance > 255):
-                max_red = 255
-            else:
-                max_red = red + max_distance
-            
-            if (red - max_distance < 0):
-                low_red = 0
-            else:
-                low_red = red - max_distance
-
-            max_green = 0
-            low_green = 0
-
-            if (green + max_distance > 255):
-                max_green = 255
-            else:
-                max_green = green + max_distance
-            
-            if (green - max_distance < 0):
-                low_green = 0
-            else:
-                low_green = green - max_distance
-
-            actual_blue = random.randint(low_blue, max_blue)
-            actual_green = random.randint(low_green, max_green)
-            actual_red = random.randint(low_red, max_red)
-
-            image.write(bytes([actual_blue, actual_green, actual_red]))
-        image.seek(padding, 1)
 
 
 @export_filter
+def make_static(image, extra, color, **kwargs):
+    # extra can hold (in any order) how strong the static is, a mode and a seed, e.g. "40", "gaussian 20 seed=7" or "salt 5"
+    #   uniform (default): every channel is random within that distance of the color (255 if not given)
+    #   gaussian: the color plus normal noise with that standard deviation (32 if not given)
+    #   salt: the color, with that percentage of the pixels turned black or white (5 if not given)
+    mode = "uniform"
+    amount = None
+    seed = None
+    for word in extra.replace(",", " ").split():
+        if word.startswith("seed="):
+            try:
+                seed = int(word[5:])
+            except ValueError:
+                pass
+        elif word in ("uniform", "gaussian", "salt"):
+            mode = word
+        else:
+            try:
+                amount = int(word)
+            except ValueError:
+                pass
+
+    rng = np.random.default_rng(seed)
+    bgr = np.array([color[2], color[1], color[0]])
+    pixels = get_pixels(image)
+    height, width = pixels.shape[:2]
+    rows_at_once = max(1, (1 << 20) // max(1, width))  # bounds the temporary arrays
+
+    if mode == "uniform":
+        max_distance = 255 if amount is None else amount
+        # the bounds are the same for every pixel, so only work them out once
+        low = np.clip(bgr - max_distance, 0, 255)
+        high = np.clip(bgr + max_distance, 0, 255)
+        for row in range(0, height, rows_at_once):
+            band = pixels[row : row + rows_at_once]
+            band[:] = rng.integers(low, high, size=band.shape, dtype=np.uint8, endpoint=True)
+    elif mode == "gaussian":
+        deviation = 32 if amount is None else amount
+        for row in range(0, height, rows_at_once):
+            band = pixels[row : row + rows_at_once]
+            noise = rng.standard_normal(band.shape, dtype=np.float32) * deviation + bgr
+            band[:] = np.clip(np.rint(noise), 0, 255)
+    else:
+        percentage = 5 if amount is None else amount
+        for row in range(0, height, rows_at_once):
+            band = pixels[row : row + rows_at_once]
+            band[:] = bgr
+            hit = rng.random(band.shape[:2], dtype=np.float32) < percentage / 100
+            white = rng.random(band.shape[:2], dtype=np.float32) < 0.5
+            band[hit & white] = 255
+            band[hit & ~white] = 0
+
+
+@export_filter(point_op=True)
 def remove_red(image, color, extra, **kwargs):
+    pixels = get_pixels(image)
+    pixels[:, :, 2] = 0
 
-    fpp, width, height, padding, row_size = get_info(image)
-    image.seek(fpp)
-    for row in range(height):
-        for pixel in range(width):
-            image.seek(2, 1)
-            image.write(bytes([0]))
-        image.seek(padding, 1)
-@export_filter
+@export_filter(point_op=True)
 def remove_green(image, color, extra, **kwargs):
-    fpp, width, height, padding, row_size = get_info(image)
-    image.seek(fpp)
+    pixels = get_pixels(image)
+    pixels[:, :, 1] = 0
 
-    for row in range(height):
-        for pixel in range(width):
-            image.seek(1, 1)
-            image.write(bytes([0]))
-            image.seek(1, 1)
-        image.seek(padding, 1)
 
-
-@export_filter
+@export_filter(point_op=True)
 def remove_blue(image, color, extra, **kwargs):
-    fpp, width, height, padding, row_size = get_info(image)
-    image.seek(fpp)
-
-    for row in range(height):
-        for pixel in range(width):
-            image.write(bytes([0]))
-            image.seek(2, 1)
-        image.seek(padding, 1)
+    pixels = get_pixels(image)
+    pixels[:, :, 0] = 0
 
-@export_filter
+@export_filter(point_op=True)
 def max_red(image, color, extra, **kwargs):
-    fpp, width, height, padding, row_size = get_info(image)
-    image.seek(fpp)
-    for row in range(height):
-        for pixel in range(width):
-            image.seek(2, 1)
-            image.write(bytes([255]))
-        image.seek(padding, 1)
-@export_filter
-def max_green(image, color, extra, **kwargs):
-    fpp, width, height, padding, row_size = get_info(image)
-    image.seek(fpp)
+    pixels = get_pixels(image)
+    pixels[:, :, 2] = 255
 
-    for row in range(height):
-        for pixel in range(width):
-            image.seek(1, 1)
-            image.write(bytes([255]))
-            image.seek(1, 1)
-        image.seek(padding, 1)
+@export_filter(point_op=True)
+def max_green(image, color, extra, **kwargs):
+    pixels = get_pixels(image)
+    pixels[:, :, 1] = 255
 
 
-@export_filter
+@export_filter(point_op=True)
 def max_blue(image, color, extra, **kwargs):
-    fpp, width, height, padding, row_size = get_info(image)
-    image.seek(fpp)
+    pixels = get_pixels(image)
+    pixels[:, :, 0] = 255
 
-    for row in range(height):
-        for pixel in range(width):
-            image.write(bytes([255]))
-            image.seek(2, 1)
-        image.seek(padding, 1)
 
-
-@export_filter
+@export_filter(point_op=True)
 def negate_red(image, **kwargs):
-    fpp, width, height, padding, row_size = get_info(image)
-
-    image.seek(fpp)
-    for row in range(height):
-        for pixel in range(width):
-            blue, green, red = image.read(3)
-            r1 = 255 - red
-            image.seek(-3, 1)
-            image.write(bytes([blue, green, r1]))
-        image.seek(padding, 1)
-        
-@export_filter
+    pixels = get_pixels(image)
+    np.subtract(255, pixels[:, :, 2], out=pixels[:, :, 2])
+
+@functools.lru_cache(maxsize=64)
+def _disc_mask(radius):
+    # (2 * radius + 1) square of which pixels are within radius of the middle one
+    # (same test as math.sqrt(dx ** 2 + dy ** 2) <= radius, without the square root)
+    offsets = np.arange(-radius, radius + 1)
+    mask = offsets[np.newaxis, :] ** 2 + offsets[:, np.newaxis] ** 2 <= radius * radius
+    mask.flags.writeable = False  # shared by every call with this radius
+    return mask
+
+@export_tool(interpolate=True)
 def draw_gray(image, clicked_coordinate,color, extra, **kwargs):
-   fpp, width, height, padding, row_size = get_info(image)
    try:
        radius = int(extra)
    except:
        radius = 1
+   if radius < 0:
+       return
    x, y = clicked_coordinate
-   image.seek(fpp)
-   
-   for row in range(height):
-       for pixel in range(width):
-           blue, green, red = image.read(3)
-           image.seek(-3, 1)
-           lumen = blue + green + red
-           average = int(lumen/3)
-           distance = math.sqrt((x - pixel) ** 2 + (y - row) ** 2)
+   pixels = get_pixels(image)
+   height, width = pixels.shape[:2]
 
-           if distance <= radius:
-               image.write(bytes([average, average, average]))
-           else:
-               image.seek(3, 1)
-       image.seek(padding, 1)
+   # only the part of the image around the disc can change
+   left, bottom = max(0, x - radius), max(0, y - radius)
+   right, top = min(width, x + radius + 1), min(height, y + radius + 1)
+   if left >= right or bottom >= top:
+       return
+   inside = _disc_mask(radius)[bottom - (y - radius) : top - (y - radius), left - (x - radius) : right - (x - radius)]
+   box = pixels[bottom:top, left:right]
+   mark_changing(image, left, bottom, right, top)  # (so it can be undone)
 
+   average = box[inside].sum(axis=1, dtype=np.uint16) // 3
+   box[inside] = average[:, np.newaxis]
+   mark_dirty(image, left, bottom, right, top)
 
 
 
-@export_filter
-def negate_green(image, **kwargs):
-    fpp, width, height, padding, row_size = get_info(image)
 
-    image.seek(fpp)
-    for row in range(height):
-        for pixel in range(width):
-            blue, green, red = image.read(3)
-            g1 = 255 - green
-            image.seek(-3, 1)
-            image.write(bytes([blue, g1, red]))
-        image.seek(padding, 1)
+@export_filter(point_op=True)
+def negate_green(image, **kwargs):
+    pixels = get_pixels(image)
+    np.subtract(255, pixels[:, :, 1], out=pixels[:, :, 1])
 
-@export_filter
+@export_filter(point_op=True)
 def negate_blue(image, **kwargs):
-    fpp, width, height, padding, row_size = get_info(image)
+    pixels = get_pixels(image)
+    np.subtract(255, pixels[:, :, 0], out=pixels[:, :, 0])
 
-    image.seek(fpp)
-    for row in range(height):
-        for pixel in range(width):
-            blue, green, red = image.read(3)
-            b1 = 255 - blue
-            
-            image.seek(-3, 1)
-            image.write(bytes([b1, green, red]))
-        image.seek(padding, 1)
-
-@export_filter
+@export_filter(point_op=True)
 def lighten(image, **kwargs):
+    pixels = get_pixels(image)
+    # int(value * 1.5) capped at 255
+    pixels[:] = np.minimum(pixels * np.uint16(3) // 2, 255)
 
 
-    fpp, width, height, padding, row_size = get_info(image)
-
-    image.seek(fpp)
-
-    for row in range(height):
-        for pixel in range(width):
-            blue, green, red = image.read(3)
-
-            b1 = int(blue * 1.5)
-            g1 = int(green * 1.5)
-            r1 = int(red * 1.5)
-            if (b1 > 255):
-                b1 = 255
-            if (g1 > 255):
-                g1 = 255
-            if (r1 > 255):
-                r1 = 255
-
-            image.seek(-3, 1)
-            image.write(bytes([b1, g1, r1]))
-        image.seek(padding, 1)
-
 
 
 
 
-
-@export_filter
+@export_filter(pixel_op=True)
 def make_gray(image, **kwargs):
-    fpp, width, height, padding, row_size = get_info(image)
-
-    image.seek(fpp)
-
-    for row in range(height):
-        for pixel in range(width):
-                blue, green, red = image.read(3)
-                average = round((blue + green + red) / 3)
-                image.seek(-3, 1)
-                image.write(bytes([average, average, average]))
-        image.seek(padding, 1)
+    pixels = get_pixels(image)
+    # round(brightness / 3) never lands on a .5 so this is the same as rounding to nearest
+    average = (pixels.sum(axis=2, dtype=np.uint16) + 1) // 3
+    pixels[:] = average[:, :, np.newaxis]
 
 
-@export_filter
+@export_filter(point_op=True)
 def darken(image, **kwargs):
-    fpp, width, height, padding, row_size = get_info(image)
+    pixels = get_pixels(image)
+    pixels //= 2
 
-    image.seek(fpp)
-
-    for row in range(height):
-        for pixel in range(width):
-            blue, green, red = image.read(3)
 
-            b1 = int(blue * 0.5)
-            g1 = int(green * 0.5)
-            r1 = int(red * 0.5)
-            
-            image.seek(-3, 1)
-            image.write(bytes([b1, g1, r1]))
-        image.seek(padding, 1)
 
 
-
-
-@export_filter
+@export_filter(point_op=True)
 def negate(image, **kwargs):
-    fpp, width, height, padding, row_size = get_info(image)
+    pixels = get_pixels(image)
+    np.subtract(255, pixels, out=pixels)
 
-    image.seek(fpp)
-    for row in range(height):
-        for pixel in range(width):
-            blue, green, red = image.read(3)
-            b1 = 255 - blue
-            g1 = 255 - green
-            r1 = 255 - red
-            image.seek(-3, 1)
-            image.write(bytes([b1, g1, r1]))
-        image.seek(padding, 1)
 
 
 
 
 
 
-
-@export_filter
+@export_filter(point_op=True)
 def intensify(image, color, extra, **kwargs):
-    fpp, width, height, padding, row_size = get_info(image)
-    image.seek(fpp)
-    for row in range(height):
-        for pixel in range(width):
-            blue, green, red = image.read(3)
-            if blue > 127.5:
-                blue = 255
-            else:
-                blue = 0
-            if green > 127.5:
-                green = 255
-            else:
-                green = 0
-            if red > 127.5:
-                red = 255
-            else:
-                red = 0
-            image.seek(-3, 1)  # go back 3 bytes
-            image.write(bytes([blue, green, red]))  # write all three at once
-        image.seek(padding, 1)
+    pixels = get_pixels(image)
+    pixels[:] = np.where(pixels > 127.5, 255, 0)
 
-@export_filter
+@export_filter(pixel_op=True)
 def make_two_tone(image, color, extra, **kwargs):
-    fpp, width, height, padding, row_size = get_info(image)
-    image.seek(fpp)
-    for row in range(height):
-        for pixel in range(width):
-            blue, green, red = image.read(3)
-            image.seek(-3, 1)  # go back 3 bytes
-            if blue + green + red > 382.5:
-                blue = 255
-                green = 255
-                red = 255
-            else:
-                blue = 0
-                green = 0
-                red = 0
-            image.write(bytes([blue, green, red]))  # write all three at once
-        image.seek(padding, 1)
+    pixels = get_pixels(image)
+    brightness = pixels.sum(axis=2, dtype=np.uint16)
+    pixels[:] = np.where(brightness > 382.5, 255, 0)[:, :, np.newaxis]
 
-@export_filter
+@export_filter(pixel_op=True)
 def make_four_tone(image, **kwargs):
-    fpp, w, h, padding, row_size = get_info(image)
-    image.seek(fpp)
-    for row in range(h):
-        for pixel in range(w):
-            blue, green, red = image.read(3)
-            brightness = blue + green + red
-            if brightness > 573.75:
-                new_color = 255
-            elif brightness > 382.5:
-                new_color = 170
-            elif brightness > 191.25:
-                new_color = 85
-            else:
-                new_color = 0
-            image.seek(-3, 1)
-            image.write(bytes([new_color, new_color, new_color]))
-        image.seek(padding, 1)
+    pixels = get_pixels(image)
+    brightness = pixels.sum(axis=2, dtype=np.uint16)
+    new_color = np.select([brightness > 573.75, brightness > 382.5, brightness > 191.25], [255, 170, 85], 0)
+    pixels[:] = new_color[:, :, np.newaxis]
 
 @export_filter
 def make_better_two_tone(image, **kwargs):
-    
-    fpp, w, h, padding, row_size = get_info(image)
-    image.seek(fpp)
-    tb = 0
-    for row in range(h):
-        for pixel in range(w):
-            b,g,r = image.read(3)
-            cb = b+g+r
-            tb += cb
-        image.seek(padding, 1)
-    avg = tb/(w*h)
+    # the total brightness comes from the (cached) histograms, so only the thresholding goes over the pixels
+    stats = get_image_stats(image)
+    tb = sum(stats.sums)
+    avg = tb/stats.pixel_count
     avg = int(avg)
-    image.seek(fpp)
-    for row in range(h):
-        for pixel in range(w):
-            blue, green, red = image.read(3)
-
-            image.seek(-3, 1)
-            if (blue + green + red > avg):
-                blue = 255
-                green = 255
-                red = 255
-            else:
-                blue = 0
-                green = 0
-                red = 0
-
-            image.write(bytes([blue, green, red]))
-        image.seek(padding, 1)
-
-def create_bmp(width, height):
-    row_size = width * 3
-    row_padding = 0
-    if row_size % 4 != 0:
-        row_padding = 4 - row_size % 4
-        row_size += row_padding
-    bmp = io.BytesIO(b'\x42\x4D'+(138 + row_size * height).to_bytes(4, byteorder="little"))
-    bmp.seek(10)
-    bmp.write((138).to_bytes(4, byteorder="little"))  # starting pixel
-    bmp.write((124).to_bytes(4, byteorder="little"))  # header size (for version 5)
-    bmp.write(width.to_bytes(4, byteorder="little"))
-    bmp.write(height.to_bytes(4, byteorder="little"))
-    bmp.write((1).to_bytes(2, byteorder="little"))  # color planes must be 1
-    bmp.write((24).to_bytes(2, byteorder="little"))  # bits per pixel
-    bmp.write((0).to_bytes(4, byteorder="little"))  # compression (none)
-    bmp.seek(138)
-    bmp.write(bytes(([0, 0, 0]) * width + [0] * row_padding) * height)
-    bmp.seek(0)
-    return bmp
+    pixels = get_pixels(image)
+    brightness = pixels.sum(axis=2, dtype=np.uint16)
+    pixels[:] = np.where(brightness > avg, 255, 0)[:, :, np.newaxis]
+
+@export_filter
+def auto_levels(image, **kwargs):
+    # stretch every channel so that its darkest value becomes 0 and its brightest 255
+    stats = get_image_stats(image)
+    values = np.arange(256)
+    lut = np.empty((3, 256), dtype=np.uint8)
+    for c in range(3):  # red, green, blue
+        low, high = stats.min[c], stats.max[c]
+        lut[c] = np.clip(np.rint((values - low) * 255 / max(1, high - low)), 0, 255)
+    apply_lut(image, lut[::-1])  # the pixels are stored blue, green, red
+
+def _get_position(words, pixels, other_pixels):
+    # where to put the other image on this one: lined up by an alignment word (e.g. "top-left",
+    # "center" if there isn't one) and then moved by "x=N" and/or "y=N" pixels
+    align = "center"
+    offset = [0, 0]
+    for word in words:
+        if word in Compositing.ALIGNMENTS:
+            align = word
+        elif word[:2] in ("x=", "y="):
+            try:
+                offset["xy".index(word[0])] = int(word[2:])
+            except ValueError:
+                pass
+    size = (pixels.shape[1], pixels.shape[0])
+    other_size = (other_pixels.shape[1], other_pixels.shape[0])
+    return Compositing.get_position(size, other_size, align, offset)
+
+@export_filter
+def blend_other(image, other_image, extra="", **kwargs):
+    # extra can hold (in any order) a blend mode (normal, multiply, screen, overlay or difference),
+    # how much of the other image to use as "opacity=N" (a percentage, 50 if not given) and where
+    # to put it (see _get_position), e.g. "multiply opacity=80 top-left"
+    # the transparent parts of a 32-bit other image let this one show through, and if this one is
+    # 32-bit the result is too (as opaque as the other image over this one)
+    words = extra.replace(",", " ").split()
+    mode = "normal"
+    opacity = 50
+    for word in words:
+        if word in Compositing.BLEND_MODES:
+            mode = word
+        elif word.startswith("opacity="):
+            try:
+                opacity = int(word[8:])
+            except ValueError:
+                pass
+    pixels1 = get_pixels(image, alpha=True)
+    pixels2 = get_pixels(other_image, alpha=True)
+    h1, w1 = pixels1.shape[:2]
+    image3 = take_bmp(w1, h1, get_header(image).bpp)  # (every pixel gets written, so a reused one will do)
+
+    pixels3 = get_pixels(image3, alpha=True)
+    pixels3[:] = pixels1
+    matte = get_alpha(other_image) if has_alpha(other_image) else None
+    Compositing.composite(pixels3, pixels2, _get_position(words, pixels1, pixels2), mode, opacity / 100, matte)
+    del pixels3
+    image3.seek(0)
 
-@export_filter
-def blend_other(image, other_image, **kwargs):
-    image1 = image
-    image2 = other_image
-    fpp1, w1, h1, padding1, row_size1 = get_info(image1)
-    fpp2, w2, h2, padding2, row_size2 = get_info(image2)
-    image1.seek(fpp1)
-    image2.seek(fpp2)
-    image3 = create_bmp(w1, h1)
-    fpp3, w3, h3, padding3, row_size3 = get_info(image3)
-
-
-    image3.seek(fpp3)
-    for row in range(h1):
-        for pixel in range(w1):
-            b1, g1, r1 = image1.read(3)
-            b2, g2, r2 = image2.read(3)
-            blue1 = int((b1+b2)/2)
-            green1 = int((g1 + g2)/2)
-            red1 = int((r1+r2)/2)
-
-            image3.write(bytes([blue1, green1, red1]))
-        image1.seek(padding1, 1)
-        image2.seek(padding2, 1)
-        image3.write(bytes(padding3))
-    
     return image3
 @export_filter
 def borders(image, color, extra, **kwargs):
-   fpp, width, height, row_size, padding = get_info(image)
+   fpp, width, height, padding, row_size = get_info(image)
 
 
    draw_vline(image, (0,0), color, extra)
 
 
-   draw_hline(image, (0,0), color, extra)
-   draw_hline(image, (0,height-1), color, extra)
+   draw_hline(image, (0,0), color)
+   draw_hline(image, (0,height-1), color)
    draw_vline(image, (width-1, 0), color, extra)
 
 @export_filter
-def chroma_overlay(image, other_image, **kwargs):
-    green_screened = other_image
-    background_image = image
-
-   
-    fpp1, w1, h1, padding1, row_size1 = get_info(green_screened)
-    fpp2, w2, h2, padding2, row_size2 = get_info(background_image)
-    
-    image3 = create_bmp(w1, h1)
-    fpp3, w3, h3, padding3, row_size3 = get_info(image3)
-    
-    
-    green_screened.seek(fpp1)
-    background_image.seek(fpp2)
-    image3.seek(fpp3)
-
-    for row in range(h1):
-        for pixel in range(w1):
-            b1, g1, r1 = green_screened.read(3)
-            b2, g2, r2 = background_image.read(3)
-            if (g1 - b1 >= 100) and (g1 - r1 >= 100):
-                image3.write(bytes([b2, g2, r2]))
-                
-            else:
-                image3.write(bytes([b1, g1, r1]))
-        green_screened.seek(padding1, 1)
-        background_image.seek(padding2, 1)
-        image3.seek(padding3, 1)
+def chroma_overlay(image, other_image, extra="", **kwargs):
+    # puts the other image, shot in front of a green screen, on top of this one
+    # extra can hold (in any order) "tolerance=N" (how much greener than red and blue the screen is,
+    # 100 if not given), "softness=N" (how gradually the edges fade out, 0 if not given), "despill"
+    # (take the green tint out of the edges), "blue" for a blue screen and where to put the other
+    # image (see _get_position), e.g. "tolerance=60 softness=40 despill"
+    # if this image is 32-bit the result is too (the other image covers up its transparent parts)
+    words = extra.replace(",", " ").split()
+    key = "blue" if "blue" in words else "green"
+    tolerance, softness = 100, 0
+    for word in words:
+        name, _, value = word.partition("=")
+        if name in ("tolerance", "softness"):
+            try:
+                if name == "tolerance":
+                    tolerance = int(value)
+                else:
+                    softness = int(value)
+            except ValueError:
+                pass
+    green_screened = get_pixels(other_image, alpha=True)
+    background_image = get_pixels(image, alpha=True)
+    h1, w1 = background_image.shape[:2]
+
+    image3 = take_bmp(w1, h1, get_header(image).bpp)  # (every pixel gets written, so a reused one will do)
+    pixels3 = get_pixels(image3, alpha=True)
+
+    pixels3[:] = background_image
+    position = _get_position(words, background_image, green_screened)
+    Compositing.chroma_composite(pixels3, green_screened, position, key, tolerance, softness, "despill" in words)
+    del pixels3
+    image3.seek(0)
 
     return image3
 
 @export_filter
-def fade_in_vertical(image, **kwargs):
-    fpp1, w1, h1, padding1, row_size1 = get_info(image)
-    image.seek(fpp1)
-
-    for row in range(h1):
-        percent = row / (h1 - 1)
-        for pixel in range(w1):
-            b1, g1, r1 = image.read(3)
-            image.seek(-3, 1)
-            blue = int(percent * b1)
-            green = int(percent * g1)
-            red = int(percent * r1)
-            image.write(bytes([blue, green, red]))
-        
-        image.seek(padding1, 1)
-@export_filter
-def swap_rgb(image, extra, **kwargs):
-   fpp, width, height, padding, row_size = get_info(image)
-   image.seek(fpp)
-   for row in range(height):
-       for pixel in range(width):
-           blue, green, red = image.read(3)
-           new_blue = red
-           new_red = blue
-           image.seek(-3, 1)  # go back 3 bytes
-           image.write(bytes([new_blue, green, new_red]))  # write all three at once
-
-
-       image.seek(padding, 1)
+def flatten(image, color, **kwargs):
+    # puts a 32-bit image with transparent parts on a background of the chosen color, so
+    # every pixel ends up opaque (images without transparency stay as they are)
+    if not has_alpha(image):
+        return
+    pixels = get_pixels(image, alpha=True)
+    height, width = pixels.shape[:2]
+    rows_at_once = max(1, (1 << 20) // max(1, width))  # bounds the temporary arrays
+    # a whole band of the background (broadcasting one pixel of it is much slower)
+    background = np.empty((min(height, rows_at_once), width, 4), dtype=np.uint16)
+    background[...] = (color[2], color[1], color[0], 255)
+
+    for row in range(0, height, rows_at_once):
+        band = pixels[row : row + rows_at_once]
+        band_alpha = band[:, :, 3].astype(np.uint16)
+        # (all four channels get mixed, which is quicker than skipping the alpha, and then it is made opaque)
+        weight = np.stack((band_alpha, band_alpha, band_alpha, band_alpha), axis=-1)
+        # the pixel's color as much as it is opaque, the background for the rest (rounded)
+        mixed = band * weight
+        np.subtract(np.uint16(255), weight, out=weight)
+        weight *= background[: len(band)]
+        mixed += weight
+        mixed += np.uint16(127)
+        band[:] = mixed // np.uint16(255)
+        band[:, :, 3] = 255
 
 @export_filter
-def swap_brg(image, extra, **kwargs):
-   fpp, width, height, padding, row_size = get_info(image)
-   image.seek(fpp)
-   for row in range(height):
-       for pixel in range(width):
-           blue, green, red = image.read(3)
-           new_green = red
-           new_red = green
-           image.seek(-3, 1)  # go back 3 bytes
-           image.write(bytes([blue, new_green, new_red]))  # write all three at once
+def fade_in_vertical(image, **kwargs):
+    pixels = get_pixels(image)
+    h1 = pixels.shape[0]
 
+    percent = np.arange(h1) / (h1 - 1)
+    pixels[:] = percent[:, np.newaxis, np.newaxis] * pixels
+@export_filter(channel_op=True)
+def swap_rgb(image, extra, **kwargs):
+   pixels = get_pixels(image)
+   pixels[:] = pixels[:, :, [2, 1, 0]]  # blue <- red, red <- blue
 
-       image.seek(padding, 1)
+@export_filter(channel_op=True)
+def swap_brg(image, extra, **kwargs):
+   pixels = get_pixels(image)
+   pixels[:] = pixels[:, :, [0, 2, 1]]  # green <- red, red <- green
 
-@export_filter
+@export_filter(channel_op=True)
 def swap_rbg(image, extra, **kwargs):
-   fpp, width, height, padding, row_size = get_info(image)
-   image.seek(fpp)
-   for row in range(height):
-       for pixel in range(width):
-           blue, green, red = image.read(3)
-           new_blue = red
-           new_green = blue
-           new_red = green
-           image.seek(-3, 1)  # go back 3 bytes
-           image.write(bytes([new_blue, new_green, new_red]))  # write all three at once
-
-
-       image.seek(padding, 1)
+   pixels = get_pixels(image)
+   pixels[:] = pixels[:, :, [2, 0, 1]]  # blue <- red, green <- blue, red <- green
 
-@export_filter
+@export_filter(channel_op=True)
 def swap_grb(image, extra, **kwargs):
-   fpp, width, height, padding, row_size = get_info(image)
-   image.seek(fpp)
-   for row in range(height):
-       for pixel in range(width):
-           blue, green, red = image.read(3)
-           new_blue = green
-           new_green = red
-           new_red = blue
-           image.seek(-3, 1)  
-           image.write(bytes([new_blue, new_green, new_red])) 
-
-       image.seek(padding, 1)
+   pixels = get_pixels(image)
+   pixels[:] = pixels[:, :, [1, 2, 0]]  # blue <- green, green <- red, red <- blue
 
-@export_filter
+@export_filter(pixel_op=True)
 def grayify(image, **kwargs):
-    fpp, width, height, padding, row_size = get_info(image)
-
-    image.seek(fpp)
-
-    for row in range(height):
-        for pixel in range(width):
-                blue, green, red = image.read(3)
-                average = round((blue + green + red) / 3)
-                image.seek(-3, 1)
-
-                # Now make it halfway to the average
-                if (blue > average):
-                    diff = int((blue - average) / 2)
-                    blue -= diff
-                else:
-                    diff = int((average - blue) / 2)
-                    blue += diff
+    pixels = get_pixels(image)
+    channels = pixels.astype(np.int16)
+    average = (channels.sum(axis=2) + 1) // 3
 
-                if (green > average):
-                    diff = int((green - average) / 2)
-                    green -= diff
-                else:
-                    diff = int((average - green) / 2)
-                    green += diff
-                if (red > average):
-                    diff = int((red - average) / 2)
-                    red -= diff
-                else:
-                    diff = int((average - red) / 2)
-                    red += diff
-                image.write(bytes([blue, green, red]))
-        image.seek(padding, 1)
-
-
-@export_filter
-def redify(image, **kwargs):
+    # Now make it halfway to the average (int() rounds towards zero)
+    diff = average[:, :, np.newaxis] - channels
+    pixels[:] = channels + np.sign(diff) * (np.abs(diff) // 2)
 
-    fpp, width, height, padding, row_size = get_info(image)
-    image.seek(fpp)
 
-    for row in range(height):
+# Shared by the *ify filters: dark pixels become a shade of the main channels
+# and bright pixels fade from the main color towards white
+def _colorify(image, main_channels):
+    pixels = get_pixels(image)
+    brightness = pixels.sum(axis=2, dtype=np.uint16)
 
-        for pixel in range(width):
+    is_dark = brightness <= 382.5
+    dark_shade = (brightness / 382.5 * 255).clip(0, 255).astype(np.uint8)
+    light_shade = ((brightness - 382.5) / 382.5 * 255).clip(0, 255).astype(np.uint8)
 
-            blue, green, red = image.read(3)
-            brightness = red + green + blue
+    for channel in range(3):
+        if channel in main_channels:
+            pixels[:, :, channel] = np.where(is_dark, dark_shade, 255)
+        else:
+            pixels[:, :, channel] = np.where(is_dark, 0, light_shade)
 
-            if brightness <= 382.5:
-               
-                percent = brightness/382.5
-                red = int(percent * 255)
-                green = 0
-                blue = 0
-            else:
-                
-                red = 255
-                extra_brightness = brightness - 382.5
-                percent = extra_brightness / 382.5
 
-                green = int(percent * 255)  
-                blue = int(percent * 255)
-            
-            image.seek(-3, 1)
-            image.write(bytes([blue, green, red]))
-        
-        image.seek(padding, 1)
+@export_filter(pixel_op=True)
+def redify(image, **kwargs):
+    _colorify(image, (2,))
 
 
-@export_filter
+@export_filter(pixel_op=True)
 def blueify(image, **kwargs):
-    fpp, width, height, padding, row_size = get_info(image)
-    image.seek(fpp)
-
-    for row in range(height):
-        for pixel in range(width):
-            blue, green, red = image.read(3)
-            brightness = red + green + blue
-
-            if brightness <= 382.5:
-                percent = brightness / 382.5
-                blue = int(percent * 255)
-                green = 0
-                red = 0
-            else:
-                blue = 255
-                extra_brightness = brightness - 382.5
-                percent = extra_brightness / 382.5
-                green = int(percent * 255)
-                red = int(percent * 255)
-
-            image.seek(-3, 1)
-            image.write(bytes([blue, green, red]))
-
-        image.seek(padding, 1)
+    _colorify(image, (0,))
 
-@export_filter
+@export_filter(pixel_op=True)
 def greenify(image, **kwargs):
-    fpp, width, height, padding, row_size = get_info(image)
-    image.seek(fpp)
-
-    for row in range(height):
-        for pixel in range(width):
-            blue, green, red = image.read(3)
-            brightness = red + green + blue
-
-            if brightness <= 382.5:
-                percent = brightness / 382.5
-                green = int(percent * 255)
-                red = 0
-                blue = 0
-            else:
-                green = 255
-                extra_brightness = brightness - 382.5
-                percent = extra_brightness / 382.5
-                red = int(percent * 255)
-                blue = int(percent * 255)
-
-            image.seek(-3, 1)
-            image.write(bytes([blue, green, red]))
-
-        image.seek(padding, 1)
+    _colorify(image, (1,))
 
 
-@export_filter
+@export_filter(pixel_op=True)
 def magentify(image, **kwargs):
-    fpp, width, height, padding, row_size = get_info(image)
-    image.seek(fpp)
-
-    for row in range(height):
-        for pixel in range(width):
-            blue, green, red = image.read(3)
-            brightness = red + green + blue
-
-            if brightness <= 382.5:
-                
-                percent = brightness / 382.5
-                red = int(percent * 255)
-                green = 0
-                blue = int(percent * 255)
-            else:
-                red = 255
-                blue = 255
-                extra_brightness = brightness - 382.5
-                percent = extra_brightness / 382.5
-                green = int(percent * 255)
-
-            image.seek(-3, 1)
-            image.write(bytes([blue, green, red]))
-
-        image.seek(padding, 1)
+    _colorify(image, (0, 2))
 
 @export_filter
 def mirror_right_horizontal(image, **kwargs):
@@ -0,0 +1,146 @@
+"""PythoShop Image Stats
+
+Histograms and other statistics about the pixels of an image, worked out
+in one pass and cached on the image until its pixels change (see
+BmpImage.mark_changed), so several filters (or the same filter several
+times) can use them for free.  The same goes for the summed-area table
+that lets `sample_color` average any square of pixels in constant time.
+"""
+
+import typing
+
+import numpy as np
+
+from BmpImage import LUT_CHUNK_PIXELS, PALETTE_BPP, expand_palette, get_header, get_pixel, get_pixels, get_version
+
+# Weights (out of 256) of red, green and blue in the luminance (Rec. 601: 0.299, 0.587, 0.114)
+LUMINANCE_WEIGHTS = (77, 150, 29)
+
+
+class ImageStats:
+    """
+    Statistics about the pixels of an image
+
+    Everything is worked out from the histograms, which are the only thing
+    that needs a pass over the pixels.  Channels are in (red, green, blue)
+    order, like colors everywhere else in PythoShop.
+    """
+
+    def __init__(self, histograms: np.ndarray, luminance: np.ndarray) -> None:
+        """
+        :param histograms: (3, 256) array counting how many pixels have each red, green and blue value
+        :param luminance: (256,) array counting how many pixels have each luminance
+        """
+        self.histograms = histograms
+        self.luminance = luminance
+        self.pixel_count = int(luminance.sum())
+        values = np.arange(256)
+        self.sums = tuple(int(histogram @ values) for histogram in histograms)  # (sum of red, sum of green, sum of blue)
+        self.mean = tuple(total / max(1, self.pixel_count) for total in self.sums)
+        self.luminance_mean = int(luminance @ values) / max(1, self.pixel_count)
+        present = [np.flatnonzero(histogram) for histogram in histograms]
+        self.min = tuple(int(found[0]) if len(found) else 0 for found in present)
+        self.max = tuple(int(found[-1]) if len(found) else 0 for found in present)
+
+    def percentile(self, fraction: float, channel: typing.Optional[int] = None) -> int:
+        """
+        The value that `fraction` of the pixels are at or below
+
+        :param fraction: Between 0 and 1
+        :param channel: 0, 1 or 2 for red, green or blue, None for the luminance
+        :returns: Value between 0 and 255
+        """
+        histogram = self.luminance if channel is None else self.histograms[channel]
+        return int(np.searchsorted(np.cumsum(histogram), fraction * self.pixel_count))
+
+
+def get_image_stats(image) -> ImageStats:
+    """
+    Get the statistics of an image, working them out only if its pixels
+    changed since they were last asked for
+
+    :param image: BytesIO holding the 24 or 32-bit BMP image (alpha is left out)
+    :returns: ImageStats of the image
+    """
+    header = get_header(image)
+    cached = getattr(image, "_bmp_stats", None)
+    if cached is not None and cached[0] == get_version(image) and cached[1] == header.raw:
+        return cached[2]
+
+    pixels = get_pixels(image)
+    height, width = pixels.shape[:2]
+    histograms = np.zeros((3, 256), dtype=np.int64)
+    luminance = np.zeros(256, dtype=np.int64)
+    rows_per_chunk = max(1, LUT_CHUNK_PIXELS // max(1, width))
+    for first_row in range(0, height, rows_per_chunk):
+        chunk = pixels[first_row : first_row + rows_per_chunk]
+        blue, green, red = chunk[:, :, 0], chunk[:, :, 1], chunk[:, :, 2]
+        for c, channel in enumerate((red, green, blue)):
+            histograms[c] += np.bincount(channel.ravel(), minlength=256)
+        luma = (red * np.uint16(LUMINANCE_WEIGHTS[0]) + green * np.uint16(LUMINANCE_WEIGHTS[1]) + blue * np.uint16(LUMINANCE_WEIGHTS[2]) + np.uint16(128)) >> 8
+        luminance += np.bincount(luma.ravel(), minlength=256)
+
+    stats = ImageStats(histograms, luminance)
+    image._bmp_stats = (get_version(image), header.raw, stats)
+    return stats
+
+
+def get_summed_area_table(image) -> np.ndarray:
+    """
+    Get the summed-area table of an image, working it out only if its pixels
+    changed since it was last asked for
+
+    table[y, x] is the sum of every pixel below row y and left of column x,
+    per channel (in BGR order, like `get_pixels`), so the sum of any
+    rectangle is table[top, right] - table[bottom, right] - table[top, left]
+    + table[bottom, left].  The sums are uint32 and wrap around on big
+    images, which doesn't matter: the wrap cancels out in that difference as
+    long as the rectangle's own sum fits (i.e. for up to 16 million pixels).
+
+    :param image: BytesIO holding the 24 or 32-bit (or indexed) BMP image
+    :returns: (height + 1, width + 1, 3) uint32 array
+    """
+    header = get_header(image)
+    cached = getattr(image, "_bmp_summed_area", None)
+    if cached is not None and cached[0] == get_version(image) and cached[1] == header.raw:
+        return cached[2]
+
+    pixels = expand_palette(image) if header.bpp in PALETTE_BPP else get_pixels(image)
+    height, width = pixels.shape[:2]
+    table = np.zeros((height + 1, width + 1, 3), dtype=np.uint32)
+    sums = table[1:, 1:]
+    sums[...] = pixels
+    np.cumsum(sums, axis=1, out=sums)
+    # (adding each row to the next is several times faster than a cumsum down the columns)
+    for row in range(1, height):
+        np.add(sums[row], sums[row - 1], out=sums[row])
+
+    image._bmp_summed_area = (get_version(image), header.raw, table)
+    return table
+
+
+def sample_color(image, x: int, y: int, size: int = 1) -> tuple[int, int, int]:
+    """
+    Get the average color of the size x size square of pixels centered on a
+    pixel (the part of it inside the image), in constant time: a single pixel
+    is read straight from the image, bigger squares come from the summed-area
+    table (see get_summed_area_table)
+
+    :param image: BytesIO holding the 24 or 32-bit (or indexed) BMP image
+    :param x: Column of the pixel (0 is the left one)
+    :param y: Row of the pixel (0 is the bottom one)
+    :param size: Width (and height) of the square to average
+    :returns: (red, green, blue) average, rounded
+    """
+    if size <= 1:
+        return get_pixel(image, x, y)
+    table = get_summed_area_table(image)
+    height, width = table.shape[0] - 1, table.shape[1] - 1
+    left, bottom = max(0, x - size // 2), max(0, y - size // 2)
+    right, top = min(width, x - size // 2 + size), min(height, y - size // 2 + size)
+    if left >= right or bottom >= top:
+        raise IndexError("pixel (" + str(x) + ", " + str(y) + ") is outside the image")
+    total = table[top, right] - table[bottom, right] - table[top, left] + table[bottom, left]  # (wraps like the table)
+    count = (right - left) * (top - bottom)
+    b, g, r = ((int(channel) + count // 2) // count for channel in total)
+    return r, g, b
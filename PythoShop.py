@@ -1,13 +1,13 @@
-import importlib.util
-import math
 import os
 import time
 import typing
 from io import BytesIO
 
 from kivy.app import App
+from kivy.clock import Clock
 from kivy.core.image import Image as CoreImage
 from kivy.core.window import Window
+from kivy.graphics.texture import Texture
 from kivy.input.providers.mouse import MouseMotionEvent
 from kivy.uix.button import Button
 from kivy.uix.colorpicker import ColorPicker
@@ -15,9 +15,16 @@ from kivy.uix.dropdown import DropDown
 from kivy.uix.image import Image as UixImage
 from kivy.uix.popup import Popup
 from kivy.uix.widget import Widget
-from PIL import Image
+import numpy as np
 
+from BmpImage import PALETTE_BPP, MappedImage, can_view_pixels, expand_palette, get_header, get_pixel_data, get_pixels, open_image, save_bmp, take_dirty
+from Drawing import line_points
+from FilterJob import FilterJob
+from ImageStats import sample_color
+from PythoShopExports import get_exports, load_manip_module
 from ImageManip import *
+from StripExecutor import run_in_strips
+from UndoHistory import UndoHistory
 from tests.config import DEFAULT_STARTING_PRIMARY_IMAGE_PATH, DEFAULT_STARTING_SECONDARY_IMAGE_PATH
 
 
@@ -30,6 +37,9 @@ class ImageDisplay:
         self.is_primary = is_primary
         self.uix_image: typing.Optional[UixImage] = None
         self.bytes: typing.Optional[BytesIO] = None
+        self.texture: typing.Optional[Texture] = None
+        self.texture_key: tuple[int, int, bool, str] = (0, 0, False, "")  # (width, height, top_down, colorfmt) the texture was made for
+        self.history = UndoHistory()
 
     def is_image_loaded(self) -> bool:
         return bool(self.uix_image)
@@ -44,13 +54,68 @@ class ImageDisplay:
         else:
             return PythoShopApp._root.image2
 
-    def do_binds(self) -> None:
-        assert self.uix_image
+    def do_binds(self, dirty: typing.Optional[tuple[int, int, int, int]] = None) -> None:
+        """
+        Show the current pixels of the image
 
-        self.uix_image.texture = CoreImage(self.bytes, ext="bmp").texture
-        # to avoid anti-aliassing when zoomed
-        self.uix_image.texture.mag_filter = "nearest"
-        self.uix_image.texture.min_filter = "nearest"
+        :param dirty: Optional (left, bottom, right, top) rectangle (see BmpImage.mark_dirty)
+            outside of which nothing changed since the last call, only that part gets uploaded
+        :returns: None
+        """
+        assert self.uix_image and self.bytes
+
+        header = get_header(self.bytes)
+        indexed = header.bpp in PALETTE_BPP
+        if not indexed and not can_view_pixels(self.bytes):  # let Kivy decode anything the pixel view doesn't understand
+            bytes_ = self.bytes if isinstance(self.bytes, BytesIO) else BytesIO(self.bytes.getbuffer())  # CoreImage only reads BytesIO
+            self.texture = None
+            self.uix_image.texture = CoreImage(bytes_, ext="bmp").texture
+            # to avoid anti-aliassing when zoomed
+            self.uix_image.texture.mag_filter = "nearest"
+            self.uix_image.texture.min_filter = "nearest"
+            return
+
+        # Keep one texture per image and upload the pixel rows of the BMP straight into it
+        # (32-bit images go into an RGBA texture as they are, alpha and all)
+        colorfmt = "bgra" if header.bpp == 32 else "bgr"
+        texture_key = (header.width, header.height, header.top_down, colorfmt)
+        if dirty and not indexed and self.texture is not None and self.texture_key == texture_key and self.uix_image.texture is self.texture:
+            left, bottom, right, top = dirty
+            pixels = get_pixels(self.bytes, alpha=True)[bottom:top, left:right]
+            if header.top_down:  # the texture holds the rows in file order (top row first)
+                pixels, bottom = pixels[::-1], header.height - top
+            region = np.ascontiguousarray(pixels)
+            del pixels
+            self.texture.blit_buffer(region, size=(region.shape[1], region.shape[0]), pos=(left, bottom), colorfmt=colorfmt, bufferfmt="ubyte")
+            self.uix_image.canvas.ask_update()
+            return
+
+        if self.texture is None or self.texture_key != texture_key:
+            self.texture = Texture.create(size=(header.width, header.height), colorfmt=colorfmt)
+            if header.top_down:
+                self.texture.flip_vertical()
+            # to avoid anti-aliassing when zoomed
+            self.texture.mag_filter = "nearest"
+            self.texture.min_filter = "nearest"
+            self.texture_key = texture_key
+
+        if indexed:
+            pixels = expand_palette(self.bytes)  # (the image itself stays indexed)
+            rows = np.ascontiguousarray(pixels[::-1]) if header.top_down else pixels
+            del pixels
+        elif header.padding == 0:  # (always the case for 32-bit images)
+            rows = get_pixel_data(self.bytes)  # zero-copy: the rows are already packed the way OpenGL wants them
+        else:
+            pixels = get_pixels(self.bytes)  # (bottom row first, top-down images go back to file order for their flipped texture)
+            rows = np.ascontiguousarray(pixels[::-1] if header.top_down else pixels)  # drop the padding
+            del pixels
+        self.texture.blit_buffer(rows, colorfmt=colorfmt, bufferfmt="ubyte")
+        del rows
+
+        if self.uix_image.texture is self.texture:
+            self.uix_image.canvas.ask_update()
+        else:
+            self.uix_image.texture = self.texture
 
     def do_resize(self) -> None:
         assert self.uix_image
@@ -130,6 +195,9 @@ def _select_color(x: int, y: int) -> None:  # sourcery skip: merge-else-if-into-
     """
     Set the color picker to be the RGB of a particular (x, y) coordinate
 
+    A number in the "extra parameters..." box (e.g. 5) sets the color to the
+    average of that size square around the pixel instead.
+
     :param x: The x value of the pixel to sample
     :param y: The y value of the pixel to sample
     :returns: None
@@ -138,24 +206,17 @@ def _select_color(x: int, y: int) -> None:  # sourcery skip: merge-else-if-into-
 
     image = _get_current_image()
     if image.bytes:
-        img = Image.open(image.bytes)
-        r, g, b = img.getpixel((x, img.height - 1 - y))
+        try:
+            size = int(_get_extra_text())
+        except ValueError:
+            size = 1
+        r, g, b = sample_color(image.bytes, x, y, size)
         PythoShopApp._color_picker.color = (r / 255, g / 255, b / 255, 1)
 
 
 def _get_image_bytes(file_name: str) -> BytesIO:
-    if os.path.splitext(file_name)[-1].lower() == ".bmp":
-        # Load it directly rather than going through Pillow where we might loose some fidelity (e.g. paddding bytes)
-        current_bytes = BytesIO()
-        current_bytes.write(open(file_name, "rb").read())
-    else:
-        current_bytes = BytesIO()
-        img = Image.open(file_name)
-        img = img.convert("RGB")
-        img.save(current_bytes, format="bmp")
-        img.close()
-
-    return current_bytes
+    # (big BMP files get memory-mapped rather than copied into memory)
+    return open_image(file_name)
 
 
 def _get_chosen_color() -> tuple[int, int, int]:
@@ -196,7 +257,7 @@ def _is_touch_in_image(cimage: UixImage, event: MouseMotionEvent, cscatter) -> b
             return True
 
 
-def _handle_touch_in_image(cimage: UixImage, event: MouseMotionEvent, cscatter) -> None:
+def _get_touch_pixel(cimage: UixImage, event: MouseMotionEvent, cscatter) -> tuple[int, int]:
     lr_space = (cimage.width - cimage.norm_image_size[0]) / 2  # empty space in Image widget left and right of actual image
     tb_space = (cimage.height - cimage.norm_image_size[1]) / 2  # empty space in Image widget above and below actual image
     pixel_x = event.x - lr_space - cscatter.x  # x coordinate of touch measured from lower left of actual image
@@ -207,12 +268,67 @@ def _handle_touch_in_image(cimage: UixImage, event: MouseMotionEvent, cscatter)
     # scale coordinates to actual pixels of the Image source
     actual_x = int(pixel_x * cimage.texture_size[0] / cimage.norm_image_size[0])
     actual_y = int(pixel_y * cimage.texture_size[1] / cimage.norm_image_size[1])
+    return actual_x, actual_y
+
+
+def _handle_touch_in_image(cimage: UixImage, event: MouseMotionEvent, cscatter) -> None:
+    actual_x, actual_y = _get_touch_pixel(cimage, event, cscatter)
 
     # Note: can't call your manip functions "_select_"
     if PythoShopApp._tool_function.__name__[:8] == "_select_":
         PythoShopApp._tool_function(actual_x, actual_y)
     else:
         run_manip_function(PythoShopApp._tool_function, clicked_coordinate=(actual_x, actual_y))
+        PythoShopApp._stroke_last = (actual_x, actual_y)  # where a drag starting here continues from
+
+
+def _stroke_path(start: typing.Optional[tuple[int, int]], end: tuple[int, int]) -> list[tuple[int, int]]:
+    """
+    Get the pixels a stroke goes through from one sample to the next (Bresenham)
+
+    :param start: The previous sample (already painted), None if this is the first one
+    :param end: The new sample
+    :returns: List of coordinates after start up to and including end
+    """
+    if start is None:
+        return [end]
+    xs, ys = line_points(start, end)
+    return list(zip(xs[1:].tolist(), ys[1:].tolist()))
+
+
+def _queue_stroke_point(coordinate: tuple[int, int]) -> None:
+    """
+    Remember where a drag went; the tool is applied to everything queued
+    during a frame in one go (see _apply_stroke)
+
+    :param coordinate: Pixel the drag went through
+    :returns: None
+    """
+    PythoShopApp._stroke_points.append(coordinate)
+    PythoShopApp._stroke_trigger()
+
+
+def _apply_stroke(dt: float = 0) -> None:
+    """
+    Apply the current tool to where the drag went since the last frame: along
+    everything it went through, filling in the pixels between the samples,
+    for brush-like tools (see export_tool), only where it got to for others
+    """
+    points, PythoShopApp._stroke_points = PythoShopApp._stroke_points, []
+    if not points or not PythoShopApp._tool_function:
+        return
+
+    merge = PythoShopApp._stroke_last is not None  # the drag started on the image, undo it all at once
+    path = []
+    if getattr(PythoShopApp._tool_function, "__interpolate__", False):
+        for point in points:
+            path.extend(_stroke_path(PythoShopApp._stroke_last, point))
+            PythoShopApp._stroke_last = point
+    elif points[-1] != PythoShopApp._stroke_last:
+        path.append(points[-1])
+        PythoShopApp._stroke_last = points[-1]
+    if path:
+        run_tool_stroke(PythoShopApp._tool_function, path, merge)
 
 
 def _write_image_to_file_system(bytes: BytesIO) -> None:
@@ -222,11 +338,8 @@ def _write_image_to_file_system(bytes: BytesIO) -> None:
     :param bytes: Bytes of bitmap to write to the filesystem
     :returns: None
     """
-    bytes.seek(0)
     new_image_file_name = os.path.join(os.path.expanduser("~"), "Desktop", "PythoShop " + time.strftime("%Y-%m-%d at %H.%M.%S") + ".bmp")
-    new_image_file = open(new_image_file_name, "wb")
-    new_image_file.write(bytes.read())
-    new_image_file.close()
+    save_bmp(bytes, new_image_file_name)
 
 
 def _check_bmp_integrity(image: BytesIO) -> None:
@@ -236,41 +349,31 @@ def _check_bmp_integrity(image: BytesIO) -> None:
     :param image: Image to assert is a proper bitmap
     :returns: None
     """
-    image.seek(0)
-    assert image.read(2) == b"\x42\x4d", "header field was invalid"
-    file_byte_size = int.from_bytes(image.read(4), "little")
-
-    image.seek(10)
-    first_pixel_offset = int.from_bytes(image.read(4), "little")
-    header_size = int.from_bytes(image.read(4), "little")  # should be fpp - 14
-    pixel_width = int.from_bytes(image.read(4), "little")
-    pixel_height = int.from_bytes(image.read(4), "little")
-    color_planes = int.from_bytes(image.read(2), "little")
-    assert color_planes == 1, "color planes should be 1"
-    bits_per_pixel = int.from_bytes(image.read(2), "little")
+    header = get_header(image)
+    assert header.raw[:2] == b"\x42\x4d", "header field was invalid"
+    assert header.color_planes == 1, "color planes should be 1"
 
     bits_per_pixel_possibilities = [1, 4, 8, 16, 24, 32]
-    assert bits_per_pixel in bits_per_pixel_possibilities, (
-        "bits per pixel is set to " + str(bits_per_pixel) + " which is not one of the allowed options: " + ", ".join(bits_per_pixel_possibilities)
+    assert header.bpp in bits_per_pixel_possibilities, (
+        "bits per pixel is set to " + str(header.bpp) + " which is not one of the allowed options: " + ", ".join(map(str, bits_per_pixel_possibilities))
     )
-    bits_per_row = pixel_width * bits_per_pixel
-    bytes_per_row = math.ceil(bits_per_row / 8)
-    padding_bytes = 0
-    if bytes_per_row % 4 != 0:
-        padding_bytes = 4 - bytes_per_row % 4
-    row_byte_size = bytes_per_row + padding_bytes
-    theoretical_file_size = first_pixel_offset + row_byte_size * pixel_height
-    assert file_byte_size == theoretical_file_size, "file size is incorrect"
-
-    compression = int.from_bytes(image.read(4), "little")
-    assert compression == 0, "PythoShop doesn't support images with compression"
-    pixel_data_byte_size = int.from_bytes(image.read(4), "little")
-    assert pixel_data_byte_size == 0 or pixel_data_byte_size == row_byte_size * pixel_height, "pixel data size can either be 0 or the actual size"
+    row_byte_size = header.row_size
+    theoretical_file_size = header.fpp + row_byte_size * header.height
+    assert header.file_size == theoretical_file_size, "file size is incorrect"
+
+    # (32-bit images can have bit fields, which get_pixels checks are laid out as BGRA)
+    assert header.compression == 0 or (header.bpp == 32 and header.compression == 3), "PythoShop doesn't support images with compression"
+    assert header.pixel_data_size == 0 or header.pixel_data_size == row_byte_size * header.height, "pixel data size can either be 0 or the actual size"
     # only validates the header up to position 38
     image.seek(0)
 
 
-def run_manip_function(func: typing.Callable, **kwargs) -> None:
+def _get_manip_images() -> tuple[ImageDisplay, ImageDisplay]:
+    """
+    Get the image a manipulation function should run on and the other one
+
+    :returns: Tuple of (image in the selected tab, image in the other tab)
+    """
     if _is_primary_tab_selected():
         image1 = PythoShopApp._image1
         image2 = PythoShopApp._image2
@@ -282,35 +385,186 @@ def run_manip_function(func: typing.Callable, **kwargs) -> None:
 
     if not image1.uix_image or not image1.bytes:
         raise NoImageError("The currently selected tab doesn't have an image loaded into it")
+    return image1, image2
+
+
+def _get_manip_kwargs(image1: ImageDisplay, image2: ImageDisplay) -> dict:
+    """
+    Get the parameters every manipulation function is called with
+
+    :param image1: Image the function will run on
+    :param image2: The other image
+    :returns: Dictionary of keyword arguments (color, extra and other_image)
+    """
+    image1.bytes.seek(0)
+    kwargs = {"color": _get_chosen_color(), "extra": _get_extra_text()}
+    if image2.bytes:
+        image2.bytes.seek(0)
+        kwargs["other_image"] = image2.bytes
+    return kwargs
+
+
+def _show_manip_result(
+    func: typing.Callable, image1: ImageDisplay, result: typing.Any, dirty: typing.Optional[tuple] = None, merge: bool = False
+) -> None:
+    """
+    Check the image a manipulation function produced, remember what it changed (for undo) and display it
+
+    :param func: The function that was run
+    :param image1: The image it was run on
+    :param result: What the function returned
+    :param dirty: Rectangle the function changed in place (see BmpImage.mark_dirty), None for all of it
+    :param merge: Undo this together with the previous manipulation (e.g. the rest of a drag)
+    :returns: None
+    """
+    if result != None:  # Something was returned, make sure it was an image file
+        if result.__class__ not in (BytesIO, MappedImage):
+            raise Exception("Function", func.__name__, "should have returned an image but instead returned something else")
+        verified_bytes = result
+        dirty = None  # a whole new image
+    else:  # No return: assume that the change has been made to the image itself (img1)
+        verified_bytes = image1.bytes
 
     try:
-        image1.bytes.seek(0)
-        kwargs["color"] = _get_chosen_color()
-        kwargs["extra"] = _get_extra_text()
-        if image2.bytes:
-            image2.bytes.seek(0)
-            kwargs["other_image"] = image2.bytes
-
-        result = func(image1.bytes, **kwargs)
-        if result != None:  # Something was returned, make sure it was an image file
-            if result.__class__ != BytesIO:
-                raise Exception("Function", func.__name__, "should have returned an image but instead returned something else")
-            verified_bytes = result
-        else:  # No return: assume that the change has been made to the image itself (img1)
-            verified_bytes = image1.bytes
+        _check_bmp_integrity(verified_bytes)
+    except AssertionError as ae:
+        raise Exception('The image returned by "' + func.__name__ + '" was corrupt and cannot be displayed: ' + str(ae))
 
-        try:
-            _check_bmp_integrity(verified_bytes)
-        except AssertionError as ae:
-            raise Exception('The image returned by "' + func.__name__ + '" was corrupt and cannot be displayed: ' + str(ae))
+    image1.history.record(verified_bytes, dirty, merge)
+    verified_bytes.seek(0)
+    image1.load_image(image1.uix_image, verified_bytes)
+    image1.do_binds(dirty)
+
+
+def run_manip_function(func: typing.Callable, **kwargs) -> None:
+    image1, image2 = _get_manip_images()
 
-        verified_bytes.seek(0)
-        image1.load_image(image1.uix_image, verified_bytes)
-        image1.do_binds()
+    try:
+        kwargs.update(_get_manip_kwargs(image1, image2))
+        take_dirty(image1.bytes)  # forget about anything marked outside of a manipulation
+        result = run_in_strips(func, image1.bytes, **kwargs)  # in parallel when the filter allows it
+        _show_manip_result(func, image1, result, take_dirty(image1.bytes))
     except SyntaxError:
         print("Error: ", func.__name__, "generated an exception")
 
 
+def run_tool_stroke(func: typing.Callable, coordinates: list[tuple[int, int]], merge: bool = False) -> None:
+    """
+    Apply a tool at several coordinates, then check and redisplay the image
+    only once (the tool has to change the image in place)
+
+    :param func: The tool to apply
+    :param coordinates: Pixels to apply it to, in order
+    :param merge: Undo this together with the previous manipulation (the start of the same drag)
+    :returns: None
+    """
+    image1, image2 = _get_manip_images()
+
+    try:
+        kwargs = _get_manip_kwargs(image1, image2)
+        take_dirty(image1.bytes)  # forget about anything marked outside of a manipulation
+        result = None
+        dirty_rects = []
+        for coordinate in coordinates:
+            image1.bytes.seek(0)
+            result = func(image1.bytes, clicked_coordinate=coordinate, **kwargs)
+            dirty_rects.append(take_dirty(image1.bytes))
+
+        dirty = None  # the whole image unless every application marked what it changed
+        if None not in dirty_rects:
+            dirty = (
+                min(rect[0] for rect in dirty_rects),
+                min(rect[1] for rect in dirty_rects),
+                max(rect[2] for rect in dirty_rects),
+                max(rect[3] for rect in dirty_rects),
+            )
+        _show_manip_result(func, image1, result, dirty, merge)
+    except SyntaxError:
+        print("Error: ", func.__name__, "generated an exception")
+
+
+def start_manip_job(func: typing.Callable) -> None:
+    """
+    Run a filter in the background, showing its progress, and display the
+    result once it is done (tools can't be used in the meantime)
+
+    :param func: The filter to run
+    :returns: None
+    """
+    if PythoShopApp._job:
+        return  # one filter at a time
+    image1, image2 = _get_manip_images()
+    kwargs = _get_manip_kwargs(image1, image2)
+
+    # the job calls these from its own thread, the widgets may only be touched from the main one
+    def on_progress(rows_done: int, total_rows: int) -> None:
+        Clock.schedule_once(lambda dt: _show_progress(rows_done / max(1, total_rows)))
+
+    def on_done(job: FilterJob) -> None:
+        Clock.schedule_once(lambda dt: _finish_manip_job(job, image1))
+
+    PythoShopApp._job = FilterJob(func, image1.bytes, on_done, on_progress, **kwargs)
+    _show_progress(0)
+    PythoShopApp._job.start()
+
+
+def _show_progress(fraction: typing.Optional[float]) -> None:
+    """
+    Show how far the running filter is (or hide the progress bar)
+
+    :param fraction: How much of the filter is done (between 0 and 1), None when no filter is running
+    :returns: None
+    """
+    PythoShopApp._root.progress_bar.opacity = 0 if fraction is None else 1
+    PythoShopApp._root.progress_bar.value = fraction or 0
+    PythoShopApp._root.cancel_button.disabled = fraction is None
+
+
+def _finish_manip_job(job: FilterJob, image1: ImageDisplay) -> None:
+    PythoShopApp._job = None
+    _show_progress(None)
+    if job.cancelled or image1.bytes is not job.image:  # cancelled, or another image was loaded meanwhile
+        job.discard()
+        return
+    if isinstance(job.error, SyntaxError):
+        print("Error: ", job.func.__name__, "generated an exception")
+    elif job.error:
+        raise job.error
+    else:
+        _show_manip_result(job.func, image1, job.result)
+
+
+def _show_history_step(image: ImageDisplay, restored: typing.Optional[BytesIO]) -> None:
+    """
+    Display an image after undoing or redoing a step
+
+    :param image: The image that was undone or redone
+    :param restored: What UndoHistory.undo / redo returned (None if there was nothing to do)
+    :returns: None
+    """
+    if restored is None:
+        return
+    restored.seek(0)
+    dirty = take_dirty(restored)
+    image.load_image(image.uix_image, restored)
+    image.do_binds(dirty)
+
+
+def _on_keyboard(window, key: int, scancode: int, codepoint: str, modifiers: list[str]) -> bool:
+    """
+    Ctrl+Z undoes, Ctrl+Y (or Ctrl+Shift+Z) redoes
+    """
+    if "ctrl" not in modifiers and "meta" not in modifiers:
+        return False
+    if codepoint == "z" and "shift" not in modifiers:
+        PythoShopApp._root.undo()
+    elif codepoint in ("y", "z"):
+        PythoShopApp._root.redo()
+    else:
+        return False
+    return True
+
+
 class FileChooserDialog(Widget):
     def __init__(self, **kwargs) -> None:
         super().__init__()
@@ -334,6 +588,7 @@ class FileChooserDialog(Widget):
 
         uix_image = UixImage(fit_mode="contain")
         image.load_image(uix_image, current_bytes)
+        image.history.reset(current_bytes)
         image.do_binds()
         image.do_resize()
 
@@ -356,27 +611,51 @@ class PhotoShopWidget(Widget):
             PhotoShopWidget._file_chooser_popup = Popup(title="Choose an image", content=FileChooserDialog(rootpath=os.path.expanduser("./images")))
         PhotoShopWidget._file_chooser_popup.open()
 
+    def cancel_filter(self) -> None:
+        if PythoShopApp._job:
+            PythoShopApp._job.cancel()
+
+    def undo(self) -> None:
+        image = _get_current_image()
+        if image.bytes and not PythoShopApp._job:
+            _show_history_step(image, image.history.undo())
+
+    def redo(self) -> None:
+        image = _get_current_image()
+        if image.bytes and not PythoShopApp._job:
+            _show_history_step(image, image.history.redo())
+
     def save_image(self) -> None:
         image = _get_current_image()
         if image.bytes:
             _write_image_to_file_system(image.bytes)
 
-    def apply_tool(self, event: MouseMotionEvent, callback: typing.Callable) -> bool:
+    def apply_tool(self, event: MouseMotionEvent, callback: typing.Callable, in_stroke: bool = False) -> bool:
         image = _get_current_image()
 
         uix_image = image.uix_image
         scatter = image.get_scatter()
-        if uix_image and PythoShopApp._tool_function and _is_touch_in_image(uix_image, event, scatter):
-            _handle_touch_in_image(uix_image, event, scatter)
+        if uix_image and PythoShopApp._tool_function and not PythoShopApp._job and _is_touch_in_image(uix_image, event, scatter):
+            if in_stroke and PythoShopApp._tool_function.__name__[:8] != "_select_":
+                _queue_stroke_point(_get_touch_pixel(uix_image, event, scatter))
+            else:
+                _handle_touch_in_image(uix_image, event, scatter)
             return True
         else:
             return callback(event)
 
     def on_touch_down(self, touch: MouseMotionEvent) -> None:
+        PythoShopApp._stroke_last = None
         self.apply_tool(touch, super().on_touch_down)
 
     def on_touch_move(self, movement: MouseMotionEvent) -> None:
-        self.apply_tool(movement, super().on_touch_move)
+        # drags come in much faster than the image can be redisplayed, so they are batched per frame
+        self.apply_tool(movement, super().on_touch_move, in_stroke=True)
+
+    def on_touch_up(self, touch: MouseMotionEvent) -> None:
+        _apply_stroke()  # don't leave the end of the drag waiting for the next frame
+        PythoShopApp._stroke_last = None
+        super().on_touch_up(touch)
 
 
 class PythoShopApp(App):
@@ -385,6 +664,10 @@ class PythoShopApp(App):
     _root: typing.Any = None
     _tool_function: typing.Any = None
     _color_picker: typing.Optional[ColorPicker] = None
+    _job: typing.Optional[FilterJob] = None  # filter running in the background
+    _stroke_points: list[tuple[int, int]] = []  # pixels dragged through since the last frame
+    _stroke_last: typing.Optional[tuple[int, int]] = None  # last pixel the current drag was applied to
+    _stroke_trigger: typing.Any = None
     _first_color = True
 
     def on_color(self, value: list[int]) -> None:
@@ -413,6 +696,8 @@ class PythoShopApp(App):
 
     def build(self) -> None:
         Window.bind(on_dropfile=self._on_file_drop)
+        Window.bind(on_keyboard=_on_keyboard)
+        PythoShopApp._stroke_trigger = Clock.create_trigger(_apply_stroke)
         PythoShopApp._root = PhotoShopWidget()
         # Find the functions that can be run
         try:
@@ -434,24 +719,20 @@ class PythoShopApp(App):
             select_color_button.bind(on_release=lambda btn: PythoShopApp._tool_dropdown.select(btn))
             PythoShopApp._tool_dropdown.add_widget(select_color_button)
 
-            spec = importlib.util.spec_from_file_location("ImageManip", os.getcwd() + "/ImageManip.py")
-            manip_module = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(manip_module)  # try to load it to see if we have a syntax error
-            for attribute in dir(manip_module):
-                thing = getattr(manip_module, attribute)
-                if callable(thing) and hasattr(thing, "__wrapped__") and hasattr(thing, "__type__"):
-                    if getattr(thing, "__type__") == "filter":
-                        btn = Button(text=attribute, size_hint_y=None, height=44)
-                        btn.func = thing
-                        btn.bind(on_release=lambda btn: PythoShopApp._filter_dropdown.select(btn))
-                        PythoShopApp._filter_dropdown.add_widget(btn)
-                    elif getattr(thing, "__type__") == "tool":
-                        btn = Button(text=attribute, size_hint_y=None, height=44)
-                        btn.func = thing
-                        btn.bind(on_release=lambda btn: PythoShopApp._tool_dropdown.select(btn))
-                        PythoShopApp._tool_dropdown.add_widget(btn)
-                    else:
-                        print("Error: unrecognized manipulation")
+            manip_module = load_manip_module(os.getcwd() + "/ImageManip.py")  # try to load it to see if we have a syntax error
+            for attribute, thing in get_exports(manip_module).items():
+                if getattr(thing, "__type__") == "filter":
+                    btn = Button(text=attribute, size_hint_y=None, height=44)
+                    btn.func = thing
+                    btn.bind(on_release=lambda btn: PythoShopApp._filter_dropdown.select(btn))
+                    PythoShopApp._filter_dropdown.add_widget(btn)
+                elif getattr(thing, "__type__") == "tool":
+                    btn = Button(text=attribute, size_hint_y=None, height=44)
+                    btn.func = thing
+                    btn.bind(on_release=lambda btn: PythoShopApp._tool_dropdown.select(btn))
+                    PythoShopApp._tool_dropdown.add_widget(btn)
+                else:
+                    print("Error: unrecognized manipulation")
             PythoShopApp._root.filter_button.bind(on_release=PythoShopApp._filter_dropdown.open)
             PythoShopApp._root.tool_button.bind(on_release=PythoShopApp._tool_dropdown.open)
 
@@ -459,7 +740,7 @@ class PythoShopApp(App):
                 # currently selected tab actually has an image
                 image = _get_current_image()
                 if image.is_image_loaded():
-                    run_manip_function(btn.func)
+                    start_manip_job(btn.func)
 
             PythoShopApp._filter_dropdown.bind(on_select=select_filter)
 
@@ -478,6 +759,7 @@ class PythoShopApp(App):
             # Create a Kivy Image widget for the loaded image
             uix_image = UixImage(fit_mode="contain")
             PythoShopApp._image1.load_image(uix_image, current_bytes)
+            PythoShopApp._image1.history.reset(current_bytes)
             PythoShopApp._image1.do_binds()
             PythoShopApp._image1.do_resize()
 
@@ -488,6 +770,7 @@ class PythoShopApp(App):
             # Create a Kivy Image widget for the loaded image
             uix_image = UixImage(fit_mode="contain")
             PythoShopApp._image2.load_image(uix_image, current_bytes)
+            PythoShopApp._image2.history.reset(current_bytes)
             PythoShopApp._image2.do_binds()
             PythoShopApp._image2.do_resize()
 
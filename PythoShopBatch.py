@@ -0,0 +1,229 @@
+"""PythoShop Batch
+
+Applies a chain of exported filters to many image files without the GUI
+(and without importing Kivy), e.g.
+
+    python PythoShopBatch.py "scans/*.bmp" -f negate -f "make_two_tone:dark" -o out
+
+Files are handed to a pool of worker processes a few at a time, so a glob
+matching thousands of files never has them all in flight at once.  With
+--stream, chains of strip safe filters run on BMP files a few rows at a
+time (see StripExecutor.filter_file), so files bigger than memory work too.
+"""
+
+import argparse
+import concurrent.futures
+import glob
+import os
+import sys
+import time
+import typing
+
+from BmpImage import HEADER_BYTES, PIXEL_BPP, BmpHeader, get_header, open_image, release_bmp, save_bmp
+from FilterPipeline import FilterPipeline
+from PythoShopExports import get_exports, load_manip_module
+from StripExecutor import filter_file
+
+# How many files may be waiting for (or in) each worker at once
+FILES_PER_WORKER = 2
+
+_pipelines: dict = {}  # (manip file, chain) -> FilterPipeline, per worker process
+_other_images: dict = {}  # file name -> image, per worker process
+
+
+def parse_chain(chain: list[str], exports: dict) -> list[tuple[str, dict]]:
+    """
+    Turn the filters given on the command line into (name, params) steps
+
+    :param chain: Filters in the order to apply them, each "name" or "name:extra"
+    :param exports: The exported functions (see PythoShopExports.get_exports)
+    :returns: List of (filter name, params) tuples
+    """
+    steps = []
+    for text in chain:
+        name, separator, extra = text.partition(":")
+        if name not in exports or exports[name].__type__ != "filter":
+            raise ValueError(name + " is not an exported filter")
+        steps.append((name, {"extra": extra} if separator else {}))
+    return steps
+
+
+def _get_pipeline(manip_file: str, steps: tuple) -> FilterPipeline:
+    """
+    Worker side: build the filter pipeline once per process
+    """
+    key = (manip_file, steps)
+    if key not in _pipelines:
+        exports = get_exports(load_manip_module(manip_file))
+        _pipelines[key] = FilterPipeline([(exports[name], dict(params)) for name, params in steps])
+    return _pipelines[key]
+
+
+def get_output_name(file_name: str, output_dir: str) -> str:
+    """
+    Work out where the result of filtering a file is saved: under the same
+    name, as a BMP, keeping the original extension of other files in the
+    name (so a.bmp and a.png don't both become a.bmp)
+
+    :param file_name: Image to filter
+    :param output_dir: Directory to save the result in
+    :returns: Path of the result
+    """
+    name = os.path.basename(file_name)
+    if os.path.splitext(name)[1].lower() != ".bmp":
+        name += ".bmp"
+    return os.path.join(output_dir, name)
+
+
+def process_file(manip_file: str, steps: tuple, file_name: str, output_dir: str, kwargs: dict, other_file: typing.Optional[str], stream: bool = False):
+    """
+    Worker side: apply the filters to one file and save the result as a BMP
+
+    :param manip_file: Path of the module the filters come from (ImageManip.py)
+    :param steps: Tuple of (filter name, tuple of params items) steps
+    :param file_name: Image to filter
+    :param output_dir: Directory to save the result in (see get_output_name)
+    :param kwargs: Parameters for every filter (color, extra)
+    :param other_file: Image to use as other_image, if any
+    :param stream: Filter BMP files a few rows at a time (when every filter is strip safe)
+    :returns: (output file name, megapixels, seconds taken)
+    """
+    start = time.perf_counter()
+    pipeline = _get_pipeline(manip_file, steps)
+    output_file = get_output_name(file_name, output_dir)
+    if stream and pipeline.__strip_safe__ and os.path.splitext(file_name)[1].lower() == ".bmp":
+        with open(file_name, "rb") as file:
+            header = BmpHeader(file.read(HEADER_BYTES))
+        # (indexed images only have their palette filtered, so they are small enough as they are)
+        if header.bpp in PIXEL_BPP and header.compression == 0:
+            header = filter_file(pipeline, file_name, output_file, **kwargs)
+            return output_file, header.width * header.height / 1e6, time.perf_counter() - start
+
+    kwargs = dict(kwargs)
+    if other_file:
+        if other_file not in _other_images:
+            _other_images[other_file] = open_image(other_file)
+        kwargs["other_image"] = _other_images[other_file]
+        kwargs["other_image"].seek(0)
+
+    image = open_image(file_name)
+    result = pipeline(image, **kwargs)
+    if result is not None:
+        image = result
+    header = get_header(image)
+    save_bmp(image, output_file)
+    release_bmp(image)  # (the next file's filters can write into it)
+    return output_file, header.width * header.height / 1e6, time.perf_counter() - start
+
+
+def run_batch(
+    manip_file: str,
+    steps: list[tuple[str, dict]],
+    file_names: typing.Iterable[str],
+    output_dir: str,
+    kwargs: dict,
+    other_file: typing.Optional[str] = None,
+    workers: int = 0,
+    stream: bool = False,
+    report: typing.Callable[[str], None] = print,
+) -> int:
+    """
+    Apply the filters to every file, a few files per worker at a time
+
+    A file whose result would be saved over the result of an earlier one
+    (e.g. files with the same name in different directories) fails instead.
+
+    :param manip_file: Path of the module the filters come from (ImageManip.py)
+    :param steps: List of (filter name, params) steps (see parse_chain)
+    :param file_names: Images to filter (can be a lazy iterable)
+    :param output_dir: Directory to save the results in
+    :param kwargs: Parameters for every filter (color, extra)
+    :param other_file: Image to use as other_image, if any
+    :param workers: Number of processes to use (defaults to one per core)
+    :param stream: Filter BMP files a few rows at a time (when every filter is strip safe)
+    :param report: Called with a line of text for every file and for the summary
+    :returns: Number of files that failed
+    """
+    workers = workers or os.cpu_count() or 1
+    steps = tuple((name, tuple(sorted(params.items()))) for name, params in steps)
+    os.makedirs(output_dir, exist_ok=True)
+
+    done = failed = 0
+    megapixels = 0.0
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        pending = {}
+        file_names = iter(file_names)
+        output_files = set()
+        while True:
+            for file_name in file_names:
+                output_file = os.path.normcase(os.path.abspath(get_output_name(file_name, output_dir)))
+                if output_file in output_files:
+                    failed += 1
+                    report(file_name + ": failed: its result would overwrite that of another file with the same name")
+                    continue
+                output_files.add(output_file)
+                future = pool.submit(process_file, manip_file, steps, file_name, output_dir, kwargs, other_file, stream)
+                pending[future] = file_name
+                if len(pending) >= workers * FILES_PER_WORKER:
+                    break
+            if not pending:
+                break
+            finished, not_finished = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                file_name = pending.pop(future)
+                try:
+                    output_file, file_megapixels, seconds = future.result()
+                except Exception as error:
+                    failed += 1
+                    report(file_name + ": failed: " + repr(error))
+                else:
+                    done += 1
+                    megapixels += file_megapixels
+                    report(f"{file_name} -> {output_file}: {file_megapixels:.2f} MP in {seconds * 1000:.1f} ms")
+
+    elapsed = time.perf_counter() - start
+    report(
+        f"{done} files ({failed} failed), {megapixels:.1f} MP in {elapsed:.2f} s: "
+        f"{done / max(elapsed, 1e-9):.1f} files/s, {megapixels / max(elapsed, 1e-9):.1f} MP/s with {workers} workers"
+    )
+    return failed
+
+
+def main(argv: typing.Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Apply exported PythoShop filters to image files without the GUI")
+    parser.add_argument("inputs", nargs="*", help="image files or glob patterns (quote them)")
+    parser.add_argument("-f", "--filter", dest="chain", action="append", default=[], help='filter to apply, as "name" or "name:extra" (repeat for a chain)')
+    parser.add_argument("-o", "--output", default="output", help="directory for the filtered images (default: output)")
+    parser.add_argument("-c", "--color", default="0,0,0", help="color for the filters, as r,g,b (default: 0,0,0)")
+    parser.add_argument("-e", "--extra", default="", help="extra parameters for the filters that don't have their own")
+    parser.add_argument("--other", help="image to use as the other image (e.g. for blend_other)")
+    parser.add_argument("-j", "--workers", type=int, default=0, help="number of worker processes (default: one per core)")
+    parser.add_argument("--stream", action="store_true", help="filter BMP files a few rows at a time, for files bigger than memory (strip safe filters only)")
+    parser.add_argument("--manip", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "ImageManip.py"), help="module to take the filters from")
+    parser.add_argument("--list", action="store_true", help="list the exported filters and tools and exit")
+    args = parser.parse_args(argv)
+
+    exports = get_exports(load_manip_module(args.manip))
+    if args.list:
+        for name, func in exports.items():
+            print(func.__type__, name)
+        return 0
+    if not args.chain:
+        parser.error("no filter given (use -f, or --list to see them)")
+    try:
+        steps = parse_chain(args.chain, exports)
+        color = tuple(int(value) for value in args.color.split(","))
+    except ValueError as error:
+        parser.error(str(error))
+
+    file_names = (file_name for pattern in args.inputs for file_name in sorted(glob.glob(pattern)) if os.path.isfile(file_name))
+    kwargs = {"color": color, "extra": args.extra}
+    if args.stream and not all(exports[name].__strip_safe__ for name, params in steps):
+        parser.error("--stream only works with strip safe filters")
+    failed = run_batch(args.manip, steps, file_names, args.output, kwargs, args.other, args.workers, args.stream)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
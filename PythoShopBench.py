@@ -0,0 +1,225 @@
+"""PythoShop Bench
+
+Times every exported filter and tool on synthetic images of a few sizes,
+e.g.
+
+    python PythoShopBench.py --save-baseline bench.json
+    python PythoShopBench.py --baseline bench.json
+
+and fails (exit code 1) when something got slower, or needs more memory,
+than in the baseline by more than the threshold.
+"""
+
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+import typing
+
+import numpy as np
+
+from BmpImage import create_bmp, get_pixels
+from PythoShopExports import get_exports, load_manip_module
+
+DEFAULT_SIZES = ((256, 256), (2048, 2048), (8192, 4096))
+
+# Once a function is estimated to take longer than this (per run) at some size, bigger sizes are skipped
+DEFAULT_MAX_SECONDS = 10.0
+
+# Allowed slow down (or growth in peak memory) compared to the baseline before the run fails
+DEFAULT_THRESHOLD = 0.25
+
+
+def make_test_image(width: int, height: int, seed: int = 0) -> io.BytesIO:
+    """
+    Create a BMP (with create_bmp) full of random pixels, so filters don't get an easy all-black image
+
+    :param width: Width of the image
+    :param height: Height of the image
+    :param seed: Seed for the pixels
+    :returns: BytesIO holding the image
+    """
+    image = create_bmp(width, height)
+    pixels = get_pixels(image)
+    rng = np.random.default_rng(seed)
+    for row in range(0, height, 256):  # a band at a time, to not need a second full size copy
+        pixels[row : row + 256] = rng.integers(0, 256, pixels[row : row + 256].shape, dtype=np.uint8)
+    image.seek(0)
+    return image
+
+
+def _get_kwargs(func, width: int, height: int, other_image) -> dict:
+    kwargs = {"color": (200, 100, 50), "extra": "5", "other_image": other_image}
+    if func.__type__ == "tool" or "clicked_coordinate" in func.__wrapped__.__code__.co_varnames:
+        kwargs["clicked_coordinate"] = (width // 2, height // 2)
+    return kwargs
+
+
+def bench_function(func, base_image: io.BytesIO, other_image: io.BytesIO, width: int, height: int, repeat: int, measure_memory: bool = True) -> dict:
+    """
+    Time a function on (fresh copies of) an image
+
+    :param func: Exported filter or tool
+    :param base_image: Image to run it on (it is copied for every run, which isn't timed)
+    :param other_image: Image to hand it as other_image
+    :param width: Width of the image
+    :param height: Height of the image
+    :param repeat: Number of timed runs
+    :param measure_memory: Also do a run under tracemalloc to find the peak memory use
+    :returns: Dictionary with the median seconds, megapixels per second, relative standard deviation and peak bytes
+    """
+    kwargs = _get_kwargs(func, width, height, other_image)
+    times = []
+    for run in range(repeat):
+        image = io.BytesIO(base_image.getbuffer())
+        other_image.seek(0)
+        start = time.perf_counter()
+        func(image, **kwargs)
+        times.append(time.perf_counter() - start)
+
+    peak = None
+    if measure_memory:
+        image = io.BytesIO(base_image.getbuffer())
+        other_image.seek(0)
+        tracemalloc.start()
+        try:
+            func(image, **kwargs)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    median = statistics.median(times)
+    return {
+        "seconds": median,
+        "mp_per_s": width * height / 1e6 / max(median, 1e-9),
+        "rel_stdev": statistics.pstdev(times) / max(statistics.mean(times), 1e-9),
+        "peak_bytes": peak,
+    }
+
+
+def compare_to_baseline(result: dict, baseline: typing.Optional[dict], threshold: float) -> list[str]:
+    """
+    :returns: List of the ways the result is worse than the baseline by more than the threshold (empty if it isn't)
+    """
+    if not baseline:
+        return []
+    problems = []
+    if result["mp_per_s"] < baseline["mp_per_s"] * (1 - threshold):
+        problems.append(f"{result['mp_per_s']:.1f} MP/s, was {baseline['mp_per_s']:.1f}")
+    if result["peak_bytes"] is not None and baseline.get("peak_bytes") is not None:
+        # (a bit of slack for tiny images where a few kB of bookkeeping dominate)
+        if result["peak_bytes"] > baseline["peak_bytes"] * (1 + threshold) + 64 * 1024:
+            problems.append(f"peak {result['peak_bytes'] / 2**20:.1f} MiB, was {baseline['peak_bytes'] / 2**20:.1f}")
+    return problems
+
+
+def run_bench(
+    exports: dict,
+    sizes: typing.Iterable[tuple[int, int]] = DEFAULT_SIZES,
+    repeat: int = 5,
+    max_seconds: float = DEFAULT_MAX_SECONDS,
+    measure_memory: bool = True,
+    baseline: typing.Optional[dict] = None,
+    threshold: float = DEFAULT_THRESHOLD,
+    report: typing.Callable[[str], None] = print,
+) -> tuple[dict, list[str]]:
+    """
+    Benchmark every exported function at every size
+
+    :param exports: Functions to benchmark (see PythoShopExports.get_exports)
+    :param sizes: (width, height) of the images to use, smallest first
+    :param repeat: Number of timed runs per function and size
+    :param max_seconds: Skip a size once a function is estimated to take longer than this per run
+    :param measure_memory: Also measure the peak memory use (in an extra run)
+    :param baseline: Results of an earlier run to compare to
+    :param threshold: Allowed slow down (as a fraction) compared to the baseline
+    :param report: Called with a line of text per result
+    :returns: (results keyed by "name@WIDTHxHEIGHT", list of regressions)
+    """
+    results = {}
+    regressions = []
+    seconds_per_pixel = {}  # slowest seen so far, to guess whether the next size is affordable (None once it failed)
+    report(f"{'function':<26}{'size':>11}{'ms':>11}{'MP/s':>10}{'stdev':>8}{'peak MiB':>10}")
+    for width, height in sizes:
+        base_image = make_test_image(width, height, seed=0)
+        other_image = make_test_image(width, height, seed=1)
+        for name, func in exports.items():
+            key = f"{name}@{width}x{height}"
+            if seconds_per_pixel.get(name) is None and name in seconds_per_pixel:
+                report(f"{name:<26}{width:>5}x{height:<5} skipped (failed on a smaller image)")
+                continue
+            if (seconds_per_pixel.get(name) or 0) * width * height > max_seconds:
+                report(f"{name:<26}{width:>5}x{height:<5} skipped (would take over {max_seconds:g} s)")
+                continue
+            # compile lookup tables and the like before timing anything
+            warm_up = make_test_image(16, 16)
+            try:
+                func(warm_up, **_get_kwargs(func, 16, 16, make_test_image(16, 16)))
+                result = bench_function(func, base_image, other_image, width, height, repeat, measure_memory)
+            except Exception as error:
+                report(f"{name:<26}{width:>5}x{height:<5} failed: {error!r}")
+                seconds_per_pixel[name] = None
+                continue
+            seconds_per_pixel[name] = max(seconds_per_pixel.get(name, 0), result["seconds"] / (width * height))
+            results[key] = result
+
+            peak = "-" if result["peak_bytes"] is None else f"{result['peak_bytes'] / 2**20:.1f}"
+            line = f"{name:<26}{width:>5}x{height:<5}{result['seconds'] * 1000:>11.2f}{result['mp_per_s']:>10.1f}{result['rel_stdev']:>8.1%}{peak:>10}"
+            problems = compare_to_baseline(result, (baseline or {}).get(key), threshold)
+            if problems:
+                regressions.append(key + ": " + ", ".join(problems))
+                line += "  REGRESSION: " + ", ".join(problems)
+            report(line)
+    return results, regressions
+
+
+def _parse_size(text: str) -> tuple[int, int]:
+    width, separator, height = text.lower().partition("x")
+    return int(width), int(height or width)
+
+
+def main(argv: typing.Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the exported PythoShop filters and tools")
+    parser.add_argument("names", nargs="*", help="only benchmark these functions (default: all of them)")
+    parser.add_argument("-s", "--size", dest="sizes", action="append", type=_parse_size, help="image size as WIDTHxHEIGHT (repeat for several, default: 256x256, 2048x2048 and 8192x4096)")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="timed runs per function and size (default: 5)")
+    parser.add_argument("--max-seconds", type=float, default=DEFAULT_MAX_SECONDS, help="skip sizes a function would take longer than this on")
+    parser.add_argument("--no-memory", action="store_true", help="don't measure peak memory (saves a run per function and size)")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare to")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="allowed slow down compared to the baseline (default: 0.25)")
+    parser.add_argument("--save-baseline", help="write the results to this JSON file")
+    parser.add_argument("--manip", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "ImageManip.py"), help="module to take the functions from")
+    args = parser.parse_args(argv)
+
+    exports = get_exports(load_manip_module(args.manip))
+    if args.names:
+        unknown = set(args.names) - set(exports)
+        if unknown:
+            parser.error("not exported: " + ", ".join(sorted(unknown)))
+        exports = {name: func for name, func in exports.items() if name in args.names}
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+
+    sizes = sorted(args.sizes or DEFAULT_SIZES, key=lambda size: size[0] * size[1])
+    results, regressions = run_bench(exports, sizes, args.repeat, args.max_seconds, not args.no_memory, baseline, args.threshold)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as file:
+            json.dump({"python": sys.version.split()[0], "cpus": os.cpu_count(), "results": results}, file, indent=2, sort_keys=True)
+    if regressions:
+        print(str(len(regressions)) + " regression(s):")
+        for regression in regressions:
+            print("  " + regression)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,28 +5,179 @@ from ImageManip.py into the PythoShop GUI application.
 """
 
 import functools
+import importlib.util
 from PIL import Image
 
-def export_filter(func):
+import ExportStats
+from BmpImage import (
+    IDENTITY_LUT,
+    IDENTITY_ORDER,
+    PALETTE_BPP,
+    apply_lut,
+    compile_channel_order,
+    compile_lut,
+    convert_to_24_bit,
+    filter_palette,
+    get_header,
+    mark_changed,
+)
+
+def _is_indexed(image):
+    return image is not None and get_header(image).bpp in PALETTE_BPP
+
+def _run_on_24_bit(func, image, *args, **kwargs):
+    """
+    Run a filter or tool that needs real pixels on an indexed image (or with
+    an indexed other_image), by running it on 24-bit copies
+
+    :returns: The 24-bit image the function changed (or the one it returned)
+    """
+    if _is_indexed(kwargs.get("other_image")):
+        kwargs["other_image"] = convert_to_24_bit(kwargs["other_image"])
+    if _is_indexed(image):
+        image = convert_to_24_bit(image)
+        result = func(image, *args, **kwargs)
+        return image if result is None else result
+    return func(image, *args, **kwargs)
+
+def export_filter(func=None, *, point_op=False, channel_op=False, pixel_op=False, strip_safe=False):
     """Decorator
     describes a function that will be called on an image 
     *as a whole* immediately when the user selects it.
+
+    Use `@export_filter(point_op=True)` for filters where each channel of a
+    pixel only depends on the same channel before the filter ran (and not on
+    color or extra). The filter then only runs once, on a 256 pixel probe, to
+    build a lookup table that is cached and applied to the whole image in C.
+
+    Use `@export_filter(channel_op=True)` for filters that only swap the
+    channels of every pixel around. The filter then only runs once, on a one
+    pixel probe, to find out which channel goes where.
+
+    Use `@export_filter(pixel_op=True)` for filters where each pixel only
+    depends on the same pixel before the filter ran (e.g. on all three of its
+    channels), but not on where it is in the image. On indexed (palette)
+    images the filter then only runs on the colors of the palette (see
+    BmpImage.filter_palette); point and channel ops are pixel ops too.
+    Other filters run on a 24-bit copy of an indexed image, which they
+    return.
+
+    Use `@export_filter(strip_safe=True)` for filters where each row of the
+    result only depends on the same row before the filter ran (and not on
+    where that row is in the image), so the image can be cut into horizontal
+    strips that are filtered in parallel (see StripExecutor). Point, channel
+    and pixel ops are always strip safe.
+
+    Calls are timed and counted when stats are enabled (see ExportStats).
     """
+    if func is None:
+        return functools.partial(export_filter, point_op=point_op, channel_op=channel_op, pixel_op=pixel_op, strip_safe=strip_safe)
+
     func.__type__ = "filter"
     func.__return_type__ = None
+    func.__point_op__ = point_op
+    func.__channel_op__ = channel_op
+    func.__pixel_op__ = pixel_op or point_op or channel_op
+    func.__strip_safe__ = strip_safe or func.__pixel_op__
+    def run(image, *args, **kwargs):
+        if point_op or channel_op:
+            order, lut = get_color_map(wrapper, *args, **kwargs)
+            apply_lut(image, lut, order)  # (only changes the palette of indexed images)
+            return None
+        if pixel_op and _is_indexed(image):
+            filter_palette(func, image, *args, **kwargs)
+            return None
+        return _run_on_24_bit(func, image, *args, **kwargs)
     @functools.wraps(func)
     def wrapper(image, *args, **kwargs):
-        return func(image, *args, **kwargs)
+        try:
+            if ExportStats.stats_enabled():
+                return ExportStats.call_with_stats(func, run, image, *args, **kwargs)
+            return run(image, *args, **kwargs)
+        finally:
+            mark_changed(image)  # whatever was cached about its pixels is out of date
+    wrapper.__color_map__ = None
     return wrapper
 
-def export_tool(func):
+def get_color_map(filter_func, *args, **kwargs):
+    """
+    Get the (order, lut) color map a point_op or channel_op filter boils
+    down to (see BmpImage.compose_color_maps), compiling it the first time.
+
+    :param filter_func: Exported filter
+    :returns: The color map, or None if the filter isn't a point or channel op
+    """
+    if not (filter_func.__point_op__ or filter_func.__channel_op__):
+        return None
+    if filter_func.__color_map__ is None:
+        if filter_func.__point_op__:
+            filter_func.__color_map__ = (IDENTITY_ORDER, compile_lut(filter_func.__wrapped__, *args, **kwargs))
+        else:
+            filter_func.__color_map__ = (compile_channel_order(filter_func.__wrapped__, *args, **kwargs), IDENTITY_LUT)
+    return filter_func.__color_map__
+
+def export_tool(func=None, *, interpolate=False):
     """Decorator 
     describes a function that will get selected and then called 
     once the user clicks on a specific position on the image.
+
+    Use `@export_tool(interpolate=True)` for brush-like tools that only
+    paint around the clicked pixel. Dragging such a tool applies it to every
+    pixel along the drag, so the stroke has no gaps; other tools are only
+    applied to the latest pixel the drag reached in each frame.
+
+    Tools change the image in place, so they must announce each part of it
+    before changing it and mark it once it is changed (see
+    BmpImage.mark_changing and BmpImage.mark_dirty): changes that weren't
+    announced can't be undone (UndoHistory warns about them). Drawing does
+    both.
+
+    Calls are timed and counted when stats are enabled (see ExportStats).
     """
+    if func is None:
+        return functools.partial(export_tool, interpolate=interpolate)
+
     func.__type__ = "tool"
     func.__return_type__ = None
+    func.__interpolate__ = interpolate
+    func.__point_op__ = False
+    func.__channel_op__ = False
+    func.__pixel_op__ = False
+    func.__strip_safe__ = False
+    run = functools.partial(_run_on_24_bit, func)
     @functools.wraps(func)
     def wrapper(image, clicked_coordinate, *args, **kwargs):
-        return func(image, clicked_coordinate, *args, **kwargs)
-    return wrapper
\ No newline at end of file
+        try:
+            if ExportStats.stats_enabled():
+                return ExportStats.call_with_stats(func, run, image, clicked_coordinate, *args, **kwargs)
+            return run(image, clicked_coordinate, *args, **kwargs)
+        finally:
+            mark_changed(image)  # whatever was cached about its pixels is out of date
+    return wrapper
+
+def load_manip_module(file_name, module_name="ImageManip"):
+    """
+    Load (or reload) a module of exported functions straight from its file
+
+    :param file_name: Path of the python file, e.g. ImageManip.py
+    :param module_name: Name to give the module
+    :returns: The module (raises SyntaxError if the file has one)
+    """
+    spec = importlib.util.spec_from_file_location(module_name, file_name)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def get_exports(module):
+    """
+    Find the functions a module exports with export_filter or export_tool
+
+    :param module: Module to look in (e.g. ImageManip)
+    :returns: Dictionary of name -> exported function, sorted by name
+    """
+    exports = {}
+    for attribute in dir(module):
+        thing = getattr(module, attribute)
+        if callable(thing) and hasattr(thing, "__wrapped__") and hasattr(thing, "__type__"):
+            exports[attribute] = thing
+    return exports
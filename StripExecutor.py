@@ -0,0 +1,280 @@
+"""PythoShop Strip Executor
+
+Runs strip safe filters on several cores at once by cutting the image
+into horizontal strips that live in shared memory, so no pixel data is
+ever pickled between processes.
+
+Strip safe filters can also be run straight from one BMP file to another
+a few rows at a time (see filter_file), for images too big for memory.
+"""
+
+import concurrent.futures
+import importlib
+import io
+import multiprocessing
+import os
+import sys
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from BmpImage import HEADER_BYTES, PIXEL_BPP, BmpHeader, BufferImage, get_header, mark_dirty
+
+# Images with fewer pixels than this aren't worth sending to other processes
+STRIP_MIN_PIXELS = 2_000_000
+
+# Number of strips a filter is cut into (at least) when its progress is wanted
+PROGRESS_STEPS = 32
+
+# (Roughly) how many bytes of rows filter_file holds in memory at once
+STREAM_CHUNK_BYTES = 4 * 1024 * 1024
+
+_pool = None
+_pool_workers = 0
+
+
+class FilterCancelled(Exception):
+    pass
+
+
+def _get_pool(workers: int) -> concurrent.futures.ProcessPoolExecutor:
+    """
+    Get the (lazily started) pool of worker processes
+
+    :param workers: Number of worker processes wanted
+    :returns: ProcessPoolExecutor with that many workers
+    """
+    global _pool, _pool_workers
+    if _pool is None or _pool_workers != workers:
+        if _pool is not None:
+            _pool.shutdown()
+        # fork where we can: spawned workers would re-import the (Kivy) main module
+        start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+        _pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context(start_method))
+        _pool_workers = workers
+    return _pool
+
+
+def plan_strips(height: int, count: int) -> list[tuple[int, int]]:
+    """
+    Cut the rows of an image into (nearly) equal strips
+
+    :param height: Number of rows in the image
+    :param count: Number of strips wanted
+    :returns: List of (first row, end row) pairs
+    """
+    count = max(1, min(count, height))
+    bounds = [height * i // count for i in range(count + 1)]
+    return [(bounds[i], bounds[i + 1]) for i in range(count)]
+
+
+def _importable(func) -> bool:
+    """
+    Whether worker processes can find a function by its module and name
+    (a FilterPipeline, for one, can't be found that way)
+    """
+    return getattr(sys.modules.get(getattr(func, "__module__", None)), getattr(func, "__name__", ""), None) is not None
+
+
+def _run_strip(shm_name: str, offset: int, size: int, module_name: str, func_name: str, kwargs: dict) -> None:
+    """
+    Worker side: run a filter on one strip (a complete little BMP) in shared memory
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        strip = BufferImage(shm.buf[offset : offset + size])
+        func = getattr(importlib.import_module(module_name), func_name)
+        func(strip, **kwargs)
+        strip.close()
+    finally:
+        shm.close()
+
+
+def _mark_rows(image, header: BmpHeader, first_row: int, end_row: int) -> None:
+    """
+    Record that some rows (in file order) of an image were written back from
+    strips, so whatever was cached about its pixels is worked out again
+    """
+    if header.top_down:  # (mark_dirty counts rows from the bottom)
+        first_row, end_row = header.height - end_row, header.height - first_row
+    mark_dirty(image, 0, first_row, header.width, end_row)
+
+
+def _filter_rows(func, image, header: BmpHeader, first_row: int, end_row: int, kwargs: dict) -> None:
+    """
+    Run a filter on some rows of an image in this process, through a little
+    BMP (with a create_bmp style header) holding a copy of just those rows
+    """
+    strip_header = BmpHeader.new(header.width, end_row - first_row, header.bpp)
+    strip = io.BytesIO(strip_header.raw)
+    strip.seek(strip_header.fpp)
+    rows_start = header.fpp + first_row * header.row_size
+    rows_end = header.fpp + end_row * header.row_size
+    strip.write(image.getbuffer()[rows_start:rows_end])
+    strip.seek(0)
+    func(strip, **kwargs)
+    image.getbuffer()[rows_start:rows_end] = strip.getbuffer()[strip_header.fpp :]
+    _mark_rows(image, header, first_row, end_row)
+
+
+def run_in_strips(func, image, workers: int = 0, progress=None, cancel=None, **kwargs):
+    """
+    Run a filter on an image, in parallel strips if the filter is strip safe
+    and the image is big enough for it to pay off
+
+    Each strip is copied once into shared memory as a BMP of its own (with a
+    create_bmp style header) so the filter can run on it unchanged, and
+    copied back once every strip is done.
+
+    When asked for progress (or to be cancellable) a strip safe filter is run
+    a strip at a time even when it doesn't go to other processes, so that
+    there is something to report and somewhere to stop.  Other filters can
+    only report that they are done and can't be stopped half way.
+
+    :param func: Exported filter to run
+    :param image: BytesIO (or other image buffer) holding the BMP image
+    :param workers: Number of processes to use (defaults to one per core)
+    :param progress: Optional callback taking (rows done, total rows)
+    :param cancel: Optional threading.Event; once it is set no more strips are
+        started and FilterCancelled is raised (the image may then be half done)
+    :param kwargs: Parameters for the filter (color, extra...)
+    :returns: Whatever the filter returns (always None when run in strips)
+    """
+    workers = workers or os.cpu_count() or 1
+    header = get_header(image)
+    # (strips get an uncompressed create_bmp style header, which is only laid out the same for these)
+    strip_safe = getattr(func, "__strip_safe__", False) and header.bpp in PIXEL_BPP and header.compression == 0
+    parallel = strip_safe and workers >= 2 and header.width * header.height >= STRIP_MIN_PIXELS and _importable(func)
+    in_steps = strip_safe and (progress is not None or cancel is not None)
+
+    if not parallel and not in_steps:
+        image.seek(0)
+        result = func(image, **kwargs)
+        if progress is not None:
+            progress(header.height, header.height)
+        return result
+
+    # other images (and anything else that isn't simple data) stay in this process
+    kwargs = {key: value for key, value in kwargs.items() if key != "other_image"}
+    strip_count = max(workers, PROGRESS_STEPS) if in_steps else workers
+    if not parallel:
+        for first_row, end_row in plan_strips(header.height, strip_count):
+            if cancel is not None and cancel.is_set():
+                raise FilterCancelled(func.__name__ + " was cancelled")
+            _filter_rows(func, image, header, first_row, end_row, kwargs)
+            if progress is not None:
+                progress(end_row, header.height)
+        image.seek(0)
+        return None
+
+    strips = []
+    total_size = 0
+    for first_row, end_row in plan_strips(header.height, strip_count):
+        strip_header = BmpHeader.new(header.width, end_row - first_row, header.bpp)
+        strips.append((first_row, end_row, total_size, strip_header))
+        total_size += strip_header.file_size
+
+    shm = shared_memory.SharedMemory(create=True, size=total_size)
+    shared = None
+    try:
+        shared = np.ndarray(total_size, dtype=np.uint8, buffer=shm.buf)
+        source = np.frombuffer(image.getbuffer(), dtype=np.uint8)
+        for first_row, end_row, offset, strip_header in strips:
+            shared[offset : offset + len(strip_header.raw)] = np.frombuffer(strip_header.raw, dtype=np.uint8)
+            rows = source[header.fpp + first_row * header.row_size : header.fpp + end_row * header.row_size]
+            shared[offset + strip_header.fpp : offset + strip_header.file_size] = rows
+
+        pool = _get_pool(workers)
+        futures = {
+            pool.submit(_run_strip, shm.name, offset, strip_header.file_size, func.__module__, func.__name__, kwargs): end_row - first_row
+            for first_row, end_row, offset, strip_header in strips
+        }
+        rows_done = 0
+        pending = set(futures)
+        while pending:
+            done, pending = concurrent.futures.wait(pending, timeout=0.1, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                future.result()
+                rows_done += futures[future]
+            if done and progress is not None:
+                progress(rows_done, header.height)
+            if pending and cancel is not None and cancel.is_set():
+                for future in pending:
+                    future.cancel()
+                # strips already running still use the shared memory, let them finish
+                concurrent.futures.wait(pending)
+                raise FilterCancelled(func.__name__ + " was cancelled")
+
+        for first_row, end_row, offset, strip_header in strips:
+            rows = source[header.fpp + first_row * header.row_size : header.fpp + end_row * header.row_size]
+            rows[:] = shared[offset + strip_header.fpp : offset + strip_header.file_size]
+        _mark_rows(image, header, 0, header.height)
+    finally:
+        shared = None  # the shared memory can't be closed while numpy still points into it
+        shm.close()
+        shm.unlink()
+    image.seek(0)
+    return None
+
+
+def filter_file(func, source_name: str, destination_name: str, chunk_bytes: int = STREAM_CHUNK_BYTES, progress=None, cancel=None, **kwargs) -> BmpHeader:
+    """
+    Run a strip safe filter from one BMP file to another without ever having
+    the whole image in memory
+
+    The rows are read a chunk at a time into a little BMP (with a create_bmp
+    style header), filtered, and written out, so memory use stays at about
+    chunk_bytes however big the image is.  The destination gets a create_bmp
+    style header and is always stored bottom up.
+
+    :param func: Exported strip safe filter (or FilterPipeline of them) to run
+    :param source_name: Path of the 24 or 32-bit BMP file to filter
+    :param destination_name: Path of the BMP file to write (it can't be the source)
+    :param chunk_bytes: (Roughly) how many bytes of rows to filter at once
+    :param progress: Optional callback taking (rows done, total rows)
+    :param cancel: Optional threading.Event; once it is set FilterCancelled is
+        raised (the destination is then only partly written)
+    :param kwargs: Parameters for the filter (color, extra...)
+    :returns: The header written to the destination
+    """
+    if not getattr(func, "__strip_safe__", False):
+        raise ValueError(func.__name__ + " isn't strip safe so it can't be run on a file a few rows at a time")
+    kwargs = {key: value for key, value in kwargs.items() if key != "other_image"}
+
+    with open(source_name, "rb") as source, open(destination_name, "wb") as destination:
+        header = BmpHeader(source.read(HEADER_BYTES))
+        if header.raw[:2] != b"BM" or header.bpp not in PIXEL_BPP or header.compression != 0:
+            raise ValueError(source_name + " isn't an uncompressed 24 or 32-bit BMP")
+        new_header = BmpHeader.new(header.width, header.height, header.bpp)
+        destination.write(new_header.raw + bytes(new_header.fpp - len(new_header.raw)))
+        destination.truncate(new_header.file_size)  # (sparse until the rows are written)
+        rows_per_chunk = max(1, chunk_bytes // header.row_size)
+
+        strip = None
+        for first_row, end_row in plan_strips(header.height, -(-header.height // rows_per_chunk)):
+            if cancel is not None and cancel.is_set():
+                raise FilterCancelled(func.__name__ + " was cancelled")
+            rows = end_row - first_row
+            if strip is None or strip_header.height != rows:
+                strip_header = BmpHeader.new(header.width, rows, header.bpp)
+                strip = io.BytesIO(strip_header.raw + bytes(strip_header.file_size - len(strip_header.raw)))
+            source.seek(header.fpp + first_row * header.row_size)
+            view = strip.getbuffer()
+            source.readinto(view[strip_header.fpp :])
+            view.release()
+
+            strip.seek(0)
+            result = func(strip, **kwargs)
+            filtered = strip if result is None else result
+            data = filtered.getbuffer()[strip_header.fpp :]
+            if header.top_down:
+                # these rows are stored top down in the source, but bottom up in the destination
+                destination.seek(new_header.fpp + (header.height - end_row) * header.row_size)
+                destination.write(np.frombuffer(data, dtype=np.uint8).reshape(rows, header.row_size)[::-1].tobytes())
+            else:
+                destination.seek(new_header.fpp + first_row * header.row_size)
+                destination.write(data)
+            del data
+            if progress is not None:
+                progress(end_row, header.height)
+    return new_header
@@ -0,0 +1,293 @@
+"""PythoShop Undo History
+
+Undo and redo for an image that only remembers the tiles each operation
+actually changed, rather than a copy of the whole image per step.
+"""
+
+import collections
+import typing
+import warnings
+
+import numpy as np
+
+from BmpImage import PALETTE_BPP, can_view_pixels, get_header, get_indices, get_palette, get_pixels, mark_changed, mark_dirty, release_bmp
+
+# Width and height (in pixels) of the tiles changes are remembered in
+TILE_SIZE = 64
+
+# How much memory the undo and redo steps may use together before the oldest steps are forgotten
+DEFAULT_MEMORY_CAP = 256 * 1024 * 1024
+
+
+class _TileStep:
+    """A step that changed some tiles of the image in place"""
+
+    def __init__(self, tiles: list[tuple[int, int, np.ndarray]]) -> None:
+        self.tiles = tiles  # (bottom, left, pixels the tile had) for each tile
+        self.nbytes = sum(pixels.nbytes for bottom, left, pixels in tiles)
+
+
+class _PaletteStep:
+    """A step that changed the palette of an indexed image"""
+
+    def __init__(self, palette: np.ndarray) -> None:
+        self.palette = palette  # the colors the palette had
+        self.nbytes = palette.nbytes
+
+
+class _ImageStep:
+    """A step that replaced the image by one of a different size (or kind)"""
+
+    def __init__(self, image) -> None:
+        self.image = image  # the image buffer that was replaced
+        self.nbytes = len(image.getbuffer())
+
+
+def _changed_tiles(old_pixels: np.ndarray, pixels: np.ndarray, dirty: typing.Optional[tuple[int, int, int, int]]) -> list:
+    """
+    Compare the pixels of an image before and after an operation, tile by tile
+
+    :param old_pixels: (height, width, channels) pixels before
+    :param pixels: The same pixels after
+    :param dirty: Rectangle outside of which nothing changed, None for all of it
+    :returns: (bottom, left, copy of the old pixels) of each tile that changed
+    """
+    height, width = pixels.shape[:2]
+    left, bottom, right, top = dirty or (0, 0, width, height)
+    left -= left % TILE_SIZE
+    tiles = []
+    if right <= left:
+        return tiles  # nothing changed
+    for tile_bottom in range(bottom - bottom % TILE_SIZE, top, TILE_SIZE):
+        tile_top = min(height, tile_bottom + TILE_SIZE)
+        band = np.s_[tile_bottom:tile_top, left:right]
+        changed_columns = np.any(pixels[band] != old_pixels[band], axis=(0, 2))
+        changed_tiles = np.logical_or.reduceat(changed_columns, np.arange(0, right - left, TILE_SIZE))
+        for tile in np.flatnonzero(changed_tiles):
+            tile_left = left + int(tile) * TILE_SIZE
+            area = np.s_[tile_bottom:tile_top, tile_left : min(width, tile_left + TILE_SIZE)]
+            tiles.append((tile_bottom, tile_left, old_pixels[area].copy()))
+    return tiles
+
+
+def _all_saved(saved: dict, dirty: tuple[int, int, int, int]) -> bool:
+    """Whether every tile of a dirty rectangle was saved before it changed"""
+    left, bottom, right, top = dirty
+    return all(
+        (tile_bottom, tile_left) in saved
+        for tile_bottom in range(bottom - bottom % TILE_SIZE, top, TILE_SIZE)
+        for tile_left in range(left - left % TILE_SIZE, right, TILE_SIZE)
+    )
+
+
+class UndoHistory:
+    """
+    Undo and redo for one image
+
+    The history never copies the whole image.  Operations that return a new
+    image buffer are compared with the old one, tile by tile inside their
+    dirty rectangle, and only the old contents of the tiles that changed are
+    kept.  Operations that change the image in place announce what they are
+    about to change (see BmpImage.mark_changing), and the tiles they touch
+    are saved just before that; once the operation is recorded only the ones
+    that really changed are kept.  For indexed images whose indices an
+    operation left alone (pixel filters only change the palette, see
+    BmpImage.filter_palette), in place or in a new buffer, only a copy of the
+    palette is kept.  Operations that change the size of the image, or its
+    kind (e.g. turn an indexed image into a 24-bit one), keep the whole old
+    image.
+
+    Steps (and tiles saved for an operation that isn't recorded yet) are
+    forgotten oldest first once they use more than `memory_cap` bytes, but
+    the last step is always kept, even if it is bigger than that on its own.
+    Image buffers the history lets go of are given back for reuse (see
+    BmpImage.release_bmp).
+    """
+
+    def __init__(self, memory_cap: int = DEFAULT_MEMORY_CAP) -> None:
+        self.memory_cap = memory_cap
+        self._image = None
+        self._palette: typing.Optional[np.ndarray] = None  # copy of the palette of an indexed image
+        self._saved: dict = {}  # (bottom, left) -> pixels a tile had before the operation being done
+        self._undo_steps: collections.deque = collections.deque()
+        self._redo_steps: list = []
+
+    @property
+    def memory_used(self) -> int:
+        steps = sum(step.nbytes for step in self._undo_steps) + sum(step.nbytes for step in self._redo_steps)
+        return steps + sum(pixels.nbytes for pixels in self._saved.values())
+
+    def can_undo(self) -> bool:
+        return bool(self._undo_steps)
+
+    def can_redo(self) -> bool:
+        return bool(self._redo_steps)
+
+    def reset(self, image) -> None:
+        """
+        Forget everything and start over from a (newly loaded) image
+
+        :param image: Image buffer as it is now
+        :returns: None
+        """
+        self._undo_steps.clear()
+        self._redo_steps.clear()
+        self._track(image)
+
+    def _track(self, image) -> None:
+        """Start following the changes announced for an image (instead of the previous one)"""
+        if self._image is not None:
+            self._image._bmp_before_change = None
+        self._image = image
+        self._saved = {}
+        self._palette = get_palette(image).copy() if get_header(image).bpp in PALETTE_BPP else None
+        if can_view_pixels(image):
+            image._bmp_before_change = self._save_tiles
+
+    def _save_tiles(self, left: int, bottom: int, right: int, top: int) -> None:
+        """Save the tiles of a rectangle of the image that are about to change (see BmpImage.mark_changing)"""
+        pixels = get_pixels(self._image, alpha=True)
+        for tile_bottom in range(bottom - bottom % TILE_SIZE, top, TILE_SIZE):
+            for tile_left in range(left - left % TILE_SIZE, right, TILE_SIZE):
+                if (tile_bottom, tile_left) not in self._saved:
+                    tile = pixels[tile_bottom : tile_bottom + TILE_SIZE, tile_left : tile_left + TILE_SIZE]
+                    self._saved[tile_bottom, tile_left] = tile.copy()
+
+    def _same_indices(self, image) -> bool:
+        """Whether an indexed image only differs from the one followed by the colors of its palette"""
+        if image is self._image:
+            return get_palette(image).shape == self._palette.shape
+        header, old_header = get_header(image), get_header(self._image)
+        if header.bpp != old_header.bpp or (header.width, header.height) != (old_header.width, old_header.height):
+            return False
+        return get_palette(image).shape == self._palette.shape and np.array_equal(get_indices(image), get_indices(self._image))
+
+    def record(self, image, dirty: typing.Optional[tuple[int, int, int, int]] = None, merge: bool = False) -> None:
+        """
+        Remember what an operation changed (call it after every operation)
+
+        :param image: Image buffer after the operation (the same one changed in place, or a new one)
+        :param dirty: Rectangle outside of which the operation changed nothing (see BmpImage.mark_dirty), None for all of it
+        :param merge: Add the changes to the last step rather than making a new one (e.g. for the rest of a drag)
+        :returns: None
+        """
+        bpp = get_header(image).bpp
+        if self._image is None or (not can_view_pixels(image) and bpp not in PALETTE_BPP):
+            self.reset(image)
+            return
+        self._clear_redo()
+        saved, self._saved = self._saved, {}
+
+        if self._palette is not None and self._same_indices(image):
+            palette = get_palette(image)
+            if (palette != self._palette).any():
+                self._push(_PaletteStep(self._palette))
+            if image is not self._image:
+                old_image = self._image
+                self._track(image)
+                release_bmp(old_image)
+            self._palette = palette.copy()
+            return
+
+        if not (can_view_pixels(self._image) and can_view_pixels(image)):
+            self._push(_ImageStep(self._image))
+            self._track(image)
+            return
+        old_pixels, pixels = get_pixels(self._image, alpha=True), get_pixels(image, alpha=True)
+        if pixels.shape != old_pixels.shape:
+            self._push(_ImageStep(self._image))
+            self._track(image)
+            return
+
+        if image is self._image:
+            if dirty is not None and not _all_saved(saved, dirty):
+                warnings.warn(
+                    "pixels were changed in place without being announced first (see BmpImage.mark_changing), that change can't be undone",
+                    stacklevel=2,
+                )
+            # only the tiles saved before the operation can have changed
+            tiles = []
+            for (tile_bottom, tile_left), old in sorted(saved.items()):
+                area = np.s_[tile_bottom : tile_bottom + old.shape[0], tile_left : tile_left + old.shape[1]]
+                if (pixels[area] != old).any():
+                    tiles.append((tile_bottom, tile_left, old))
+        else:
+            # a new buffer of the same size: the old one is what it was like before
+            tiles = _changed_tiles(old_pixels, pixels, dirty)
+            del old_pixels
+            old_image = self._image
+            self._track(image)
+            release_bmp(old_image)
+
+        if merge and self._undo_steps and isinstance(self._undo_steps[-1], _TileStep):
+            last = self._undo_steps.pop()
+            # the last step already knows what those tiles were like before it
+            known = {(bottom, left) for bottom, left, old in last.tiles}
+            tiles = last.tiles + [tile for tile in tiles if tile[:2] not in known]
+        if tiles:
+            self._push(_TileStep(tiles))
+
+    def undo(self):
+        """
+        Undo the last step
+
+        :returns: The image buffer to display (the changed tiles are marked dirty), None if there was nothing to undo
+        """
+        if not self._undo_steps:
+            return None
+        inverse = self._apply(self._undo_steps.pop())
+        self._redo_steps.append(inverse)
+        return self._image
+
+    def redo(self):
+        """
+        Redo the last undone step
+
+        :returns: The image buffer to display (the changed tiles are marked dirty), None if there was nothing to redo
+        """
+        if not self._redo_steps:
+            return None
+        inverse = self._apply(self._redo_steps.pop())
+        self._push(inverse, clear_redo=False)
+        return self._image
+
+    def _apply(self, step):
+        """Put back what a step remembers, returning the step that would put it back again"""
+        self._saved = {}  # (anything changed since the last record is overwritten or out of reach)
+        if isinstance(step, _ImageStep):
+            inverse = _ImageStep(self._image)
+            self._track(step.image)
+            return inverse
+        if isinstance(step, _PaletteStep):
+            palette = get_palette(self._image)
+            inverse = _PaletteStep(palette.copy())
+            palette[...] = step.palette
+            self._palette = step.palette
+            mark_changed(self._image)
+            return inverse
+
+        pixels = get_pixels(self._image, alpha=True)
+        swapped = []
+        for bottom, left, old in step.tiles:
+            area = np.s_[bottom : bottom + old.shape[0], left : left + old.shape[1]]
+            swapped.append((bottom, left, pixels[area].copy()))
+            pixels[area] = old
+            mark_dirty(self._image, left, bottom, left + old.shape[1], bottom + old.shape[0])
+        return _TileStep(swapped)
+
+    def _push(self, step, clear_redo: bool = True) -> None:
+        self._undo_steps.append(step)
+        if clear_redo:
+            self._clear_redo()
+        # (never the step just pushed: one bigger than the cap is kept as the only one)
+        while len(self._undo_steps) > 1 and self.memory_used > self.memory_cap:
+            self._forget(self._undo_steps.popleft())
+
+    def _clear_redo(self) -> None:
+        for step in self._redo_steps:
+            self._forget(step)
+        self._redo_steps.clear()
+
+    def _forget(self, step) -> None:
+        if isinstance(step, _ImageStep):
+            release_bmp(step.image)
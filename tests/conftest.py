@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from BmpImage import create_bmp, get_pixels
+
+
+@pytest.fixture
+def gray_image():
+    """Make 24 (or 32) bit images whose channels all have one value"""
+
+    def make(value, width=64, height=48, bpp=24):
+        image = create_bmp(width, height, bpp)
+        get_pixels(image)[...] = value
+        return image
+
+    return make
+
+
+@pytest.fixture
+def noisy_image():
+    """Make 24 (or 32) bit images of random (but always the same) pixels"""
+
+    def make(width=64, height=48, bpp=24, seed=0):
+        image = create_bmp(width, height, bpp)
+        pixels = get_pixels(image, alpha=True)
+        pixels[...] = np.random.default_rng(seed).integers(0, 256, size=pixels.shape, dtype=np.uint8)
+        return image
+
+    return make
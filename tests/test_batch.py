@@ -0,0 +1,44 @@
+import os
+
+from PIL import Image
+
+from BmpImage import get_pixels, open_bmp
+from PythoShopBatch import get_output_name, run_batch
+
+MANIP_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ImageManip.py")
+
+
+def _save(file_name, value):
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    Image.new("RGB", (8, 4), (value, value, value)).save(file_name)
+
+
+def test_output_keeps_the_extension_of_other_files():
+    assert get_output_name(os.path.join("scans", "a.bmp"), "out") == os.path.join("out", "a.bmp")
+    assert get_output_name(os.path.join("scans", "a.png"), "out") == os.path.join("out", "a.png.bmp")
+
+
+def test_files_with_the_same_base_name_keep_their_results_apart(tmp_path):
+    _save(str(tmp_path / "in" / "a.bmp"), 10)
+    _save(str(tmp_path / "in" / "a.png"), 20)
+    output_dir = str(tmp_path / "out")
+    lines = []
+
+    failed = run_batch(MANIP_FILE, [("negate", {})], [str(tmp_path / "in" / "a.bmp"), str(tmp_path / "in" / "a.png")], output_dir, {"color": (0, 0, 0), "extra": ""}, workers=1, report=lines.append)
+
+    assert failed == 0
+    assert (get_pixels(open_bmp(os.path.join(output_dir, "a.bmp"))) == 245).all()
+    assert (get_pixels(open_bmp(os.path.join(output_dir, "a.png.bmp"))) == 235).all()
+
+
+def test_results_that_would_overwrite_each_other_fail(tmp_path):
+    _save(str(tmp_path / "one" / "a.bmp"), 10)
+    _save(str(tmp_path / "two" / "a.bmp"), 20)
+    output_dir = str(tmp_path / "out")
+    lines = []
+
+    failed = run_batch(MANIP_FILE, [("negate", {})], [str(tmp_path / "one" / "a.bmp"), str(tmp_path / "two" / "a.bmp")], output_dir, {"color": (0, 0, 0), "extra": ""}, workers=1, report=lines.append)
+
+    assert failed == 1
+    assert any("two" in line and "overwrite" in line for line in lines)
+    assert (get_pixels(open_bmp(os.path.join(output_dir, "a.bmp"))) == 245).all()
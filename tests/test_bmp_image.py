@@ -0,0 +1,16 @@
+import os
+
+from BmpImage import MMAP_THRESHOLD, MappedImage, copy_bmp, get_alpha, get_pixels, open_image, save_bmp
+
+
+def test_big_bmp_without_alpha_stays_opaque_in_copies(tmp_path, gray_image):
+    file_name = str(tmp_path / "no_alpha.bmp")
+    image = gray_image(10, 2100, 2100, 32)  # (alpha all 0)
+    save_bmp(image, file_name)
+    assert os.path.getsize(file_name) >= MMAP_THRESHOLD
+
+    opened = open_image(file_name)
+    assert isinstance(opened, MappedImage)
+    assert (get_alpha(opened) == 255).all()
+    copy = copy_bmp(opened)
+    assert (get_alpha(copy) == 255).all() and (get_pixels(copy) == 10).all()
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+import Compositing
+
+# what each blend mode works out, in floats between 0 and 1
+BLENDS = {
+    "normal": lambda base, top: top,
+    "multiply": lambda base, top: base * top,
+    "screen": lambda base, top: 1 - (1 - base) * (1 - top),
+    "overlay": lambda base, top: np.where(base < 0.5, 2 * base * top, 1 - 2 * (1 - base) * (1 - top)),
+    "difference": lambda base, top: np.abs(base - top),
+}
+
+
+def _random_pixels(height, width, channels=3, seed=0):
+    return np.random.default_rng(seed).integers(0, 256, size=(height, width, channels), dtype=np.uint8)
+
+
+@pytest.mark.parametrize("mode", sorted(BLENDS))
+def test_blend_modes(mode):
+    base, top = _random_pixels(40, 50), _random_pixels(40, 50, seed=1)
+    expected = BLENDS[mode](base / 255, top / 255) * 255
+    Compositing.composite(base, top, mode=mode)
+    assert np.abs(base - expected).max() <= 1
+
+
+@pytest.mark.parametrize("mode", sorted(BLENDS))
+def test_opacity_mixes_in_part_of_the_blend(mode):
+    base, top = _random_pixels(40, 50), _random_pixels(40, 50, seed=1)
+    original = base.astype(float)
+    expected = (BLENDS[mode](original / 255, top / 255) * 255 + original) / 2
+    Compositing.composite(base, top, mode=mode, opacity=0.5)
+    assert np.abs(base - expected).max() <= 1.5
+
+
+def test_matte_shows_the_top_only_where_it_is_opaque():
+    base, top = np.full((10, 10, 3), 200, dtype=np.uint8), np.full((10, 10, 3), 20, dtype=np.uint8)
+    matte = np.zeros((10, 10), dtype=np.uint8)
+    matte[:, :5] = 255
+    matte[:, 5] = 128
+    Compositing.composite(base, top, matte=matte)
+    assert (base[:, :5] == 20).all() and (base[:, 6:] == 200).all()
+    assert (np.abs(base[:, 5].astype(int) - 110) <= 1).all()
+
+
+def test_top_is_clipped_to_the_base():
+    base, top = np.zeros((10, 10, 3), dtype=np.uint8), np.full((6, 6, 3), 255, dtype=np.uint8)
+    Compositing.composite(base, top, position=(7, -2))
+    covered = np.zeros((10, 10), dtype=bool)
+    covered[0:4, 7:10] = True
+    assert (base[covered] == 255).all() and (base[~covered] == 0).all()
+
+
+def test_transparent_base_becomes_as_opaque_as_the_top():
+    base = np.zeros((4, 4, 4), dtype=np.uint8)  # (fully transparent)
+    top = np.full((4, 4, 3), 90, dtype=np.uint8)
+    Compositing.composite(base, top, opacity=0.5)
+    assert (base[:, :, :3] == 90).all()
+    assert (np.abs(base[:, :, 3].astype(int) - 128) <= 1).all()
+
+
+def test_unknown_blend_mode():
+    with pytest.raises(ValueError):
+        Compositing.composite(_random_pixels(2, 2), _random_pixels(2, 2), mode="dodge")
+
+
+def test_chroma_key_replaces_the_screen():
+    base = np.full((8, 8, 3), 50, dtype=np.uint8)
+    top = np.zeros((8, 8, 3), dtype=np.uint8)
+    top[...] = (0, 255, 0)  # green screen (BGR)
+    top[2:6, 2:6] = (30, 60, 90)  # what was in front of it
+    Compositing.chroma_composite(base, top, key="green", tolerance=100)
+
+    assert (base[2:6, 2:6] == (30, 60, 90)).all()
+    base[2:6, 2:6] = 50
+    assert (base == 50).all()
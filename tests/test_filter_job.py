@@ -0,0 +1,48 @@
+import ImageManip
+from BmpImage import MappedImage, clear_bmp_pool, get_pixels, save_bmp, take_bmp
+from FilterJob import FilterJob
+
+
+def _run(job):
+    job.start()
+    job._thread.join()
+    return job
+
+
+def test_mapped_image_is_filtered_with_its_unmarked_changes(tmp_path, gray_image):
+    file_name = str(tmp_path / "gray.bmp")
+    save_bmp(gray_image(10), file_name)
+    image = MappedImage(file_name)
+    get_pixels(image)[:8] = 100  # (written without marking the image changed)
+
+    job = _run(FilterJob(ImageManip.negate, image, lambda job: None, color=(0, 0, 0), extra=""))
+
+    assert job.error is None and job.result is not image
+    assert (get_pixels(job.result)[:8] == 155).all() and (get_pixels(job.result)[8:] == 245).all()
+    assert (get_pixels(image)[:8] == 100).all() and (get_pixels(image)[8:] == 10).all()
+
+
+def test_cancelled_job_gives_its_copy_back(gray_image):
+    clear_bmp_pool()
+    image = gray_image(10)
+    job = FilterJob(ImageManip.negate, image, lambda job: None, color=(0, 0, 0), extra="")
+    job.cancel()
+    _run(job)
+
+    assert job.result is None and job.cancelled
+    assert (get_pixels(image) == 10).all()
+    copy = take_bmp(64, 48)  # the copy the job worked on
+    assert copy is not image and (get_pixels(copy) == 10).all()
+
+
+def test_result_thrown_away_is_given_back(gray_image):
+    clear_bmp_pool()
+    image = gray_image(10)
+    job = _run(FilterJob(ImageManip.negate, image, lambda job: None, color=(0, 0, 0), extra=""))
+    result = job.result
+    job.cancel()  # (too late to stop it)
+
+    job.discard()
+
+    assert job.result is None
+    assert take_bmp(64, 48) is result
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+import ImageManip
+from BmpImage import get_pixels
+from FilterPipeline import FilterPipeline
+from PythoShopExports import get_exports
+
+KWARGS = {"color": (40, 120, 200), "extra": ""}
+
+COLOR_MAP_FILTERS = [name for name, func in get_exports(ImageManip).items() if func.__type__ == "filter" and (func.__point_op__ or func.__channel_op__)]
+
+
+def _pixel_by_pixel(func, image):
+    """Run a filter as written, straight on the pixels (no lookup table)"""
+    image.seek(0)
+    func.__wrapped__(image, **KWARGS)
+
+
+@pytest.mark.parametrize("name", COLOR_MAP_FILTERS)
+def test_color_map_matches_the_filter(name, noisy_image):
+    func = getattr(ImageManip, name)
+    image, expected = noisy_image(), noisy_image()
+    func(image, **KWARGS)
+    _pixel_by_pixel(func, expected)
+    assert np.array_equal(get_pixels(image), get_pixels(expected))
+
+
+def test_pipeline_matches_running_each_filter(noisy_image):
+    # point and channel ops (fused into color maps) on either side of a pixel op
+    steps = [ImageManip.negate, ImageManip.swap_rgb, ImageManip.lighten, ImageManip.make_gray, ImageManip.darken, ImageManip.swap_grb]
+    image, expected = noisy_image(), noisy_image()
+
+    result = FilterPipeline(steps)(image, **KWARGS)
+
+    for func in steps:
+        expected.seek(0)
+        returned = func(expected, **KWARGS)
+        expected = expected if returned is None else returned
+    assert np.array_equal(get_pixels(result or image), get_pixels(expected))
+
+
+def test_pipeline_needs_exported_filters():
+    with pytest.raises(ValueError):
+        FilterPipeline([ImageManip.negate, ImageManip.change_pixel])
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+import ImageManip
+from BmpImage import get_pixels
+
+
+@pytest.mark.parametrize("extra", ["seed=7", "gaussian 20 seed=7", "salt 30 seed=7"])
+def test_static_with_a_seed_repeats(extra, gray_image):
+    first, second, other = gray_image(0), gray_image(0), gray_image(0)
+    ImageManip.make_static(first, color=(100, 100, 100), extra=extra)
+    ImageManip.make_static(second, color=(100, 100, 100), extra=extra)
+    ImageManip.make_static(other, color=(100, 100, 100), extra=extra.replace("seed=7", "seed=8"))
+
+    assert np.array_equal(get_pixels(first), get_pixels(second))
+    assert not np.array_equal(get_pixels(first), get_pixels(other))
+
+
+def test_uniform_static_stays_within_its_distance(gray_image):
+    image = gray_image(0)
+    ImageManip.make_static(image, color=(100, 150, 200), extra="20 seed=1")
+    pixels = get_pixels(image).astype(int)
+    for channel, value in zip((2, 1, 0), (100, 150, 200)):
+        assert pixels[:, :, channel].min() >= value - 20 and pixels[:, :, channel].max() <= value + 20
+
+
+def _bands(gray_image):
+    # columns 0-19 are 100, 20-39 are 105, 40-63 are 120
+    image = gray_image(100)
+    get_pixels(image)[:, 20:40] = 105
+    get_pixels(image)[:, 40:] = 120
+    return image
+
+
+@pytest.mark.parametrize("tolerance, filled_columns", [("", 20), ("4", 20), ("5", 40), ("19", 40), ("20", 64)])
+def test_bucket_fill_tolerance(tolerance, filled_columns, gray_image):
+    image = _bands(gray_image)
+    ImageManip.bucket_fill(image, (0, 0), (0, 0, 255), tolerance)
+
+    blue = (get_pixels(image) == (255, 0, 0)).all(axis=2)
+    assert blue[:, :filled_columns].all() and not blue[:, filled_columns:].any()
+
+
+def test_bucket_fill_stays_in_the_connected_area(gray_image):
+    image = gray_image(100)
+    get_pixels(image)[:, 30:34] = 0  # a wall from bottom to top
+    ImageManip.bucket_fill(image, (5, 5), (255, 255, 255), "10")
+
+    pixels = get_pixels(image)
+    assert (pixels[:, :30] == 255).all()
+    assert (pixels[:, 30:34] == 0).all() and (pixels[:, 34:] == 100).all()
@@ -0,0 +1,72 @@
+import io
+
+import numpy as np
+import pytest
+
+import ImageManip
+import StripExecutor
+from BmpImage import get_header, get_pixels, open_bmp, save_bmp, take_dirty
+from FilterPipeline import FilterPipeline
+from ImageStats import get_image_stats, sample_color
+
+
+def test_stats_follow_rows_filtered_in_steps(gray_image):
+    image = gray_image(10)
+    assert get_image_stats(image).mean == (10, 10, 10)
+    assert sample_color(image, 5, 5, 3) == (10, 10, 10)
+
+    StripExecutor.run_in_strips(ImageManip.negate, image, workers=1, progress=lambda done, total: None, color=(0, 0, 0), extra="")
+
+    assert (get_pixels(image) == 245).all()
+    assert get_image_stats(image).mean == (245, 245, 245)
+    assert sample_color(image, 5, 5, 3) == (245, 245, 245)
+
+
+def test_stats_follow_rows_filtered_in_parallel(monkeypatch, gray_image):
+    monkeypatch.setattr(StripExecutor, "STRIP_MIN_PIXELS", 0)
+    image = gray_image(10)
+    assert get_image_stats(image).mean == (10, 10, 10)
+
+    StripExecutor.run_in_strips(ImageManip.negate, image, workers=2, color=(0, 0, 0), extra="")
+
+    assert (get_pixels(image) == 245).all()
+    assert get_image_stats(image).mean == (245, 245, 245)
+
+
+@pytest.mark.parametrize("top_down", [False, True])
+def test_filtered_rows_are_marked_dirty(top_down, gray_image):
+    image = gray_image(10)
+    if top_down:
+        image.getbuffer()[22:26] = (-48).to_bytes(4, "little", signed=True)
+    take_dirty(image)
+
+    StripExecutor.run_in_strips(ImageManip.negate, image, workers=1, progress=lambda done, total: None, color=(0, 0, 0), extra="")
+
+    assert take_dirty(image) == (0, 0, 64, 48)
+
+
+@pytest.mark.parametrize("top_down", [False, True])
+@pytest.mark.parametrize("func", [ImageManip.make_gray, FilterPipeline([ImageManip.negate, ImageManip.swap_rgb, ImageManip.make_gray])])
+def test_filter_file_matches_filtering_in_memory(tmp_path, func, top_down, noisy_image):
+    image = noisy_image(61, 37)  # (rows with padding)
+    if top_down:
+        image.getbuffer()[22:26] = (-37).to_bytes(4, "little", signed=True)
+    source_name, destination_name = str(tmp_path / "source.bmp"), str(tmp_path / "destination.bmp")
+    save_bmp(image, source_name)
+    progress = []
+
+    header = StripExecutor.filter_file(func, source_name, destination_name, chunk_bytes=1000, progress=lambda done, total: progress.append(done), color=(0, 0, 0), extra="")
+
+    expected = io.BytesIO(image.getbuffer())
+    result = func(expected, color=(0, 0, 0), extra="")
+    filtered = open_bmp(destination_name)
+    assert not header.top_down and get_header(filtered).raw == header.raw
+    assert np.array_equal(get_pixels(filtered), get_pixels(result or expected))
+    assert len(progress) > 1 and progress[-1] == 37
+
+
+def test_filter_file_needs_a_strip_safe_filter(tmp_path, gray_image):
+    source_name = str(tmp_path / "source.bmp")
+    save_bmp(gray_image(10), source_name)
+    with pytest.raises(ValueError):
+        StripExecutor.filter_file(ImageManip.make_static, source_name, str(tmp_path / "destination.bmp"), color=(0, 0, 0), extra="")
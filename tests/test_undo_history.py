@@ -0,0 +1,132 @@
+import io
+
+import pytest
+from PIL import Image
+
+import ImageManip
+from BmpImage import expand_palette, get_palette, get_pixels, mark_changing, mark_dirty, take_dirty
+from FilterJob import FilterJob
+from UndoHistory import UndoHistory
+
+
+def _indexed_image(value, width=64, height=64):
+    picture = Image.new("P", (width, height), 0)
+    picture.putpalette([value, value, value] * 256)
+    image = io.BytesIO()
+    picture.save(image, "BMP")
+    image.seek(0)
+    return image
+
+
+def _paint(image, area, value):
+    left, bottom, right, top = area
+    mark_changing(image, left, bottom, right, top)
+    get_pixels(image)[bottom:top, left:right] = value
+
+
+def test_step_bigger_than_the_cap_is_kept(gray_image):
+    image = gray_image(10, 128, 128)
+    history = UndoHistory(memory_cap=30000)  # room for two 64 x 64 tiles, not for the whole image
+    history.reset(image)
+    _paint(image, (0, 0, 64, 64), 20)
+    history.record(image, (0, 0, 64, 64))
+    _paint(image, (64, 64, 128, 128), 30)
+    history.record(image, (64, 64, 128, 128))
+    assert history.memory_used <= history.memory_cap
+
+    smaller = gray_image(40, 32, 32)
+    history.record(smaller)  # keeps the whole 128 x 128 image, which is over the cap
+
+    assert history.can_undo()
+    restored = history.undo()
+    assert restored is image
+    assert (get_pixels(restored)[:64, :64] == 20).all() and (get_pixels(restored)[64:, 64:] == 30).all()
+    assert not history.can_undo()  # the steps before it had to go
+    assert history.redo() is smaller
+
+
+def test_oldest_steps_are_forgotten_first(gray_image):
+    image = gray_image(10, 128, 128)
+    history = UndoHistory(memory_cap=30000)
+    history.reset(image)
+    for value, area in ((20, (0, 0, 64, 64)), (30, (64, 0, 128, 64)), (40, (0, 64, 64, 128))):
+        _paint(image, area, value)
+        history.record(image, area)
+
+    assert history.memory_used <= history.memory_cap
+    history.undo()
+    history.undo()
+    assert not history.can_undo()
+    assert (get_pixels(image)[:64, :64] == 20).all() and (get_pixels(image)[64:, :] == 10).all()
+
+
+def test_no_copy_of_the_image_is_kept(gray_image):
+    image = gray_image(10, 128, 128)
+    history = UndoHistory()
+    history.reset(image)
+    assert history.memory_used == 0
+
+    mark_changing(image, 0, 0, 1, 1)  # tiles are only saved once a change is announced
+    assert history.memory_used == 64 * 64 * 3
+    get_pixels(image)[0, 0] = 20
+    history.record(image, (0, 0, 1, 1))
+    assert history.memory_used == 64 * 64 * 3
+
+
+def test_tool_changes_are_undone(gray_image):
+    image = gray_image(10, 128, 128)
+    history = UndoHistory()
+    history.reset(image)
+    ImageManip.fill_circle(image, (70, 70), (255, 0, 0), "5")
+    history.record(image, take_dirty(image))
+    ImageManip.bucket_fill(image, (0, 0), (0, 255, 0), "")
+    history.record(image, take_dirty(image))
+    assert (get_pixels(image)[0, 0] == (0, 255, 0)).all() and (get_pixels(image)[70, 70] == (0, 0, 255)).all()
+
+    history.undo()
+    assert (get_pixels(image)[0, 0] == 10).all() and (get_pixels(image)[70, 70] == (0, 0, 255)).all()
+    history.undo()
+    assert (get_pixels(image) == 10).all()
+    history.redo()
+    history.redo()
+    assert (get_pixels(image)[0, 0] == (0, 255, 0)).all() and (get_pixels(image)[70, 70] == (0, 0, 255)).all()
+
+
+def test_new_buffer_is_compared_with_the_old_one(gray_image):
+    image = gray_image(10, 128, 128)
+    history = UndoHistory()
+    history.reset(image)
+    result = io.BytesIO(image.getbuffer())
+    get_pixels(result)[100:, :] = 50
+    history.record(result)
+
+    assert history.memory_used == 2 * 64 * 64 * 3  # just the two tiles of the top rows
+    assert history.undo() is result
+    assert (get_pixels(result) == 10).all()
+
+
+def test_palette_filter_in_a_job_is_a_palette_step():
+    image = _indexed_image(10)
+    history = UndoHistory()
+    history.reset(image)
+    job = FilterJob(ImageManip.negate, image, lambda job: None, color=(0, 0, 0), extra="")
+    job.start()
+    job._thread.join()
+    assert job.result is not image
+    history.record(job.result)
+
+    assert history.memory_used == get_palette(image).nbytes  # no copy of the pixels
+    assert (expand_palette(job.result) == 245).all()
+    assert history.undo() is job.result
+    assert (expand_palette(job.result) == 10).all()
+
+
+def test_unannounced_change_is_warned_about(gray_image):
+    image = gray_image(10, 128, 128)
+    history = UndoHistory()
+    history.reset(image)
+    get_pixels(image)[:4, :4] = 20
+    mark_dirty(image, 0, 0, 4, 4)
+
+    with pytest.warns(UserWarning, match="mark_changing"):
+        history.record(image, take_dirty(image))